@@ -1,38 +1,63 @@
 #!/usr/bin/env python3
 
 import pyshark
-from collections import Counter, defaultdict
+from collections import Counter, defaultdict, deque, OrderedDict
 import ipaddress
 import sys
 import argparse
 import json
 import logging
 import hashlib
+import base64
 import sqlite3
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 import asyncio
 import aiohttp
 from typing import Dict, List, Tuple, Optional
 import configparser
 import smtplib
-from email.mime.text import MimeText
-from email.mime.multipart import MimeMultipart
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
 import re
 import geoip2.database
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import multiprocessing
 import os
 import tempfile
+import glob
+import copy
+import pickle
 import zipfile
-from cryptography.fernet import Fernet
+import gzip
+import random
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 import hmac
+import uuid
+import mmap
+import struct
 
 # Дополнительные импорты для новых функций
 import requests
 from urllib.parse import urlparse
 import socket
 import subprocess
+import shutil
 import statistics
+import zlib
+import math
+import time
+import queue
+import threading
+import contextlib
+import platform
+import resource
+import fcntl
+import heapq
+import bisect
 
 # Enterprise конфигурация
 class EnterpriseConfig:
@@ -54,192 +79,3332 @@ class EnterpriseConfig:
     
     def get_quarantine_settings(self):
         return dict(self.config['QUARANTINE']) if 'QUARANTINE' in self.config else {}
+    
+    def get_ioc_settings(self):
+        return dict(self.config['IOC']) if 'IOC' in self.config else {}
+    
+    def get_database_settings(self):
+        return dict(self.config['DATABASE']) if 'DATABASE' in self.config else {}
+    
+    def digest(self) -> str:
+        """Отпечаток всех секций: смена порогов или фидов меняет результат"""
+        sections = {name: dict(self.config[name]) for name in self.config.sections()}
+        return hashlib.blake2b(json.dumps(sections, sort_keys=True).encode(), digest_size=16).hexdigest()
+
+# Поиск ключевых слов доменов: автомат Ахо-Корасик вместо перебора списка
+class KeywordMatcher:
+    """Бор ключевых слов со ссылками неудачи: поиск за один проход по имени,
+    O(длина имени) независимо от числа ключевых слов. Автомат строится
+    лениво при первом поиске после добавления. Из нескольких совпавших
+    возвращается первое по порядку фида, как при переборе списка."""
+    
+    def __init__(self, keywords=()):
+        self.keywords = []
+        self._indexes = {}
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [-1]  # наименьший индекс слова, оканчивающегося в узле
+        self._built = True
+        for keyword in keywords:
+            self.add(keyword)
+    
+    def add(self, keyword: str):
+        if not keyword or keyword in self._indexes:
+            return
+        self._indexes[keyword] = len(self.keywords)
+        self.keywords.append(keyword)
+        node = 0
+        for char in keyword:
+            next_node = self._goto[node].get(char)
+            if next_node is None:
+                next_node = self._goto[node][char] = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(-1)
+            node = next_node
+        if self._output[node] == -1:
+            self._output[node] = self._indexes[keyword]
+        self._built = False
+    
+    def _build(self):
+        """Ссылки неудачи обходом в ширину; выход узла включает выходы по ссылке"""
+        goto, fail, output = self._goto, self._fail, self._output
+        for node in range(len(goto)):
+            fail[node] = 0
+        queue = deque(goto[0].values())
+        while queue:
+            node = queue.popleft()
+            suffix_output = output[fail[node]]
+            if suffix_output != -1 and (output[node] == -1 or suffix_output < output[node]):
+                output[node] = suffix_output
+            for char, child in goto[node].items():
+                state = fail[node]
+                while state and char not in goto[state]:
+                    state = fail[state]
+                fail[child] = goto[state].get(char, 0)
+                queue.append(child)
+        self._built = True
+    
+    def match(self, text: str) -> Optional[str]:
+        """Первое по порядку фида ключевое слово, входящее в text, или None"""
+        if not self.keywords:
+            return None
+        if not self._built:
+            self._build()
+        goto, fail, output = self._goto, self._fail, self._output
+        node = 0
+        best = -1
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            found = output[node]
+            if found != -1 and (best == -1 or found < best):
+                best = found
+                if best == 0:
+                    break
+        return self.keywords[best] if best != -1 else None
+
+# Индекс доменов IOC: поиск по суффиксам меток вместо перебора всего фида
+class DomainSuffixIndex:
+    """Записи с точкой совпадают с самим доменом и его поддоменами
+    (evil.com -> evil.com, a.b.evil.com). Поиск проверяет каждый суффикс
+    запроса по границе меток в хеш-множестве - это проход по обращенному
+    дереву меток за O(число меток) без узлов-словарей на каждую метку.
+    Записи без точки остаются ключевыми словами с поиском подстроки
+    (KeywordMatcher)."""
+    
+    def __init__(self, domains=()):
+        self.suffixes = set()
+        self.keyword_matcher = KeywordMatcher()
+        for domain in domains:
+            self.add(domain)
+    
+    def add(self, domain: str):
+        domain = domain.strip().lower().strip('.')
+        if not domain:
+            return
+        if '.' in domain:
+            self.suffixes.add(domain)
+        else:
+            self.keyword_matcher.add(domain)
+    
+    @property
+    def keywords(self) -> List[str]:
+        return self.keyword_matcher.keywords
+    
+    def match(self, domain: str) -> Optional[str]:
+        """Совпавшая запись фида или None"""
+        domain = domain.lower().rstrip('.')
+        suffixes = self.suffixes
+        if domain in suffixes:
+            return domain
+        dot = domain.find('.')
+        while dot != -1:
+            suffix = domain[dot + 1:]
+            if suffix in suffixes:
+                return suffix
+            dot = domain.find('.', dot + 1)
+        return self.keyword_matcher.match(domain)
+
+# Индекс сетей IOC: отсортированные непересекающиеся интервалы адресов
+class IPRangeIndex:
+    """Сети CIDR отсортированы по (начало, -конец); так как CIDR сети либо
+    вложены, либо не пересекаются, у каждой хранится индекс ближайшей
+    объемлющей. Поиск: bisect до последней сети с началом не больше адреса,
+    затем подъем по объемлющим до первой, содержащей адрес, - это самая
+    узкая сеть фида. Подъем ограничен глубиной вложенности."""
+    
+    def __init__(self, networks=()):
+        self.starts = {4: [], 6: []}
+        self.ends = {4: [], 6: []}
+        self.labels = {4: [], 6: []}
+        self.parents = {4: [], 6: []}
+        self.build(networks)
+    
+    def build(self, networks):
+        ranges = {4: set(), 6: set()}
+        for entry in networks:
+            try:
+                network = ipaddress.ip_network(entry.strip(), strict=False)
+            except ValueError:
+                logging.warning(f"Invalid IOC network: {entry}")
+                continue
+            ranges[network.version].add((int(network.network_address),
+                                         int(network.broadcast_address), str(network)))
+        
+        for version, items in ranges.items():
+            starts, ends, labels, parents = [], [], [], []
+            stack = []  # индексы объемлющих сетей текущей цепочки
+            for start, end, label in sorted(items, key=lambda item: (item[0], -item[1])):
+                while stack and ends[stack[-1]] < start:
+                    stack.pop()
+                parents.append(stack[-1] if stack else -1)
+                stack.append(len(starts))
+                starts.append(start)
+                ends.append(end)
+                labels.append(label)
+            self.starts[version], self.ends[version] = starts, ends
+            self.labels[version], self.parents[version] = labels, parents
+    
+    def match(self, ip: str) -> Optional[str]:
+        """Самая узкая сеть, содержащая адрес, или None"""
+        try:
+            value, version = int.from_bytes(socket.inet_pton(socket.AF_INET, ip), 'big'), 4
+        except OSError:
+            try:
+                value, version = int.from_bytes(socket.inet_pton(socket.AF_INET6, ip), 'big'), 6
+            except OSError:
+                return None
+        
+        i = bisect.bisect_right(self.starts[version], value) - 1
+        if i < 0:
+            return None
+        ends = self.ends[version]
+        if value > ends[i]:
+            parents = self.parents[version]
+            i = parents[i]
+            while i >= 0 and value > ends[i]:
+                i = parents[i]
+            if i < 0:
+                return None
+        return self.labels[version][i]
+    
+    def __len__(self) -> int:
+        return len(self.starts[4]) + len(self.starts[6])
+
+# Множество с номером версии: индексы IOC перестраиваются при любом изменении
+class VersionedSet(set):
+    MUTATORS = ('add', 'discard', 'remove', 'pop', 'clear', 'update', 'difference_update',
+                'intersection_update', 'symmetric_difference_update',
+                '__ior__', '__iand__', '__isub__', '__ixor__')
+    
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.version = 0
+
+def _versioned_mutator(name: str):
+    method = getattr(set, name)
+    
+    def wrapper(self, *args):
+        self.version += 1
+        return method(self, *args)
+    wrapper.__name__ = name
+    return wrapper
+
+for _name in VersionedSet.MUTATORS:
+    setattr(VersionedSet, _name, _versioned_mutator(_name))
+
+# Скомпилированный снимок IOC фида для отображения в память (mmap)
+class IOCSnapshot:
+    """Бинарный снимок фида: домены, хеши файлов и точные IP (в упакованном
+    виде) лежат в таблицах с открытой адресацией из 64-битных ключей
+    BLAKE2b. Сети CIDR хранятся как в IPRangeIndex: массивы начал, концов
+    и индексов объемлющей сети, поэтому поиск возвращает самую узкую сеть.
+    Запросы выполняются прямо по отображению, поэтому все процессы делят
+    одни страницы. Вероятность ложного совпадения ключа - порядка
+    (размер фида) / 2**64."""
+    
+    MAGIC_PREFIX = b'WFIOC\x00\x00'
+    MAGIC = b'WFIOC\x00\x00\x02'
+    HEADER = struct.Struct('<8s12Q')
+    
+    def __init__(self, snapshot_file: str):
+        with open(snapshot_file, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic = self._mm[:len(self.MAGIC)]
+        if magic != self.MAGIC:
+            self._mm.close()
+            if magic.startswith(self.MAGIC_PREFIX):
+                raise ValueError(f"IOC snapshot {snapshot_file} has an old format, "
+                                 f"recompile it with --compile-ioc")
+            raise ValueError(f"Not an IOC snapshot: {snapshot_file}")
+        (_, self.domain_offset, self.domain_slots, self.exact_offset, self.exact_slots,
+         self.ipv4_offset, self.ipv4_count, self.ipv6_offset, self.ipv6_count,
+         self.hash_offset, self.hash_slots, json_offset, json_length) = self.HEADER.unpack_from(self._mm, 0)
+        
+        extra = json.loads(self._mm[json_offset:json_offset + json_length])
+        self.keyword_matcher = KeywordMatcher(extra['keywords'])
+        self.metadata = extra['metadata']
+        self.counts = extra['counts']
+        self._digest = None
+    
+    def digest(self) -> str:
+        """Отпечаток содержимого снимка (версия фида)"""
+        if self._digest is None:
+            self._digest = hashlib.blake2b(self._mm, digest_size=16).hexdigest()
+        return self._digest
+    
+    @classmethod
+    def is_snapshot(cls, path: str) -> bool:
+        with open(path, 'rb') as f:
+            return f.read(len(cls.MAGIC_PREFIX)) == cls.MAGIC_PREFIX
+    
+    @staticmethod
+    def _key(value) -> int:
+        # 0 обозначает пустой слот; точные IP хешируются в упакованном виде
+        data = value.encode() if isinstance(value, str) else value
+        return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'little') or 1
+    
+    @staticmethod
+    def _network_section(ranges: 'IPRangeIndex', version: int) -> bytes:
+        width = 4 if version == 4 else 16
+        return (b''.join(start.to_bytes(width, 'big') for start in ranges.starts[version]) +
+                b''.join(end.to_bytes(width, 'big') for end in ranges.ends[version]) +
+                struct.pack(f'<{len(ranges.parents[version])}i', *ranges.parents[version]))
+    
+    @classmethod
+    def _hash_table(cls, keys) -> bytes:
+        keys = {cls._key(key) for key in keys}
+        slots = max(8, len(keys) * 2)
+        table = [0] * slots
+        for key in keys:
+            i = key % slots
+            while table[i]:
+                i = (i + 1) % slots
+            table[i] = key
+        return struct.pack(f'<{slots}Q', *table)
+    
+    @classmethod
+    def compile(cls, ioc_file: str, snapshot_file: str):
+        """Компиляция JSON фида в снимок (выполняется один раз, офлайн)"""
+        with open(ioc_file, 'r') as f:
+            data = json.load(f)
+        
+        domains = DomainSuffixIndex(data.get('suspicious_domains', []))
+        # Точные адреса и сети CIDR хранятся раздельно, как в IOCManager
+        exact = []
+        for entry in data.get('malicious_ips', []):
+            if '/' not in entry:
+                try:
+                    exact.append(ipaddress.ip_address(entry.strip()).packed)
+                except ValueError:
+                    logging.warning(f"Invalid IOC address: {entry}")
+        ranges = IPRangeIndex(entry for entry in data.get('malicious_ips', []) if '/' in entry)
+        hashes = [h.strip().lower() for h in data.get('malware_hashes', [])]
+        
+        sections = [
+            cls._hash_table(domains.suffixes),
+            cls._hash_table(exact),
+            cls._network_section(ranges, 4),
+            cls._network_section(ranges, 6),
+            cls._hash_table(hashes),
+            json.dumps({
+                'keywords': domains.keywords,
+                'metadata': data.get('metadata', {}),
+                'counts': {'malicious_ips': len(data.get('malicious_ips', [])),
+                           'suspicious_domains': len(data.get('suspicious_domains', [])),
+                           'malware_hashes': len(hashes)}
+            }).encode()
+        ]
+        
+        offsets = []
+        offset = cls.HEADER.size
+        for section in sections:
+            offsets.append(offset)
+            offset += len(section) + (-len(section) % 8)
+        
+        header = cls.HEADER.pack(
+            cls.MAGIC,
+            offsets[0], len(sections[0]) // 8,
+            offsets[1], len(sections[1]) // 8,
+            offsets[2], len(ranges.starts[4]),
+            offsets[3], len(ranges.starts[6]),
+            offsets[4], len(sections[4]) // 8,
+            offsets[5], len(sections[5])
+        )
+        
+        # Запись во временный файл и атомарная замена: читатели не видят половину снимка
+        tmp_file = f"{snapshot_file}.tmp"
+        with open(tmp_file, 'wb') as f:
+            f.write(header)
+            for section in sections:
+                f.write(section + b'\x00' * (-len(section) % 8))
+        os.replace(tmp_file, snapshot_file)
+        logging.info(f"IOC snapshot compiled: {ioc_file} -> {snapshot_file}")
+    
+    def _lookup(self, offset: int, slots: int, value) -> bool:
+        if not slots:
+            return False
+        key = self._key(value)
+        i = key % slots
+        while True:
+            slot = struct.unpack_from('<Q', self._mm, offset + i * 8)[0]
+            if slot == key:
+                return True
+            if not slot:
+                return False
+            i = (i + 1) % slots
+    
+    def _network_lookup(self, offset: int, count: int, width: int, value: bytes) -> Optional[str]:
+        """Самая узкая сеть, содержащая адрес: bisect и подъем по объемлющим"""
+        mm = self._mm
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if mm[offset + mid * width:offset + (mid + 1) * width] <= value:
+                lo = mid + 1
+            else:
+                hi = mid
+        ends = offset + count * width
+        parents = ends + count * width
+        i = lo - 1
+        while i >= 0 and value > mm[ends + i * width:ends + (i + 1) * width]:
+            i = struct.unpack_from('<i', mm, parents + i * 4)[0]
+        if i < 0:
+            return None
+        start = int.from_bytes(mm[offset + i * width:offset + (i + 1) * width], 'big')
+        end = int.from_bytes(mm[ends + i * width:ends + (i + 1) * width], 'big')
+        prefix = width * 8 - (end - start).bit_length()
+        return str(ipaddress.ip_network((start, prefix)))
+    
+    def match_domain(self, domain: str) -> Optional[str]:
+        domain = domain.lower().rstrip('.')
+        suffix = domain
+        while True:
+            if self._lookup(self.domain_offset, self.domain_slots, suffix):
+                return suffix
+            dot = suffix.find('.')
+            if dot == -1:
+                break
+            suffix = suffix[dot + 1:]
+        return self.keyword_matcher.match(domain)
+    
+    def match_ip(self, ip: str) -> Optional[str]:
+        """Сам адрес для точной записи, самая узкая сеть (CIDR), содержащая его, или None"""
+        try:
+            value = socket.inet_pton(socket.AF_INET, ip)
+            offset, count, width = self.ipv4_offset, self.ipv4_count, 4
+        except OSError:
+            try:
+                value = socket.inet_pton(socket.AF_INET6, ip)
+            except OSError:
+                return None
+            offset, count, width = self.ipv6_offset, self.ipv6_count, 16
+        if self._lookup(self.exact_offset, self.exact_slots, value):
+            return ip
+        return self._network_lookup(offset, count, width, value)
+    
+    def match_hash(self, file_hash: str) -> bool:
+        return self._lookup(self.hash_offset, self.hash_slots, file_hash.strip().lower())
+    
+    def close(self):
+        self._mm.close()
 
 # Менеджер IOC с поддержкой TLP (Traffic Light Protocol)
 class IOCManager:
     def __init__(self):
-        self.malicious_ips = set()
-        self.suspicious_domains = set()
+        self._indexed_versions = None
+        self.malicious_ips = VersionedSet()
+        self.suspicious_domains = VersionedSet()
         self.malware_hashes = set()
         self.ioc_metadata = {}  # TLP маркировки и источники
+        self.domain_index = DomainSuffixIndex()
+        self.network_index = IPRangeIndex()
+        self.snapshot = None
         
     def load_from_file(self, ioc_file: str):
         try:
+            # Скомпилированный снимок отображается в память без разбора JSON
+            if IOCSnapshot.is_snapshot(ioc_file):
+                self.snapshot = IOCSnapshot(ioc_file)
+                self.ioc_metadata = self.snapshot.metadata
+                return
+            
             with open(ioc_file, 'r') as f:
                 data = json.load(f)
                 self.malicious_ips.update(data.get('malicious_ips', []))
                 self.suspicious_domains.update(data.get('suspicious_domains', []))
                 self.malware_hashes.update(data.get('malware_hashes', []))
                 self.ioc_metadata = data.get('metadata', {})
+            self.rebuild_indexes()
         except Exception as e:
             logging.error(f"Error loading IOC file: {e}")
     
+    def rebuild_indexes(self):
+        """Построение индексов; CIDR записи в malicious_ips уходят в интервальный индекс"""
+        self.domain_index = DomainSuffixIndex(self.suspicious_domains)
+        self.network_index = IPRangeIndex(ip for ip in self.malicious_ips if '/' in ip)
+        self._indexed_versions = (self._malicious_ips.version, self._suspicious_domains.version)
+    
+    # Присвоенное множество оборачивается в VersionedSet, индексы сбрасываются
+    @property
+    def malicious_ips(self) -> VersionedSet:
+        return self._malicious_ips
+    
+    @malicious_ips.setter
+    def malicious_ips(self, entries):
+        self._malicious_ips = entries if isinstance(entries, VersionedSet) else VersionedSet(entries)
+        self._indexed_versions = None
+    
+    @property
+    def suspicious_domains(self) -> VersionedSet:
+        return self._suspicious_domains
+    
+    @suspicious_domains.setter
+    def suspicious_domains(self, entries):
+        self._suspicious_domains = entries if isinstance(entries, VersionedSet) else VersionedSet(entries)
+        self._indexed_versions = None
+    
+    def _ensure_indexes(self):
+        # Множества могли быть изменены напрямую после загрузки
+        if self._indexed_versions != (self._malicious_ips.version, self._suspicious_domains.version):
+            self.rebuild_indexes()
+    
+    def feed_digest(self) -> str:
+        """Версия загруженного фида: отпечаток записей и снимка"""
+        digest = hashlib.blake2b(digest_size=16)
+        for entries in (self.malicious_ips, self.suspicious_domains, self.malware_hashes):
+            digest.update(json.dumps(sorted(entries)).encode())
+        if self.snapshot is not None:
+            digest.update(self.snapshot.digest().encode())
+        return digest.hexdigest()
+    
     def check_ip(self, ip: str) -> Tuple[bool, dict]:
         if ip in self.malicious_ips:
             return True, {'source': 'local_ioc', 'tlp': 'RED', 'confidence': 'high'}
+        self._ensure_indexes()
+        if self.network_index or self.snapshot is not None:
+            network = self.network_index.match(ip)
+            if not network and self.snapshot is not None:
+                network = self.snapshot.match_ip(ip)
+            if network == ip:
+                return True, {'source': 'local_ioc', 'tlp': 'RED', 'confidence': 'high'}
+            if network:
+                return True, {'source': 'local_ioc', 'tlp': 'RED', 'confidence': 'high',
+                              'network': network}
         return False, {}
     
     def check_domain(self, domain: str) -> Tuple[bool, dict]:
-        for suspicious in self.suspicious_domains:
-            if suspicious in domain:
-                return True, {'source': 'local_ioc', 'tlp': 'AMBER', 'confidence': 'medium'}
+        self._ensure_indexes()
+        matched = self.domain_index.match(domain)
+        if not matched and self.snapshot is not None:
+            matched = self.snapshot.match_domain(domain)
+        if matched:
+            return True, {'source': 'local_ioc', 'tlp': 'AMBER', 'confidence': 'medium',
+                          'matched': matched}
+        return False, {}
+    
+    def check_hash(self, file_hash: str) -> Tuple[bool, dict]:
+        if file_hash in self.malware_hashes or file_hash.lower() in self.malware_hashes or \
+                (self.snapshot is not None and self.snapshot.match_hash(file_hash)):
+            return True, {'source': 'local_ioc', 'tlp': 'RED', 'confidence': 'high'}
         return False, {}
 
+# Кеш репутации: LRU с TTL в памяти и постоянный слой в SQLite
+class ReputationCache:
+    """Файл SQLite открывается при первом обращении к кешу, а не при создании"""
+    
+    def __init__(self, max_size: int = 10000, ttl: float = 86400, db_path: str = ''):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expires_at, value)
+        self.db_path = db_path
+        self.db = None
+    
+    def _database(self) -> Optional[sqlite3.Connection]:
+        if self.db is None and self.db_path:
+            self.db = sqlite3.connect(self.db_path)
+            self.db.execute("""CREATE TABLE IF NOT EXISTS reputation (
+                key TEXT PRIMARY KEY, value TEXT, expires_at REAL)""")
+            self.db.commit()
+        return self.db
+    
+    def get(self, key: str):
+        """(найдено, значение); значение None - кешированный отрицательный ответ"""
+        now = time.time()
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[0] > now:
+                self.entries.move_to_end(key)
+                return True, entry[1]
+            del self.entries[key]
+        
+        db = self._database()
+        if db is not None:
+            row = db.execute("SELECT value, expires_at FROM reputation WHERE key = ?",
+                                  (key,)).fetchone()
+            if row and row[1] > now:
+                value = json.loads(row[0])
+                self._remember(key, value, row[1])
+                return True, value
+        return False, None
+    
+    def put(self, key: str, value):
+        expires_at = time.time() + self.ttl
+        self._remember(key, value, expires_at)
+        db = self._database()
+        if db is not None:
+            db.execute("INSERT OR REPLACE INTO reputation VALUES (?, ?, ?)",
+                       (key, json.dumps(value), expires_at))
+            db.commit()
+    
+    def _remember(self, key: str, value, expires_at: float):
+        self.entries[key] = (expires_at, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+    
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+# Ограничение частоты запросов (равномерные интервалы между запросами)
+class AsyncRateLimiter:
+    def __init__(self, requests_per_minute: float):
+        self.interval = 60.0 / requests_per_minute if requests_per_minute > 0 else 0
+        self._next_time = 0.0
+        self._lock = None
+    
+    async def acquire(self):
+        if not self.interval:
+            return
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            now = asyncio.get_running_loop().time()
+            if self._next_time > now:
+                await asyncio.sleep(self._next_time - now)
+            self._next_time = max(now, self._next_time) + self.interval
+
 # Интеграция с VirusTotal API
 class VirusTotalIntegration:
+    """Одна пулированная сессия aiohttp, объединение одинаковых запросов
+    в полете, LRU/TTL кеш с постоянным слоем и бюджет параллельности и
+    частоты. Параметры секции [VIRUSTOTAL]: api_key, base_url,
+    max_concurrency, requests_per_minute, request_timeout, cache_size,
+    cache_ttl, cache_path (пусто - без дискового кеша). Файл кеша
+    создается только при первом запросе с заданным api_key."""
+    
     def __init__(self, config: EnterpriseConfig):
         self.config = config
         self.vt_settings = config.get_virustotal_settings()
         self.api_key = self.vt_settings.get('api_key', '')
-        self.base_url = "https://www.virustotal.com/api/v3"
-        
-    async def check_ip_reputation(self, ip: str) -> Optional[Dict]:
+        self.base_url = self.vt_settings.get('base_url', "https://www.virustotal.com/api/v3").rstrip('/')
+        self.max_concurrency = int(self.vt_settings.get('max_concurrency', 4))
+        self.request_timeout = float(self.vt_settings.get('request_timeout', 30))
+        # Публичный ключ VirusTotal допускает 4 запроса в минуту
+        self.rate_limiter = AsyncRateLimiter(float(self.vt_settings.get('requests_per_minute', 4)))
+        self.cache = ReputationCache(
+            max_size=int(self.vt_settings.get('cache_size', 10000)),
+            ttl=float(self.vt_settings.get('cache_ttl', 86400)),
+            db_path=self.vt_settings.get('cache_path', 'vt_cache.db')
+        )
+        self.lookup_stats = Counter()
+        self._session = None
+        self._semaphore = None
+        self._inflight = {}
+    
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                headers={'x-apikey': self.api_key},
+                connector=aiohttp.TCPConnector(limit=self.max_concurrency),
+                timeout=aiohttp.ClientTimeout(total=self.request_timeout)
+            )
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._session
+    
+    async def _lookup(self, kind: str, value: str) -> Optional[Dict]:
         if not self.api_key:
             return None
-            
+        
+        key = f"{kind}/{value}"
+        found, cached = self.cache.get(key)
+        if found:
+            self.lookup_stats['cache_hits'] += 1
+            return cached
+        
+        # Одинаковые параллельные запросы ждут один и тот же HTTP вызов
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.lookup_stats['coalesced'] += 1
+            return await inflight
+        
+        task = asyncio.ensure_future(self._fetch(key))
+        self._inflight[key] = task
         try:
-            headers = {'x-apikey': self.api_key}
-            async with aiohttp.ClientSession() as session:
-                async with session.get(f"{self.base_url}/ip_addresses/{ip}", 
-                                     headers=headers) as response:
+            return await task
+        finally:
+            self._inflight.pop(key, None)
+    
+    async def _fetch(self, key: str) -> Optional[Dict]:
+        session = self._get_session()
+        async with self._semaphore:
+            await self.rate_limiter.acquire()
+            self.lookup_stats['requests'] += 1
+            try:
+                async with session.get(f"{self.base_url}/{key}") as response:
                     if response.status == 200:
-                        return await response.json()
+                        result = await response.json()
+                        self.cache.put(key, result)
+                        return result
+                    if response.status == 404:
+                        # Неизвестный индикатор тоже кешируется
+                        self.cache.put(key, None)
                     else:
                         logging.warning(f"VirusTotal API error: {response.status}")
-        except Exception as e:
-            logging.error(f"VirusTotal check failed: {e}")
+            except Exception as e:
+                self.lookup_stats['errors'] += 1
+                logging.error(f"VirusTotal check failed: {e}")
         return None
     
+    async def check_ip_reputation(self, ip: str) -> Optional[Dict]:
+        return await self._lookup('ip_addresses', ip)
+    
     async def check_domain_reputation(self, domain: str) -> Optional[Dict]:
-        if not self.api_key:
-            return None
-            
-        try:
-            headers = {'x-apikey': self.api_key}
-            async with aiohttp.ClientSession() as session:
-                async with session.get(f"{self.base_url}/domains/{domain}", 
-                                     headers=headers) as response:
-                    if response.status == 200:
-                        return await response.json()
-        except Exception as e:
-            logging.error(f"VirusTotal domain check failed: {e}")
+        return await self._lookup('domains', domain)
+    
+    async def close(self):
+        """Закрытие HTTP сессии; кеш остается доступным для следующих запусков"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+# Экспорт событий в SIEM: пакеты, сжатие, спул на диске и повторные попытки
+class SIEMExporter:
+    """События копятся в пакет и отправляются по достижении batch_size
+    событий, batch_bytes байт или по истечении flush_interval секунд.
+    HTTP(S): NDJSON в POST (gzip по умолчанию) через общую сессию;
+    syslog://host:port (UDP) и syslog+tcp://host:port - RFC 5424.
+    Пакет, не доставленный за max_retries попыток, пишется в spool_dir
+    и отправляется повторно при следующем запуске экспорта. Пакет,
+    отклоненный SIEM ответом 4xx (кроме 408 и 429), не повторяется и
+    учитывается в rejected_batches/rejected_events, а не как отправленный.
+    Настройки [SIEM]: url, api_key, batch_size, batch_bytes, flush_interval,
+    compression (gzip|none), max_concurrency, max_retries, retry_backoff,
+    request_timeout, spool_dir, spool_max_mb."""
+    
+    SYSLOG_SEVERITY = {'CRITICAL': 2, 'HIGH': 3, 'MEDIUM': 4, 'LOW': 5}
+    
+    def __init__(self, config: EnterpriseConfig):
+        self.siem_settings = config.get_siem_settings()
+        self.url = self.siem_settings.get('url') or self.siem_settings.get('endpoint', '')
+        self.api_key = self.siem_settings.get('api_key', '')
+        self.batch_size = int(self.siem_settings.get('batch_size', 500))
+        self.batch_bytes = int(self.siem_settings.get('batch_bytes', 1 << 20))
+        self.flush_interval = float(self.siem_settings.get('flush_interval', 5))
+        self.compression = self.siem_settings.get('compression', 'gzip')
+        self.max_concurrency = int(self.siem_settings.get('max_concurrency', 4))
+        self.max_retries = int(self.siem_settings.get('max_retries', 5))
+        self.retry_backoff = float(self.siem_settings.get('retry_backoff', 1.0))
+        self.request_timeout = float(self.siem_settings.get('request_timeout', 30))
+        self.spool_dir = self.siem_settings.get('spool_dir', 'siem_spool')
+        self.spool_max_bytes = int(float(self.siem_settings.get('spool_max_mb', 512)) * 1024 * 1024)
+        
+        parsed = urlparse(self.url)
+        self.transport = {'syslog': 'udp', 'syslog+tcp': 'tcp'}.get(parsed.scheme, 'http')
+        self.host, self.port = parsed.hostname, parsed.port or 514
+        self.stats = Counter()
+        
+        self._batch = []
+        self._batch_bytes = 0
+        self._batch_started = None
+        self._session = None
+        self._semaphore = None
+        self._pending = set()
+        self._flusher = None
+        self._unavailable = False
+    
+    @property
+    def enabled(self) -> bool:
+        return bool(self.url)
+    
+    async def start(self):
+        """Открытие соединения, досылка спула и запуск сброса по времени"""
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._unavailable = False
+        if self.transport == 'http' and (self._session is None or self._session.closed):
+            headers = {'Content-Type': 'application/x-ndjson'}
+            if self.api_key:
+                headers['Authorization'] = f"Bearer {self.api_key}"
+            if self.compression == 'gzip':
+                headers['Content-Encoding'] = 'gzip'
+            self._session = aiohttp.ClientSession(
+                headers=headers,
+                connector=aiohttp.TCPConnector(limit=self.max_concurrency),
+                timeout=aiohttp.ClientTimeout(total=self.request_timeout)
+            )
+        await self.drain_spool()
+        self._flusher = asyncio.ensure_future(self._flush_periodically())
+    
+    async def submit(self, event: Dict):
+        """Добавление события; при заполненном пуле отправок вызывающий ждет"""
+        line = json.dumps(event, default=str, ensure_ascii=False)
+        if not self._batch:
+            self._batch_started = time.monotonic()
+        self._batch.append(line)
+        self._batch_bytes += len(line) + 1
+        self.stats['events'] += 1
+        if len(self._batch) >= self.batch_size or self._batch_bytes >= self.batch_bytes:
+            await self.flush()
+    
+    async def flush(self):
+        if not self._batch:
+            return
+        batch, self._batch, self._batch_bytes = self._batch, [], 0
+        # Обратное давление: в полете не больше max_concurrency пакетов
+        while len(self._pending) >= self.max_concurrency:
+            await asyncio.wait(self._pending, return_when=asyncio.FIRST_COMPLETED)
+        task = asyncio.ensure_future(self._deliver(batch))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+    
+    async def close(self):
+        """Отправка остатка, ожидание текущих отправок и закрытие сессии"""
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        await self.flush()
+        if self._pending:
+            await asyncio.wait(self._pending)
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+    
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(min(self.flush_interval, 1.0))
+            if self._batch and time.monotonic() - self._batch_started >= self.flush_interval:
+                await self.flush()
+    
+    def _encode(self, lines: List[str]) -> bytes:
+        payload = ('\n'.join(lines) + '\n').encode('utf-8')
+        return gzip.compress(payload, compresslevel=5) if self.compression == 'gzip' else payload
+    
+    async def _deliver(self, lines: List[str]):
+        payload = self._encode(lines) if self.transport == 'http' else lines
+        # После исчерпания попыток SIEM считается недоступным до конца выгрузки
+        result = None if self._unavailable else await self._send_with_retry(payload)
+        if result == 'sent':
+            self.stats['batches_sent'] += 1
+            self.stats['events_sent'] += len(lines)
+        elif result == 'rejected':
+            self.stats['rejected_batches'] += 1
+            self.stats['rejected_events'] += len(lines)
+        else:
+            self._unavailable = True
+            self._spool(self._encode(lines) if self.transport != 'http' else payload, len(lines))
+    
+    async def _send_with_retry(self, payload) -> Optional[str]:
+        """'sent', 'rejected' (повтор не поможет) или None, если попытки исчерпаны"""
+        for attempt in range(self.max_retries):
+            if attempt:
+                self.stats['retries'] += 1
+                # Экспоненциальная задержка со случайным разбросом
+                await asyncio.sleep(self.retry_backoff * (2 ** (attempt - 1)) * (0.5 + random.random()))
+            async with self._semaphore:
+                try:
+                    if self.transport == 'http':
+                        async with self._session.post(self.url, data=payload) as response:
+                            if response.status < 300:
+                                return 'sent'
+                            if response.status not in (408, 429) and response.status < 500:
+                                # Ошибка в самих данных: повтор не поможет
+                                logging.error(f"SIEM rejected batch: HTTP {response.status}")
+                                return 'rejected'
+                            logging.warning(f"SIEM export error: HTTP {response.status}")
+                    else:
+                        await self._send_syslog(payload)
+                        return 'sent'
+                except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+                    logging.warning(f"SIEM export failed (attempt {attempt + 1}/{self.max_retries}): {e}")
         return None
+    
+    async def _send_syslog(self, lines: List[str]):
+        hostname = socket.gethostname()
+        messages = []
+        for line in lines:
+            severity = self.SYSLOG_SEVERITY.get(json.loads(line).get('severity'), 6)
+            timestamp = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+            messages.append(f"<{16 * 8 + severity}>1 {timestamp} {hostname} net-analyz - - - {line}".encode('utf-8'))
+        
+        loop = asyncio.get_running_loop()
+        if self.transport == 'udp':
+            transport, _ = await loop.create_datagram_endpoint(
+                asyncio.DatagramProtocol, remote_addr=(self.host, self.port))
+            try:
+                for message in messages:
+                    transport.sendto(message)
+            finally:
+                transport.close()
+        else:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), self.request_timeout)
+            try:
+                # Octet counting (RFC 6587): сообщения могут содержать переводы строк
+                writer.write(b''.join(f"{len(m)} ".encode() + m for m in messages))
+                await asyncio.wait_for(writer.drain(), self.request_timeout)
+            finally:
+                writer.close()
+    
+    def _spool(self, payload: bytes, count: int):
+        """Сохранение недоставленного пакета (атомарно: запись и переименование)"""
+        os.makedirs(self.spool_dir, exist_ok=True)
+        spooled = sorted(glob.glob(os.path.join(self.spool_dir, '*.ndjson*')))
+        total = sum(os.path.getsize(path) for path in spooled)
+        while spooled and total + len(payload) > self.spool_max_bytes:
+            oldest = spooled.pop(0)
+            total -= os.path.getsize(oldest)
+            os.remove(oldest)
+            self.stats['spool_dropped'] += 1
+            logging.error(f"SIEM spool is full, dropped {oldest}")
+        
+        suffix = '.ndjson.gz' if self.compression == 'gzip' else '.ndjson'
+        path = os.path.join(self.spool_dir, f"{time.time_ns()}-{count}-{uuid.uuid4().hex[:8]}{suffix}")
+        with open(path + '.tmp', 'wb') as f:
+            f.write(payload)
+        os.replace(path + '.tmp', path)
+        self.stats['spooled_batches'] += 1
+        self.stats['spooled_events'] += count
+        logging.warning(f"SIEM unavailable, {count} events spooled to {path}")
+    
+    async def drain_spool(self):
+        """Досылка сохраненных пакетов в порядке записи; остановка на первой ошибке"""
+        for path in sorted(glob.glob(os.path.join(self.spool_dir, '*.ndjson*'))):
+            if path.endswith('.tmp'):
+                continue
+            with open(path, 'rb') as f:
+                payload = f.read()
+            if self.transport != 'http':
+                data = gzip.decompress(payload) if path.endswith('.gz') else payload
+                payload = data.decode('utf-8').splitlines()
+            elif path.endswith('.gz') != (self.compression == 'gzip'):
+                data = gzip.decompress(payload) if path.endswith('.gz') else payload
+                payload = self._encode(data.decode('utf-8').splitlines())
+            result = await self._send_with_retry(payload)
+            if result is None:
+                self._unavailable = True
+                break
+            os.remove(path)
+            self.stats['spool_replayed' if result == 'sent' else 'spool_rejected'] += 1
+    
+    @staticmethod
+    def capture_events(file_path: str, file_hash: str, stats: Dict):
+        """Сводка по захвату, затем по событию на угрозу и подозрительную активность"""
+        yield {
+            'event_type': 'capture_summary',
+            'file': file_path,
+            'file_hash': file_hash,
+            'total_packets': stats.get('total_packets', 0),
+            'threats': len(stats.get('threats_found', [])),
+            'suspicious_activities': len(stats.get('suspicious_activities', []))
+        }
+        for event_type, key in (('threat', 'threats_found'), ('suspicious_activity', 'suspicious_activities')):
+            for item in stats.get(key, []):
+                yield {'event_type': event_type, 'file_hash': file_hash, **item}
+
+# Конвейер оповещений: группировка, ограничение частоты и дайджесты по одной SMTP сессии
+class AlertPipeline:
+    """Угрозы группируются по (тип, индикатор) в окне alert_window секунд;
+    по окончании окна уходит одно письмо-дайджест. Не больше
+    max_emails_per_hour писем в час: при превышении группы копятся до
+    следующего разрешенного отправления. SMTP соединение открывается один
+    раз и переиспользуется до close(). Без smtp_server и recipients
+    дайджест пишется в лог.
+    Настройки [EMAIL]: smtp_server, smtp_port, use_tls, username, password,
+    sender, recipients (через запятую); [ALERTS]: alert_window,
+    max_emails_per_hour, max_groups_per_digest."""
+    
+    SEVERITY_ORDER = {'LOW': 1, 'MEDIUM': 2, 'HIGH': 3, 'CRITICAL': 4}
+    
+    def __init__(self, config: EnterpriseConfig):
+        self.email_settings = config.get_email_settings()
+        thresholds = config.get_alert_thresholds()
+        self.smtp_server = self.email_settings.get('smtp_server', '')
+        self.smtp_port = int(self.email_settings.get('smtp_port', 587))
+        self.use_tls = self.email_settings.get('use_tls', 'true').lower() in ('1', 'true', 'yes')
+        self.username = self.email_settings.get('username', '')
+        self.password = self.email_settings.get('password', '')
+        self.sender = self.email_settings.get('sender', self.username)
+        self.recipients = [r.strip() for r in self.email_settings.get('recipients', '').split(',') if r.strip()]
+        self.window = float(thresholds.get('alert_window', 300))
+        self.max_emails_per_hour = int(thresholds.get('max_emails_per_hour', 12))
+        self.max_groups_per_digest = int(thresholds.get('max_groups_per_digest', 50))
+        
+        self.groups = {}
+        self.window_started = None
+        self.sent_times = deque()
+        self.stats = Counter()
+        self._smtp = None
+    
+    def add(self, threats: List[Dict], source: str):
+        """Учет угроз; повторяющиеся угрозы только увеличивают счетчик группы"""
+        now = time.time()
+        if self.window_started is None:
+            self.window_started = now
+        for threat in threats:
+            key = (threat.get('type', 'UNKNOWN'), CaptureHistoryStore._threat_indicator(threat))
+            group = self.groups.get(key)
+            if group is None:
+                group = self.groups[key] = {
+                    'type': key[0], 'indicator': key[1], 'count': 0,
+                    'severity': threat.get('severity', 'LOW'), 'sources': set(),
+                    'first_seen': now, 'last_seen': now, 'sample': threat
+                }
+            group['count'] += 1
+            group['last_seen'] = now
+            group['sources'].add(source)
+            severity = threat.get('severity', 'LOW')
+            if self.SEVERITY_ORDER.get(severity, 0) > self.SEVERITY_ORDER.get(group['severity'], 0):
+                group['severity'] = severity
+        self.stats['alerts'] += len(threats)
+    
+    def flush(self, force: bool = False) -> bool:
+        """Отправка дайджеста по окончании окна (или сразу при force)"""
+        if not self.groups:
+            return False
+        now = time.time()
+        if not force and now - self.window_started < self.window:
+            return False
+        
+        while self.sent_times and now - self.sent_times[0] > 3600:
+            self.sent_times.popleft()
+        if len(self.sent_times) >= self.max_emails_per_hour:
+            # Лимит исчерпан: группы продолжают копиться до следующего окна
+            self.stats['rate_limited'] += 1
+            return False
+        
+        subject, body = self._format_digest()
+        if not self._deliver(subject, body):
+            return False
+        self.sent_times.append(now)
+        self.stats['digests'] += 1
+        self.stats['groups_sent'] += len(self.groups)
+        self.groups = {}
+        self.window_started = None
+        return True
+    
+    def close(self):
+        """Последний дайджест без ожидания окна и закрытие SMTP сессии"""
+        if not self.flush(force=True) and self.groups:
+            subject, body = self._format_digest()
+            logging.warning(f"Alert digest not emailed (rate limit or SMTP error): {subject}\n{body}")
+            self.groups = {}
+            self.window_started = None
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except smtplib.SMTPException:
+                pass
+            self._smtp = None
+    
+    def _format_digest(self) -> Tuple[str, str]:
+        groups = sorted(self.groups.values(),
+                        key=lambda g: (-self.SEVERITY_ORDER.get(g['severity'], 0), -g['count']))
+        total = sum(group['count'] for group in groups)
+        subject = f"[Security Alert] {total} threats in {len(groups)} groups"
+        
+        lines = [f"{total} high-severity threats grouped into {len(groups)} groups", ""]
+        for group in groups[:self.max_groups_per_digest]:
+            lines.append(f"[{group['severity']}] {group['type']} {group['indicator'] or ''} x{group['count']}")
+            lines.append(f"    first: {datetime.fromtimestamp(group['first_seen']).isoformat()}"
+                         f"  last: {datetime.fromtimestamp(group['last_seen']).isoformat()}")
+            lines.append(f"    sources: {', '.join(sorted(group['sources'])[:5])}")
+            lines.append(f"    sample: {json.dumps(group['sample'], default=str, ensure_ascii=False)}")
+        if len(groups) > self.max_groups_per_digest:
+            lines.append(f"... and {len(groups) - self.max_groups_per_digest} more groups")
+        return subject, '\n'.join(lines)
+    
+    def _connect(self) -> smtplib.SMTP:
+        smtp = smtplib.SMTP(self.smtp_server, self.smtp_port, timeout=30)
+        if self.use_tls:
+            smtp.starttls()
+        if self.username:
+            smtp.login(self.username, self.password)
+        return smtp
+    
+    def _deliver(self, subject: str, body: str) -> bool:
+        if not (self.smtp_server and self.recipients):
+            logging.warning(f"{subject}\n{body}")
+            return True
+        
+        message = MIMEMultipart()
+        message['Subject'] = subject
+        message['From'] = self.sender
+        message['To'] = ', '.join(self.recipients)
+        message.attach(MIMEText(body, 'plain', 'utf-8'))
+        
+        # Разорванная сессия открывается заново один раз
+        for attempt in range(2):
+            try:
+                if self._smtp is None:
+                    self._smtp = self._connect()
+                    self.stats['smtp_connections'] += 1
+                self._smtp.sendmail(self.sender, self.recipients, message.as_string())
+                return True
+            except (smtplib.SMTPServerDisconnected, ConnectionError) as e:
+                self._smtp = None
+                if attempt:
+                    logging.error(f"Failed to send alert digest: {e}")
+            except (smtplib.SMTPException, OSError) as e:
+                self._smtp = None
+                logging.error(f"Failed to send alert digest: {e}")
+                break
+        self.stats['errors'] += 1
+        return False
+
+# Постоянное хранилище ключей карантина
+class QuarantineKeyring:
+    """Файл ключей (по строке base64 на ключ, первый - активный) с правами 0600.
+    Старые ключи после ротации остаются для расшифровки ранее помещенных файлов.
+    Ключ ищется по key_id - первым 8 байтам SHA-256 ключа из заголовка файла.
+    Создание и ротация выполняются под flock на {key_file}.lock с повторным
+    чтением файла, поэтому параллельные процессы не теряют ключи друг друга."""
+    
+    def __init__(self, key_file: str):
+        self.key_file = key_file
+        self.keys = OrderedDict()
+        with self._locked():
+            if os.path.exists(key_file):
+                self._load()
+            else:
+                self._add_key()
+    
+    @staticmethod
+    def key_id(key: bytes) -> bytes:
+        return hashlib.sha256(key).digest()[:8]
+    
+    @property
+    def active(self) -> Tuple[bytes, bytes]:
+        """(key_id, ключ) для шифрования новых файлов"""
+        return next(iter(self.keys.items()))
+    
+    def get(self, key_id: bytes) -> bytes:
+        if key_id not in self.keys:
+            # Ключ мог появиться после ротации в другом процессе
+            with self._locked():
+                self._load()
+        if key_id not in self.keys:
+            raise KeyError(f"Quarantine key {key_id.hex()} not found in {self.key_file}")
+        return self.keys[key_id]
+    
+    def rotate(self) -> bytes:
+        """Новый активный ключ; возвращает его key_id"""
+        with self._locked():
+            self._load()
+            return self._add_key()
+    
+    @contextlib.contextmanager
+    def _locked(self):
+        directory = os.path.dirname(os.path.abspath(self.key_file))
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        fd = os.open(f"{self.key_file}.lock", os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+    
+    def _add_key(self) -> bytes:
+        key = AESGCM.generate_key(bit_length=256)
+        key_id = self.key_id(key)
+        self.keys[key_id] = key
+        self.keys.move_to_end(key_id, last=False)
+        self._save()
+        return key_id
+    
+    def _load(self):
+        keys = OrderedDict()
+        with open(self.key_file, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    key = base64.b64decode(line)
+                    keys[self.key_id(key)] = key
+        if not keys:
+            raise ValueError(f"Quarantine key file is empty: {self.key_file}")
+        self.keys = keys
+    
+    def _save(self):
+        directory = os.path.dirname(os.path.abspath(self.key_file))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(self.key_file)}.")
+        try:
+            with os.fdopen(fd, 'w') as f:
+                for key in self.keys.values():
+                    f.write(base64.b64encode(key).decode() + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.key_file)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+# Потоковое шифрование AES-256-GCM по блокам
+class ChunkedFileCipher:
+    """Формат: заголовок MAGIC | key_id(8) | salt(16) | chunk_size(4), затем блоки
+    открытого текста по chunk_size байт, каждый зашифрован отдельно с тегом 16 байт.
+    Ключ файла выводится HKDF из ключа хранилища и salt, nonce блока - его номер
+    и признак последнего блока; заголовок входит в AAD каждого блока. Поэтому
+    перестановка, подмена и обрезка блоков обнаруживаются при расшифровке.
+    Память ограничена одним блоком независимо от размера файла."""
+    
+    MAGIC = b'NAQ\x01'
+    HEADER = struct.Struct('>4s8s16sI')
+    NONCE = struct.Struct('>QI')
+    TAG_SIZE = 16
+    
+    def __init__(self, keyring: QuarantineKeyring, chunk_size: int = 1024 * 1024):
+        self.keyring = keyring
+        self.chunk_size = chunk_size
+    
+    @staticmethod
+    def _file_cipher(key: bytes, salt: bytes) -> AESGCM:
+        hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=salt, info=b'quarantine-file')
+        return AESGCM(hkdf.derive(key))
+    
+    @classmethod
+    def is_encrypted(cls, path: str) -> bool:
+        with open(path, 'rb') as f:
+            return f.read(len(cls.MAGIC)) == cls.MAGIC
+    
+    def encrypt_stream(self, src, dst) -> Tuple[int, str]:
+        """Шифрование потока src в dst; возвращает (размер, SHA-256 открытого текста)"""
+        key_id, key = self.keyring.active
+        salt = os.urandom(16)
+        header = self.HEADER.pack(self.MAGIC, key_id, salt, self.chunk_size)
+        cipher = self._file_cipher(key, salt)
+        digest = hashlib.sha256()
+        dst.write(header)
+        
+        size = 0
+        index = 0
+        chunk = src.read(self.chunk_size)
+        while True:
+            # Чтение на блок вперед: последний блок помечается в nonce
+            following = src.read(self.chunk_size) if len(chunk) == self.chunk_size else b''
+            last = not following
+            digest.update(chunk)
+            size += len(chunk)
+            dst.write(cipher.encrypt(self.NONCE.pack(index, last), chunk, header))
+            if last:
+                return size, digest.hexdigest()
+            chunk = following
+            index += 1
+    
+    def decrypt_stream(self, src, dst) -> Tuple[int, str]:
+        """Расшифровка с проверкой каждого блока; ValueError при повреждении"""
+        header = src.read(self.HEADER.size)
+        if len(header) != self.HEADER.size:
+            raise ValueError("Truncated quarantine header")
+        magic, key_id, salt, chunk_size = self.HEADER.unpack(header)
+        if magic != self.MAGIC:
+            raise ValueError("Not a chunked quarantine file")
+        cipher = self._file_cipher(self.keyring.get(key_id), salt)
+        digest = hashlib.sha256()
+        block_size = chunk_size + self.TAG_SIZE
+        
+        size = 0
+        index = 0
+        block = src.read(block_size)
+        while True:
+            following = src.read(block_size) if len(block) == block_size else b''
+            last = not following
+            try:
+                chunk = cipher.decrypt(self.NONCE.pack(index, last), block, header)
+            except InvalidTag:
+                raise ValueError(f"Quarantine file is corrupted or truncated (block {index})")
+            digest.update(chunk)
+            size += len(chunk)
+            dst.write(chunk)
+            if last:
+                return size, digest.hexdigest()
+            block = following
+            index += 1
+
+# Рабочие функции карантина (верхний уровень - для пула процессов)
+def _hash_quarantine_file(file_path: str, chunk_size: int = 1024 * 1024) -> Tuple[str, int]:
+    """SHA-256 и размер файла потоковым чтением"""
+    digest = hashlib.sha256()
+    size = 0
+    with open(file_path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return digest.hexdigest(), size
+            digest.update(chunk)
+            size += len(chunk)
+
+def _encrypt_quarantine_blob(file_path: str, blob_path: str, sha256: str, key_file: str,
+                             chunk_size: int, cipher: Optional[ChunkedFileCipher] = None) -> int:
+    """Шифрование файла в blob; возвращает размер blob на диске.
+    В пуле процессов ключи читаются из key_file, в потоках передается cipher."""
+    cipher = cipher or ChunkedFileCipher(QuarantineKeyring(key_file), chunk_size)
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+    # Уникальное имя: одинаковое содержимое могут писать несколько воркеров
+    tmp_path = f"{blob_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(file_path, 'rb') as src, open(tmp_path, 'wb') as dst:
+            _, encrypted_sha256 = cipher.encrypt_stream(src, dst)
+            dst.flush()
+            os.fsync(dst.fileno())
+        if encrypted_sha256 != sha256:
+            raise ValueError(f"File changed during quarantine: {file_path}")
+        os.replace(tmp_path, blob_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return os.path.getsize(blob_path)
 
 # Система карантина для подозрительных файлов
 class QuarantineSystem:
+    """Хранилище с адресацией по содержимому: зашифрованный blob хранится один
+    раз на уникальный SHA-256 (blobs/ab/<sha256>.blob), а каждое помещение в
+    карантин - отдельная строка instances в quarantine.db со своим путем,
+    причиной и метаданными. Настройки [QUARANTINE]: quarantine_directory,
+    key_file (по умолчанию .keys/keyring в каталоге карантина; лучше хранить
+    отдельно от данных), chunk_size_kb - размер блока шифрования,
+    batch_workers - размер пула для quarantine_batch."""
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS blobs (
+            sha256 TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            stored_size INTEGER NOT NULL,
+            created TEXT NOT NULL
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS instances (
+            quarantine_id TEXT PRIMARY KEY,
+            sha256 TEXT NOT NULL REFERENCES blobs(sha256),
+            original_path TEXT NOT NULL,
+            reason TEXT,
+            metadata TEXT,
+            quarantine_date TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_instances_sha256 ON instances(sha256);
+    """
+    
     def __init__(self, config: EnterpriseConfig):
         self.config = config
         self.quarantine_settings = config.get_quarantine_settings()
         self.quarantine_dir = self.quarantine_settings.get('quarantine_directory', '/tmp/quarantine')
-        self.encryption_key = Fernet.generate_key()
-        self.cipher_suite = Fernet(self.encryption_key)
+        self.key_file = self.quarantine_settings.get('key_file',
+                                                     os.path.join(self.quarantine_dir, '.keys', 'keyring'))
+        self.chunk_size = int(self.quarantine_settings.get('chunk_size_kb', 1024)) * 1024
+        self.batch_workers = int(self.quarantine_settings.get('batch_workers', multiprocessing.cpu_count()))
+        self.blob_dir = os.path.join(self.quarantine_dir, 'blobs')
+        self._cipher = None
+        self._db = None
         
         # Создание карантинной директории
         os.makedirs(self.quarantine_dir, exist_ok=True)
     
+    @property
+    def cipher(self) -> ChunkedFileCipher:
+        # Ключи читаются (или создаются) при первом обращении к карантину
+        if self._cipher is None:
+            self._cipher = ChunkedFileCipher(QuarantineKeyring(self.key_file), self.chunk_size)
+        return self._cipher
+    
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(os.path.join(self.quarantine_dir, 'quarantine.db'))
+            self._db.row_factory = sqlite3.Row
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript(self.SCHEMA)
+        return self._db
+    
+    def blob_path(self, sha256: str) -> str:
+        return os.path.join(self.blob_dir, sha256[:2], f"{sha256}.blob")
+    
+    def _needs_blob(self, sha256: str) -> bool:
+        return not os.path.exists(self.blob_path(sha256))
+    
+    def _record(self, entries: List[Tuple[str, str, int, Optional[int]]], reason: str,
+                metadata: Dict[str, Dict]) -> Dict[str, str]:
+        """Строки blobs и instances одной транзакцией; entries - (путь, sha256, размер,
+        размер нового blob или None); возвращает путь -> quarantine_id"""
+        now = datetime.now().isoformat()
+        ids = {path: uuid.uuid4().hex[:16] for path, _, _, _ in entries}
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO blobs (sha256, size, stored_size, created) VALUES (?, ?, ?, ?)",
+                [(sha256, size, stored, now) for _, sha256, size, stored in entries if stored is not None])
+            # Blob мог остаться без строки после сбоя между шифрованием и записью
+            self.db.executemany(
+                "INSERT OR IGNORE INTO blobs (sha256, size, stored_size, created) VALUES (?, ?, ?, ?)",
+                [(sha256, size, os.path.getsize(self.blob_path(sha256)), now)
+                 for _, sha256, size, stored in entries if stored is None])
+            self.db.executemany(
+                """INSERT INTO instances (quarantine_id, sha256, original_path, reason, metadata, quarantine_date)
+                   VALUES (?, ?, ?, ?, ?, ?)""",
+                [(ids[path], sha256, path, reason, json.dumps(metadata.get(path, {}), default=str), now)
+                 for path, sha256, _, _ in entries])
+        return ids
+    
     def quarantine_file(self, file_path: str, reason: str, metadata: Dict):
-        """Помещение файла в карантин с шифрованием"""
+        """Помещение файла в карантин; повторное содержимое не шифруется заново"""
         try:
-            # Чтение и шифрование файла
-            with open(file_path, 'rb') as f:
-                file_data = f.read()
-            
-            encrypted_data = self.cipher_suite.encrypt(file_data)
-            
-            # Создание метаданных карантина
-            quarantine_id = hashlib.sha256(f"{file_path}{datetime.now()}".encode()).hexdigest()[:16]
-            quarantine_file = os.path.join(self.quarantine_dir, f"{quarantine_id}.quarantine")
-            
-            quarantine_meta = {
-                'original_path': file_path,
-                'quarantine_date': datetime.now().isoformat(),
-                'reason': reason,
-                'original_size': len(file_data),
-                'metadata': metadata,
-                'quarantine_id': quarantine_id
-            }
-            
-            # Сохранение зашифрованного файла и метаданных
-            with open(quarantine_file, 'wb') as f:
-                f.write(encrypted_data)
-            
-            meta_file = os.path.join(self.quarantine_dir, f"{quarantine_id}.meta")
-            with open(meta_file, 'w') as f:
-                json.dump(quarantine_meta, f, indent=2)
+            sha256, size = _hash_quarantine_file(file_path, self.chunk_size)
+            stored = None
+            if self._needs_blob(sha256):
+                stored = _encrypt_quarantine_blob(file_path, self.blob_path(sha256), sha256,
+                                                  self.key_file, self.chunk_size, self.cipher)
+            quarantine_id = self._record([(file_path, sha256, size, stored)], reason,
+                                         {file_path: metadata})[file_path]
             
             # Удаление оригинального файла
             os.remove(file_path)
             
-            logging.info(f"File quarantined: {file_path} -> {quarantine_id}")
+            logging.info(f"File quarantined: {file_path} -> {quarantine_id} ({sha256[:12]}"
+                         f"{', deduplicated' if stored is None else ''})")
             return quarantine_id
             
         except Exception as e:
             logging.error(f"Quarantine failed: {e}")
             return None
-
-# Анализатор поведения сети (Behavioral Analysis)
-class BehavioralAnalyzer:
-    def __init__(self):
-        self.baseline_established = False
-        self.network_baseline = {}
+    
+    def quarantine_batch(self, file_paths: List[str], reason: str,
+                         metadata: Optional[Dict[str, Dict]] = None,
+                         workers: Optional[int] = None,
+                         use_processes: bool = False) -> Dict[str, Optional[str]]:
+        """Пакетный карантин: хеши всех файлов в пуле, затем шифрование только
+        новых уникальных blob (один файл на хеш), затем запись строк одной
+        транзакцией. Возвращает путь -> quarantine_id (None при ошибке)."""
+        metadata = metadata or {}
+        results = {path: None for path in file_paths}
+        executor = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+        # Ключи создаются до запуска воркеров: процессы читают их из key_file
+        cipher = self.cipher
         
-    def establish_baseline(self, packets: List, window_size: int = 1000):
-        """Установка базового профиля сетевого поведения"""
-        if len(packets) < window_size:
-            return
+        with executor(max_workers=workers or self.batch_workers) as pool:
+            # Этап 1: хеширование
+            hash_futures = {path: pool.submit(_hash_quarantine_file, path, self.chunk_size)
+                            for path in results}
+            hashes = {}
+            for path, future in hash_futures.items():
+                try:
+                    hashes[path] = future.result()
+                except OSError as e:
+                    logging.error(f"Quarantine failed for {path}: {e}")
             
-        protocols = []
-        packet_sizes = []
-        time_deltas = []
+            # Этап 2: шифрование одного представителя на каждое новое содержимое
+            representatives = {}
+            for path, (sha256, _) in hashes.items():
+                if sha256 not in representatives and self._needs_blob(sha256):
+                    representatives[sha256] = path
+            blob_futures = {sha256: pool.submit(_encrypt_quarantine_blob, path, self.blob_path(sha256),
+                                                sha256, self.key_file, self.chunk_size,
+                                                None if use_processes else cipher)
+                            for sha256, path in representatives.items()}
+            stored_sizes = {}
+            for sha256, future in blob_futures.items():
+                try:
+                    stored_sizes[sha256] = future.result()
+                except Exception as e:
+                    logging.error(f"Quarantine failed for {representatives[sha256]}: {e}")
         
-        for i, packet in enumerate(packets[:window_size]):
-            protocols.append(packet.highest_layer)
-            if hasattr(packet, 'length'):
-                packet_sizes.append(int(packet.length))
-            
-            if i > 0 and hasattr(packet, 'sniff_time'):
-                prev_time = packets[i-1].sniff_time
-                curr_time = packet.sniff_time
-                delta = (curr_time - prev_time).total_seconds()
-                time_deltas.append(delta)
+        # Этап 3: строки метаданных; новый blob учитывается у первого экземпляра
+        failed = set(representatives) - set(stored_sizes)
+        entries = []
+        for path, (sha256, size) in hashes.items():
+            if sha256 not in failed:
+                entries.append((path, sha256, size, stored_sizes.pop(sha256, None)))
+        if not entries:
+            return results
+        try:
+            results.update(self._record(entries, reason, metadata))
+        except sqlite3.Error as e:
+            logging.error(f"Quarantine batch metadata failed: {e}")
+            return results
         
-        self.network_baseline = {
-            'protocol_distribution': dict(Counter(protocols)),
-            'avg_packet_size': statistics.mean(packet_sizes) if packet_sizes else 0,
-            'std_packet_size': statistics.stdev(packet_sizes) if len(packet_sizes) > 1 else 0,
-            'avg_time_delta': statistics.mean(time_deltas) if time_deltas else 0,
-            'std_time_delta': statistics.stdev(time_deltas) if len(time_deltas) > 1 else 0
+        for path, _, _, _ in entries:
+            try:
+                os.remove(path)
+            except OSError as e:
+                logging.error(f"Failed to remove quarantined original {path}: {e}")
+        logging.info(f"Batch quarantined {len(entries)}/{len(file_paths)} files, "
+                     f"{len(representatives)} new blobs")
+        return results
+    
+    def storage_stats(self) -> Dict:
+        """Экземпляры, уникальные blob и экономия места от дедупликации"""
+        instances, logical = self.db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(b.size), 0) FROM instances i JOIN blobs b ON b.sha256 = i.sha256"
+        ).fetchone()
+        blobs, unique, stored = self.db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(stored_size), 0) FROM blobs"
+        ).fetchone()
+        return {
+            'instances': instances,
+            'unique_blobs': blobs,
+            'logical_bytes': logical,
+            'unique_bytes': unique,
+            'stored_bytes': stored,
+            'deduplicated_bytes': logical - unique
         }
-        self.baseline_established = True
-        
-    def detect_anomalies(self, packets: List) -> List[Dict]:
-        """Обнаружение аномалий на основе базового профиля"""
-        if not self.baseline_established:
-            return []
-            
-        anomalies = []
-        
-        # Анализ последних пакетов
-        recent_packets = packets[-500:]  # Последние 500 пакетов
-        recent_sizes = [int(p.length) for p in recent_packets if hasattr(p, 'length')]
-        
-        if recent_sizes:
-            avg_recent_size = statistics.mean(recent_sizes)
-            baseline_avg = self.network_baseline['avg_packet_size']
-            baseline_std = self.network_baseline['std_packet_size']
-            
-            # Обнаружение аномального размера пакетов
-            if abs(avg_recent_size - baseline_avg) > 2 * baseline_std:
-                anomalies.append({
-                    'type': 'SIZE_ANOMALY',
-                    'severity': 'MEDIUM',
-                    'description': f'Average packet size anomaly: {avg_recent_size:.2f} vs baseline {baseline_avg:.2f}',
-                    'deviation': abs(avg_recent_size - baseline_avg) / baseline_std
-                })
-        
-        return anomalies
-
-# Расширенный анализатор угроз с интеграцией VirusTotal
+    
+    def delete(self, quarantine_id: str) -> bool:
+        """Удаление экземпляра; blob удаляется вместе с последней ссылкой"""
+        row = self.db.execute("SELECT sha256 FROM instances WHERE quarantine_id = ?",
+                              (quarantine_id,)).fetchone()
+        if row is None:
+            return False
+        sha256 = row['sha256']
+        with self.db:
+            self.db.execute("DELETE FROM instances WHERE quarantine_id = ?", (quarantine_id,))
+            orphaned = self.db.execute("SELECT 1 FROM instances WHERE sha256 = ? LIMIT 1",
+                                       (sha256,)).fetchone() is None
+            if orphaned:
+                self.db.execute("DELETE FROM blobs WHERE sha256 = ?", (sha256,))
+        if orphaned and os.path.exists(self.blob_path(sha256)):
+            os.remove(self.blob_path(sha256))
+        return True
+    
+    def restore_file(self, quarantine_id: str, destination: str) -> bool:
+        """Расшифровка файла из карантина с проверкой целостности и SHA-256"""
+        tmp_path = f"{destination}.restore"
+        try:
+            row = self.db.execute("SELECT sha256 FROM instances WHERE quarantine_id = ?",
+                                  (quarantine_id,)).fetchone()
+            if row is not None:
+                source, expected = self.blob_path(row['sha256']), row['sha256']
+            else:
+                # Файлы, помещенные до хранилища по содержимому: <id>.quarantine и <id>.meta
+                source = os.path.join(self.quarantine_dir, f"{quarantine_id}.quarantine")
+                with open(os.path.join(self.quarantine_dir, f"{quarantine_id}.meta"), 'r') as f:
+                    expected = json.load(f).get('sha256')
+                if not ChunkedFileCipher.is_encrypted(source):
+                    # Файлы формата Fernet шифровались ключом, который не сохранялся
+                    raise ValueError("legacy quarantine file, encryption key was not persisted")
+            with open(source, 'rb') as src, open(tmp_path, 'wb') as dst:
+                _, sha256 = self.cipher.decrypt_stream(src, dst)
+            if expected and expected != sha256:
+                raise ValueError("SHA-256 mismatch after decryption")
+            os.replace(tmp_path, destination)
+            logging.info(f"File restored from quarantine: {quarantine_id} -> {destination}")
+            return True
+        except Exception as e:
+            logging.error(f"Restore failed for {quarantine_id}: {e}")
+            return False
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+def is_dns_query(packet) -> bool:
+    """DNS запрос (бит QR = 0). Ответы повторяют qry_name запроса и не
+    должны учитываться второй раз; без поля QR запросом считается пакет
+    на порт 53."""
+    if 'DNS' not in packet or not hasattr(packet.dns, 'qry_name'):
+        return False
+    response = getattr(packet.dns, 'flags_response', None)
+    if response is not None:
+        return str(response) in ('0', 'False')
+    transport = packet.tcp if 'TCP' in packet else packet.udp if 'UDP' in packet else None
+    return transport is not None and int(transport.dstport) == 53
+
+# Легковесная запись пакета для нативного бэкенда.
+# Повторяет ту часть интерфейса pyshark, которую использует анализатор:
+# 'IP' in packet, packet.ip.src, packet.tcp.dstport, packet.dns.qry_name,
+# packet.dns.flags_response, packet.length, packet.sniff_time и packet.highest_layer
+class PacketRecord:
+    __slots__ = ('layers', 'highest_layer', 'transport_layer', 'length',
+                 'sniff_timestamp', 'src', 'dst', 'srcport', 'dstport',
+                 'flags', 'qry_name', 'flags_response')
+
+    def __contains__(self, layer: str) -> bool:
+        return layer.upper() in self.layers
+
+    # Слои возвращают саму запись: поля хранятся плоско, без лишних объектов
+    @property
+    def ip(self):
+        return self
+
+    ipv6 = tcp = udp = dns = ip
+
+    @property
+    def sniff_time(self) -> datetime:
+        return datetime.fromtimestamp(self.sniff_timestamp)
+
+_U16 = struct.Struct('!H')
+_U32 = struct.Struct('!I')
+_PORTS = struct.Struct('!HH')
+
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+LINKTYPE_LINUX_SLL2 = 276
+
+def _decode_dns_name(buf, offset: int, end: int) -> Optional[str]:
+    """Имя из секции вопросов DNS (без распаковки сжатых ссылок)"""
+    labels = []
+    while offset < end:
+        size = buf[offset]
+        if size == 0:
+            return '.'.join(labels) if labels else '<Root>'
+        if size & 0xC0 or offset + 1 + size > end:
+            return None
+        labels.append(str(buf[offset + 1:offset + 1 + size], 'ascii', 'replace'))
+        offset += 1 + size
+    return None
+
+def decode_frame(buf, offset: int, caplen: int, orig_len: int,
+                 linktype: int, timestamp: float) -> PacketRecord:
+    """Разбор Ethernet/IPv4/IPv6/TCP/UDP/DNS заголовков прямо из буфера.
+    highest_layer - последний разобранный здесь слой (TCP, UDP, DNS, ARP...),
+    а не последний диссектор Wireshark: где pyshark дает TLS, HTTP или DATA,
+    нативный бэкенд дает TCP/UDP, поэтому распределения протоколов
+    бэкендов различаются. Заголовок IPv4 с IHL < 5 считается битым: у записи
+    нет слоев IP и выше."""
+    record = PacketRecord()
+    record.length = orig_len
+    record.sniff_timestamp = timestamp
+    end = offset + caplen
+    layers = []
+    ethertype = None
+
+    # Канальный уровень
+    if linktype == LINKTYPE_ETHERNET:
+        if caplen >= 14:
+            layers.append('ETH')
+            ethertype = _U16.unpack_from(buf, offset + 12)[0]
+            offset += 14
+            while ethertype in (0x8100, 0x88A8) and offset + 4 <= end:
+                layers.append('VLAN')
+                ethertype = _U16.unpack_from(buf, offset + 2)[0]
+                offset += 4
+    elif linktype == LINKTYPE_LINUX_SLL:
+        if caplen >= 16:
+            layers.append('SLL')
+            ethertype = _U16.unpack_from(buf, offset + 14)[0]
+            offset += 16
+    elif linktype == LINKTYPE_LINUX_SLL2:
+        if caplen >= 20:
+            layers.append('SLL')
+            ethertype = _U16.unpack_from(buf, offset)[0]
+            offset += 20
+    elif linktype == LINKTYPE_NULL:
+        if caplen >= 4:
+            layers.append('NULL')
+            family = struct.unpack_from('=I', buf, offset)[0]
+            if family > 0xFFFF:
+                family = struct.unpack_from('>I', buf, offset)[0]
+            ethertype = 0x0800 if family == 2 else 0x86DD if family in (10, 24, 28, 30) else None
+            offset += 4
+    elif linktype in (LINKTYPE_RAW, 12, LINKTYPE_IPV4, LINKTYPE_IPV6):
+        if caplen >= 1:
+            version = buf[offset] >> 4
+            ethertype = 0x0800 if version == 4 else 0x86DD if version == 6 else None
+
+    # Сетевой уровень
+    proto = None
+    if ethertype == 0x0800 and offset + 20 <= end and buf[offset] & 0x0F >= 5:
+        ihl = (buf[offset] & 0x0F) * 4
+        layers.append('IP')
+        record.src = socket.inet_ntoa(buf[offset + 12:offset + 16])
+        record.dst = socket.inet_ntoa(buf[offset + 16:offset + 20])
+        # Транспортный заголовок есть только в первом фрагменте
+        if not _U16.unpack_from(buf, offset + 6)[0] & 0x1FFF:
+            proto = buf[offset + 9]
+        offset += ihl
+    elif ethertype == 0x86DD and offset + 40 <= end:
+        layers.append('IPV6')
+        record.src = socket.inet_ntop(socket.AF_INET6, buf[offset + 8:offset + 24])
+        record.dst = socket.inet_ntop(socket.AF_INET6, buf[offset + 24:offset + 40])
+        proto = buf[offset + 6]
+        offset += 40
+        # Пропуск заголовков расширения IPv6
+        while proto in (0, 43, 60) and offset + 8 <= end:
+            proto, ext_len = buf[offset], (buf[offset + 1] + 1) * 8
+            offset += ext_len
+        if proto == 44 and offset + 8 <= end:
+            proto = buf[offset] if not _U16.unpack_from(buf, offset + 2)[0] & 0xFFF8 else None
+            offset += 8
+    elif ethertype == 0x0806:
+        layers.append('ARP')
+
+    # Транспортный уровень и DNS
+    payload = None
+    if proto == 6 and offset + 20 <= end:
+        layers.append('TCP')
+        record.transport_layer = 'TCP'
+        record.srcport, record.dstport = _PORTS.unpack_from(buf, offset)
+        record.flags = buf[offset + 13]
+        # DNS поверх TCP начинается с двухбайтового поля длины
+        payload = offset + (buf[offset + 12] >> 4) * 4 + 2
+    elif proto == 17 and offset + 8 <= end:
+        layers.append('UDP')
+        record.transport_layer = 'UDP'
+        record.srcport, record.dstport = _PORTS.unpack_from(buf, offset)
+        payload = offset + 8
+
+    if payload is not None and (record.srcport == 53 or record.dstport == 53) \
+            and payload + 12 < end and _U16.unpack_from(buf, payload + 4)[0]:
+        name = _decode_dns_name(buf, payload + 12, end)
+        if name is not None:
+            layers.append('DNS')
+            record.qry_name = name
+            record.flags_response = buf[payload + 2] >> 7
+
+    record.layers = layers
+    record.highest_layer = layers[-1] if layers else 'UNKNOWN'
+    return record
+
+# Нативный читатель pcap/pcapng через mmap (без tshark)
+class NativePcapReader:
+    PCAP_MAGICS = {
+        b'\xd4\xc3\xb2\xa1': ('<', 1e6), b'\xa1\xb2\xc3\xd4': ('>', 1e6),
+        b'\x4d\x3c\xb2\xa1': ('<', 1e9), b'\xa1\xb2\x3c\x4d': ('>', 1e9)
+    }
+    PCAPNG_MAGIC = b'\x0a\x0d\x0d\x0a'
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self._file = open(file_path, 'rb')
+        try:
+            self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise ValueError(f"Empty capture file: {file_path}")
+
+        magic = self._mm[:4]
+        if magic in self.PCAP_MAGICS:
+            self.format = 'pcap'
+            self.endian, self.ts_divisor = self.PCAP_MAGICS[magic]
+            self.linktype = struct.unpack_from(self.endian + 'I', self._mm, 20)[0] & 0x0FFFFFFF
+            self.data_offset = 24
+        elif magic == self.PCAPNG_MAGIC:
+            self.format = 'pcapng'
+            self.endian = '<' if self._mm[8:12] == b'\x4d\x3c\x2b\x1a' else '>'
+            self.interfaces = []  # (linktype, делитель метки времени)
+            self.data_offset = 0
+        else:
+            self.close()
+            raise ValueError(f"Unsupported capture format: {file_path}")
+        self.position = self.data_offset
+
+    def __iter__(self):
+        if self.format == 'pcap':
+            return self._iter_pcap(self.data_offset, len(self._mm))
+        return self._iter_pcapng(self.data_offset, len(self._mm))
+
+    def iter_range(self, start: int, end: int, section: Optional[Tuple] = None):
+        """Пакеты из диапазона байт [start, end), выровненного по границам записей"""
+        if self.format == 'pcap':
+            return self._iter_pcap(start, end)
+        if section is not None:
+            self.endian, interfaces = section
+            self.interfaces = list(interfaces)
+        return self._iter_pcapng(start, end)
+
+    def iter_from(self, offset: int, section: Optional[Tuple] = None):
+        """Продолжение чтения с сохраненной позиции до текущего конца файла"""
+        self.position = max(offset, self.data_offset)
+        return self.iter_range(self.position, len(self._mm), section)
+
+    def section_state(self) -> Optional[Tuple]:
+        """Порядок байт и таблица интерфейсов pcapng на текущей позиции"""
+        return (self.endian, list(self.interfaces)) if self.format == 'pcapng' else None
+
+    def split(self, parts: int, max_packets: int = 0) -> List[Dict]:
+        """Разбиение на шарды по границам записей/блоков без перезаписи файла.
+        Шард i начинается с первой записи не раньше байта total*i/parts;
+        хранятся только границы шардов. Для pcapng в каждый шард передается
+        порядок байт и таблица интерфейсов текущей секции."""
+        shards, packets = self._cut(parts)
+        # Число пакетов известно только после прохода по заголовкам
+        if max_packets and -(-packets // max_packets) > parts:
+            shards, packets = self._cut(-(-packets // max_packets))
+        return shards
+
+    def _cut(self, parts: int) -> Tuple[List[Dict], int]:
+        """Один проход по заголовкам с отметкой первой записи после каждой цели"""
+        total = len(self._mm)
+        parts = max(1, parts)
+        shards = []
+        packets = 0
+        for offset, section in self._record_starts():
+            if len(shards) < parts and offset >= total * len(shards) // parts:
+                if shards:
+                    shards[-1]['end'] = offset
+                shards.append({'start': offset, 'end': total, 'section': section, 'packets': 0})
+            shards[-1]['packets'] += 1
+            packets += 1
+        return shards, packets
+
+    def _record_starts(self):
+        """Начала записей с пакетами и состояние секции pcapng; читаются только заголовки"""
+        mm = self._mm
+        total = len(mm)
+        if self.format == 'pcap':
+            length = struct.Struct(self.endian + 'I')
+            offset = self.data_offset
+            while offset + 16 <= total:
+                yield offset, None
+                offset += 16 + length.unpack_from(mm, offset + 8)[0]
+            return
+
+        section = (self.endian, [])
+        offset = 0
+        while offset + 12 <= total:
+            endian = section[0]
+            block_type, block_len = struct.unpack_from(endian + 'II', mm, offset)
+            if block_type == 0x0A0D0D0A:
+                endian = '<' if mm[offset + 8:offset + 12] == b'\x4d\x3c\x2b\x1a' else '>'
+                block_len = struct.unpack_from(endian + 'I', mm, offset + 4)[0]
+                section = (endian, [])
+            elif block_type == 0x00000001:
+                idb = self._parse_idb(offset + 8, offset + block_len - 4, endian)
+                section = (endian, section[1] + [idb])
+            elif block_type in (0x00000002, 0x00000003, 0x00000006):
+                yield offset, section
+            if block_len < 12:
+                break
+            offset += block_len
+
+    def close(self):
+        if not self._mm.closed:
+            self._mm.close()
+        self._file.close()
+
+    def _iter_pcap(self, offset: int, end: int):
+        mm = self._mm
+        header = struct.Struct(self.endian + 'IIII')
+        linktype, divisor = self.linktype, self.ts_divisor
+
+        while offset + 16 <= end:
+            ts_sec, ts_frac, caplen, orig_len = header.unpack_from(mm, offset)
+            if offset + 16 + caplen > end:
+                break  # Обрезанная последняя запись (файл еще пишется)
+            # Пока пакет обрабатывается, позиция указывает на его начало:
+            # после сбоя обработки чтение продолжится с него же
+            self.position = offset
+            yield decode_frame(mm, offset + 16, caplen, orig_len, linktype, ts_sec + ts_frac / divisor)
+            offset += 16 + caplen
+        self.position = offset
+
+    def _iter_pcapng(self, offset: int, end: int):
+        mm = self._mm
+        endian = self.endian
+        block_header = struct.Struct(endian + 'II')
+        epb_header = struct.Struct(endian + 'IIIII')
+
+        while offset + 12 <= end:
+            block_type, block_len = block_header.unpack_from(mm, offset)
+            if block_type == 0x0A0D0D0A:  # Section Header Block
+                self.endian = endian = '<' if mm[offset + 8:offset + 12] == b'\x4d\x3c\x2b\x1a' else '>'
+                block_header = struct.Struct(endian + 'II')
+                epb_header = struct.Struct(endian + 'IIIII')
+                block_len = block_header.unpack_from(mm, offset)[1]
+                self.interfaces = []
+            if block_len < 12 or offset + block_len > end:
+                break
+            body = offset + 8
+            # Пока пакет обрабатывается, позиция указывает на начало его блока
+            self.position = offset
+
+            # Пакет без описанного интерфейса (битый файл) пропускается
+            if block_type == 0x00000006:  # Enhanced Packet Block
+                iface, ts_high, ts_low, caplen, orig_len = epb_header.unpack_from(mm, body)
+                if iface < len(self.interfaces):
+                    linktype, divisor = self.interfaces[iface]
+                    yield decode_frame(mm, body + 20, caplen, orig_len, linktype,
+                                       ((ts_high << 32) | ts_low) / divisor)
+                else:
+                    self._unknown_interface(offset, iface)
+            elif block_type == 0x00000003:  # Simple Packet Block
+                if self.interfaces:
+                    orig_len = struct.unpack_from(endian + 'I', mm, body)[0]
+                    linktype = self.interfaces[0][0]
+                    caplen = min(orig_len, block_len - 16)
+                    yield decode_frame(mm, body + 4, caplen, orig_len, linktype, 0.0)
+                else:
+                    self._unknown_interface(offset, 0)
+            elif block_type == 0x00000002:  # Obsolete Packet Block
+                iface, _, ts_high, ts_low, caplen, orig_len = struct.unpack_from(endian + 'HHIIII', mm, body)
+                if iface < len(self.interfaces):
+                    linktype, divisor = self.interfaces[iface]
+                    yield decode_frame(mm, body + 20, caplen, orig_len, linktype,
+                                       ((ts_high << 32) | ts_low) / divisor)
+                else:
+                    self._unknown_interface(offset, iface)
+            elif block_type == 0x00000001:  # Interface Description Block
+                self.interfaces.append(self._parse_idb(body, offset + block_len - 4))
+
+            offset += block_len
+        self.position = offset
+
+    def _unknown_interface(self, offset: int, iface: int):
+        logging.warning(f"{self.file_path}: packet block at offset {offset} refers to "
+                        f"undeclared interface {iface}, skipped")
+
+    def _parse_idb(self, body: int, end: int, endian: Optional[str] = None) -> Tuple[int, float]:
+        """Тип канального уровня и разрешение меток времени (if_tsresol)"""
+        endian = endian or self.endian
+        linktype = struct.unpack_from(endian + 'H', self._mm, body)[0]
+        divisor = 1e6
+        offset = body + 8
+        while offset + 4 <= end:
+            code, length = struct.unpack_from(endian + 'HH', self._mm, offset)
+            if code == 0:
+                break
+            if code == 9 and length >= 1:
+                resol = self._mm[offset + 4]
+                divisor = float(2 ** (resol & 0x7F)) if resol & 0x80 else float(10 ** resol)
+            offset += 4 + ((length + 3) & ~3)
+        return linktype, divisor
+
+# Чтение захвата через tshark -T fields: диссекторы Wireshark без объектов pyshark
+class TsharkFieldReader:
+    """tshark выводит по строке TSV на пакет только с нужными полями;
+    строки разбираются в PacketRecord. Для вложенных заголовков (туннели)
+    берется последнее вхождение поля - внутренний пакет. stderr пишется
+    во временный файл: непрочитанный канал stderr заполнился бы
+    предупреждениями tshark и остановил бы его вывод."""
+    
+    STDERR_TAIL = 1024
+    
+    FIELDS = ('frame.time_epoch', 'frame.len', 'frame.protocols',
+              'ip.src', 'ip.dst', 'ipv6.src', 'ipv6.dst',
+              'tcp.srcport', 'tcp.dstport', 'tcp.flags',
+              'udp.srcport', 'udp.dstport', 'dns.qry.name', 'dns.flags.response')
+    
+    def __init__(self, file_path: str, tshark_path: Optional[str] = None,
+                 display_filter: Optional[str] = None):
+        self.file_path = file_path
+        self.tshark_path = tshark_path or shutil.which('tshark')
+        if not self.tshark_path:
+            raise ValueError("tshark not found in PATH")
+        if not os.path.exists(file_path):
+            raise ValueError(f"Capture file not found: {file_path}")
+        
+        command = [self.tshark_path, '-n', '-r', file_path, '-T', 'fields',
+                   '-E', 'separator=/t', '-E', 'occurrence=l', '-E', 'quote=n']
+        if display_filter:
+            command += ['-Y', display_filter]
+        for field in self.FIELDS:
+            command += ['-e', field]
+        self._stderr = tempfile.TemporaryFile()
+        self._process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=self._stderr,
+                                         bufsize=1 << 20)
+        self.packets = 0
+    
+    def __iter__(self):
+        stdout = self._process.stdout
+        for line in stdout:
+            record = self._parse(line.decode('utf-8', 'replace').rstrip('\n').split('\t'))
+            if record is not None:
+                self.packets += 1
+                yield record
+        
+        if self._process.wait() != 0:
+            logging.error(f"tshark failed on {self.file_path}: {self._stderr_tail()}")
+    
+    def _stderr_tail(self) -> str:
+        self._stderr.seek(0, os.SEEK_END)
+        self._stderr.seek(max(0, self._stderr.tell() - self.STDERR_TAIL))
+        return self._stderr.read().decode('utf-8', 'replace').strip()
+    
+    @staticmethod
+    def _parse(values: List[str]) -> Optional[PacketRecord]:
+        if len(values) < 14:
+            return None
+        (epoch, length, protocols, ip_src, ip_dst, ipv6_src, ipv6_dst,
+         tcp_src, tcp_dst, tcp_flags, udp_src, udp_dst, qry_name, response) = values[:14]
+        
+        record = PacketRecord()
+        record.sniff_timestamp = float(epoch) if epoch else 0.0
+        record.length = int(length) if length else 0
+        layers = [layer.upper() for layer in protocols.split(':') if layer]
+        
+        if ip_src:
+            record.src, record.dst = ip_src, ip_dst
+        elif ipv6_src:
+            record.src, record.dst = ipv6_src, ipv6_dst
+        # Пакет с транспортом, вложенный в туннель: учитывается внутренний заголовок
+        try:
+            if tcp_src:
+                record.transport_layer = 'TCP'
+                record.srcport, record.dstport = int(tcp_src), int(tcp_dst)
+                record.flags = int(tcp_flags, 16) if tcp_flags else 0
+            elif udp_src:
+                record.transport_layer = 'UDP'
+                record.srcport, record.dstport = int(udp_src), int(udp_dst)
+        except ValueError:
+            pass
+        if qry_name:
+            record.qry_name = qry_name
+            record.flags_response = 1 if response in ('1', 'True') else 0
+        
+        record.layers = layers
+        record.highest_layer = layers[-1] if layers else 'UNKNOWN'
+        return record
+    
+    def close(self):
+        if self._process.poll() is None:
+            self._process.terminate()
+            try:
+                self._process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self._process.kill()
+        self._process.stdout.close()
+        self._stderr.close()
+
+CAPTURE_BACKENDS = ('native', 'tshark', 'pyshark')
+
+# Чтение через pyshark в отдельном потоке
+class PysharkFileReader:
+    """Синхронный FileCapture запускает собственный цикл asyncio и не работает
+    внутри уже запущенного (analyze_pcapng_advanced), поэтому файл читается
+    в фоновом потоке со своим циклом, а пакеты передаются через очередь."""
+    
+    _END = object()
+    
+    def __init__(self, file_path: str, max_queue: int = 10000):
+        self.file_path = file_path
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._read, name="pyshark-reader", daemon=True)
+        self._thread.start()
+    
+    def _read(self):
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        cap = None
+        try:
+            cap = pyshark.FileCapture(self.file_path)
+            for packet in cap:
+                if self._closed.is_set():
+                    break
+                self._put(packet)
+            self._put(self._END)
+        except Exception as e:
+            self._put(e)
+        finally:
+            if cap is not None:
+                try:
+                    cap.close()
+                except Exception as e:
+                    logging.debug(f"pyshark close failed: {e}")
+    
+    def _put(self, item):
+        while not self._closed.is_set():
+            try:
+                self._queue.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+    
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is self._END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    
+    def close(self):
+        self._closed.set()
+
+def open_capture(file_path: str, backend: str = 'native'):
+    """Открытие захвата выбранным бэкендом (native и tshark с откатом на pyshark)"""
+    if backend == 'native':
+        try:
+            return NativePcapReader(file_path)
+        except ValueError as e:
+            logging.warning(f"Native reader unavailable ({e}), falling back to pyshark")
+    elif backend == 'tshark':
+        try:
+            return TsharkFieldReader(file_path)
+        except (ValueError, OSError) as e:
+            logging.warning(f"tshark backend unavailable ({e}), falling back to pyshark")
+    return PysharkFileReader(file_path)
+
+def compare_backends(file_path: str, backends: Tuple[str, ...] = CAPTURE_BACKENDS,
+                     max_packets: Optional[int] = None) -> List[Dict]:
+    """Скорость чтения файла разными бэкендами (пакетов в секунду)"""
+    results = []
+    for backend in backends:
+        packets = 0
+        started = time.perf_counter()
+        try:
+            cap = open_capture(file_path, backend)
+            try:
+                for packet in cap:
+                    # Обращение к полям, которые читают детекторы
+                    if 'IP' in packet:
+                        packet.ip.src
+                    packet.length
+                    packets += 1
+                    if max_packets and packets >= max_packets:
+                        break
+            finally:
+                cap.close()
+        except Exception as e:
+            logging.error(f"Backend {backend} failed: {e}")
+            continue
+        elapsed = time.perf_counter() - started
+        results.append({
+            'backend': backend,
+            'reader': type(cap).__name__,
+            'packets': packets,
+            'seconds': round(elapsed, 3),
+            'packets_per_second': round(packets / elapsed, 1) if elapsed > 0 else 0
+        })
+    
+    baseline = next((r for r in results if r['backend'] == 'pyshark'), None)
+    print(f"{'Backend':<10} {'Reader':<20} {'Packets':>10} {'Seconds':>9} {'Packets/s':>12} {'vs pyshark':>11}")
+    for result in results:
+        speedup = (f"{result['packets_per_second'] / baseline['packets_per_second']:.1f}x"
+                   if baseline and baseline['packets_per_second'] else '-')
+        print(f"{result['backend']:<10} {result['reader']:<20} {result['packets']:>10} "
+              f"{result['seconds']:>9} {result['packets_per_second']:>12} {speedup:>11}")
+    return results
+
+# Онлайн-статистика (алгоритм Уэлфорда) для потоковых детекторов
+class RunningStats:
+    __slots__ = ('count', 'mean', 'm2')
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, value: float):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    @property
+    def stdev(self) -> float:
+        """Выборочное стандартное отклонение, как statistics.stdev"""
+        return (self.m2 / (self.count - 1)) ** 0.5 if self.count > 1 else 0
+
+# Экспоненциально взвешенные среднее и дисперсия (EWMA)
+class EWMAStats:
+    """Пока count < 1/alpha вес равен 1/count - это точные среднее и
+    дисперсия (как у Уэлфорда); дальше старые значения забываются с весом alpha"""
+    __slots__ = ('count', 'mean', 'var')
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.var = 0.0
+
+    def add(self, value: float, alpha: float):
+        self.count += 1
+        weight = max(1.0 / self.count, alpha)
+        delta = value - self.mean
+        self.mean += weight * delta
+        self.var = (1 - weight) * (self.var + weight * delta * delta)
+
+    @property
+    def stdev(self) -> float:
+        return self.var ** 0.5
+
+    def zscore(self, value: float, min_stdev: float = 0.0) -> float:
+        """Отклонение в сигмах; min_stdev защищает от почти постоянных рядов"""
+        stdev = max(self.var ** 0.5, min_stdev)
+        return (value - self.mean) / stdev if stdev > 0 else 0.0
+
+    def merge(self, other: 'EWMAStats', alpha: float):
+        """Слияние с состоянием следующего по времени отрезка потока.
+        Пока общее число значений не больше 1/alpha, моменты объединяются
+        точно (как у Уэлфорда); дальше вес прежнего состояния равен
+        (1 - alpha) ** other.count - столько оно забылось бы за значения other."""
+        if not other.count:
+            return
+        total = self.count + other.count
+        if total <= 1.0 / alpha:
+            weight = self.count / total
+        else:
+            weight = (1 - alpha) ** other.count
+        mean = weight * self.mean + (1 - weight) * other.mean
+        self.var = (weight * (self.var + (self.mean - mean) ** 2) +
+                    (1 - weight) * (other.var + (other.mean - mean) ** 2))
+        self.mean = mean
+        self.count = total
+
+# Профиль отправителя по одному протоколу для поведенческого анализа
+class HostProfile:
+    __slots__ = ('size', 'gap', 'rate', 'last_time', 'bucket', 'bucket_count', 'last_alert')
+
+    def __init__(self, timestamp: float):
+        self.size = EWMAStats()
+        self.gap = EWMAStats()
+        self.rate = EWMAStats()
+        self.last_time = timestamp
+        self.bucket = int(timestamp)
+        self.bucket_count = 0
+        self.last_alert = {}
+
+    def merge(self, other: 'HostProfile', alpha: float):
+        """Слияние с профилем того же отправителя из более позднего шарда"""
+        self.size.merge(other.size, alpha)
+        self.gap.merge(other.gap, alpha)
+        self.rate.merge(other.rate, alpha)
+        if other.bucket == self.bucket:
+            self.bucket_count += other.bucket_count
+        elif other.bucket > self.bucket:
+            self.bucket, self.bucket_count = other.bucket, other.bucket_count
+        self.last_time = max(self.last_time, other.last_time)
+        for metric, timestamp in other.last_alert.items():
+            self.last_alert[metric] = max(self.last_alert.get(metric, timestamp), timestamp)
+
+# Точный счетчик статистики для потокового режима
+class ExactCounter(Counter):
+    """Counter с append, как у списков в self.stats: память растет с числом
+    различных значений, а не с числом пакетов"""
+    
+    def append(self, item):
+        self[item] += 1
+
+# Потоковый подсчет частых элементов (алгоритм Space-Saving)
+class SpaceSavingCounter:
+    """Top-N с ограниченной памятью: хранится не более capacity счетчиков.
+    
+    Для потока из N элементов оценка частоты завышена не более чем на
+    N / capacity (точная граница для элемента хранится в errors), а каждый
+    элемент с частотой больше N / capacity гарантированно присутствует.
+    При слиянии сводок с N1 и N2 элементами граница становится
+    (N1 + N2) / capacity, то есть сохраняется для объединенного потока.
+    """
+    
+    def __init__(self, capacity: int = 1000):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.total = 0
+        self._heap = []  # (count, item); записи обновляются лениво
+    
+    def append(self, item):
+        """Совместимость со списками в self.stats"""
+        self.update(item)
+    
+    def update(self, item, count: int = 1):
+        self.total += count
+        counts = self.counts
+        if item in counts:
+            counts[item] += count
+            return
+        
+        if len(counts) < self.capacity:
+            counts[item] = count
+            self.errors[item] = 0
+            heapq.heappush(self._heap, (count, item))
+            return
+        
+        # Вытеснение минимального счетчика: новый элемент наследует его значение
+        min_count, min_item = self._pop_min()
+        del counts[min_item]
+        del self.errors[min_item]
+        counts[item] = min_count + count
+        self.errors[item] = min_count
+        heapq.heappush(self._heap, (min_count + count, item))
+    
+    def _pop_min(self) -> Tuple[int, object]:
+        heap = self._heap
+        while True:
+            count, item = heapq.heappop(heap)
+            current = self.counts[item]
+            if current == count:
+                return count, item
+            heapq.heappush(heap, (current, item))
+    
+    def min_count(self) -> int:
+        """Нижний порог сводки (0, пока она не заполнена)"""
+        if len(self.counts) < self.capacity:
+            return 0
+        count, item = self._pop_min()
+        heapq.heappush(self._heap, (count, item))
+        return count
+    
+    def most_common(self, n: Optional[int] = None) -> List[Tuple[object, int]]:
+        items = sorted(self.counts.items(), key=lambda kv: kv[1], reverse=True)
+        return items if n is None else items[:n]
+    
+    def merge(self, other: 'SpaceSavingCounter'):
+        """Слияние сводок (например, шардов параллельного анализа)"""
+        self_min, other_min = self.min_count(), other.min_count()
+        merged = {}
+        for item in self.counts.keys() | other.counts.keys():
+            # Отсутствующий в заполненной сводке элемент мог иметь до min_count
+            count = self.counts.get(item, self_min) + other.counts.get(item, other_min)
+            error = self.errors.get(item, self_min) + other.errors.get(item, other_min)
+            merged[item] = (count, error)
+        
+        top = heapq.nlargest(self.capacity, merged.items(), key=lambda kv: kv[1][0])
+        self.counts = {item: count for item, (count, _) in top}
+        self.errors = {item: error for item, (_, error) in top}
+        self._heap = [(count, item) for item, count in self.counts.items()]
+        heapq.heapify(self._heap)
+        self.total += other.total
+    
+    def __len__(self) -> int:
+        return len(self.counts)
+    
+    def to_state(self) -> Dict:
+        """Состояние для JSON: элементы списком, ключи могут быть не строками"""
+        return {'capacity': self.capacity, 'total': self.total,
+                'items': [[item, count, self.errors[item]] for item, count in self.counts.items()]}
+    
+    @classmethod
+    def from_state(cls, state: Dict) -> 'SpaceSavingCounter':
+        counter = cls(state['capacity'])
+        counter.total = state['total']
+        for item, count, error in state['items']:
+            counter.counts[item] = count
+            counter.errors[item] = error
+        counter._heap = [(count, item) for item, count in counter.counts.items()]
+        heapq.heapify(counter._heap)
+        return counter
+
+def merge_counts(target, source):
+    """Слияние счетчиков статистики: Counter или SpaceSavingCounter"""
+    if isinstance(target, SpaceSavingCounter):
+        target.merge(source)
+    else:
+        target.update(source)
+    return target
+
+# Анализатор поведения сети (Behavioral Analysis)
+class BehavioralAnalyzer:
+    """Помимо общего профиля сети ведутся профили по паре (отправитель,
+    протокол): EWMA размера пакета, интервала между пакетами и частоты
+    (пакетов в секунду), O(1) на пакет. Аномалия интервала - пауза не
+    короче min_gap секунд, намного длиннее обычной для отправителя.
+    Профилей не больше max_profiles, вытесняются давно не активные.
+    Аномалии по профилям возвращаются из process_packet сразу, с паузой
+    alert_cooldown секунд на метрику; после max_host_anomalies аномалий
+    остальные только подсчитываются и попадают в сводку finalize()."""
+    
+    def __init__(self, window_size: int = 1000, recent_size: int = 500,
+                 max_profiles: int = 10000, alpha: float = 0.05,
+                 z_threshold: float = 5.0, min_samples: int = 50,
+                 min_rate: float = 20.0, min_gap: float = 1.0, alert_cooldown: float = 60.0,
+                 max_host_anomalies: int = 1000):
+        self.baseline_established = False
+        self.network_baseline = {}
+        self.window_size = window_size
+        
+        # Ограниченное состояние для потокового режима
+        self._seen = 0
+        self._prev_time = None
+        self._baseline_protocols = Counter()
+        self._baseline_sizes = RunningStats()
+        self._baseline_deltas = RunningStats()
+        self._recent_sizes = deque(maxlen=recent_size)
+        
+        self.max_profiles = max_profiles
+        self.alpha = alpha
+        self.z_threshold = z_threshold
+        self.min_samples = min_samples
+        self.min_rate = min_rate
+        self.min_gap = min_gap
+        self.alert_cooldown = alert_cooldown
+        self.profiles = OrderedDict()
+        self.profiles_evicted = 0
+        self.max_host_anomalies = max_host_anomalies
+        self.host_anomalies = 0
+        self.suppressed_anomalies = Counter()
+    
+    def process_packet(self, packet) -> Optional[List[Dict]]:
+        """Потоковое обновление профилей: первые window_size пакетов формируют
+        общую базу; возвращает новые аномалии по отправителям, если они есть"""
+        self._seen += 1
+        has_length = hasattr(packet, 'length')
+        
+        if self._seen <= self.window_size:
+            self._baseline_protocols[packet.highest_layer] += 1
+            if has_length:
+                self._baseline_sizes.add(int(packet.length))
+            
+            curr_time = getattr(packet, 'sniff_time', None)
+            if self._prev_time is not None and curr_time is not None:
+                self._baseline_deltas.add((curr_time - self._prev_time).total_seconds())
+            self._prev_time = curr_time
+            
+            if self._seen == self.window_size:
+                self.network_baseline = {
+                    'protocol_distribution': dict(self._baseline_protocols),
+                    'avg_packet_size': self._baseline_sizes.mean,
+                    'std_packet_size': self._baseline_sizes.stdev,
+                    'avg_time_delta': self._baseline_deltas.mean,
+                    'std_time_delta': self._baseline_deltas.stdev
+                }
+                self.baseline_established = True
+        
+        if has_length:
+            self._recent_sizes.append(int(packet.length))
+            if 'IP' in packet:
+                return self._update_profile(packet, packet.ip.src)
+            if 'IPV6' in packet:
+                return self._update_profile(packet, packet.ipv6.src)
+        return None
+    
+    def _update_profile(self, packet, host: str) -> Optional[List[Dict]]:
+        protocol = getattr(packet, 'transport_layer', None) or packet.highest_layer
+        key = (host, protocol)
+        timestamp = float(packet.sniff_timestamp)
+        size = int(packet.length)
+        
+        profiles = self.profiles
+        profile = profiles.get(key)
+        if profile is None:
+            profile = profiles[key] = HostProfile(timestamp)
+            if len(profiles) > self.max_profiles:
+                profiles.popitem(last=False)
+                self.profiles_evicted += 1
+        else:
+            profiles.move_to_end(key)
+        
+        anomalies = None
+        if profile.size.count >= self.min_samples:
+            z = profile.size.zscore(size, max(1.0, 0.05 * profile.size.mean))
+            if abs(z) > self.z_threshold:
+                anomalies = self._host_anomaly(profile, key, 'SIZE', size, profile.size, z, timestamp)
+        profile.size.add(size, self.alpha)
+        
+        # Интервал после предыдущего пакета того же отправителя
+        if profile.size.count > 1:
+            gap = timestamp - profile.last_time
+            if profile.gap.count >= self.min_samples and gap >= self.min_gap:
+                z = profile.gap.zscore(gap, max(0.01, 0.1 * profile.gap.mean))
+                if z > self.z_threshold:
+                    anomaly = self._host_anomaly(profile, key, 'GAP', round(gap, 6), profile.gap, z, timestamp)
+                    anomalies = (anomalies or []) + (anomaly or [])
+            profile.gap.add(gap, self.alpha)
+        
+        # Частота считается по секундным интервалам при их закрытии
+        bucket = int(timestamp)
+        if bucket != profile.bucket:
+            rate = profile.bucket_count
+            if profile.rate.count >= self.min_samples // 5 and rate >= self.min_rate:
+                z = profile.rate.zscore(rate, max(1.0, 0.1 * profile.rate.mean))
+                if z > self.z_threshold:
+                    anomaly = self._host_anomaly(profile, key, 'RATE', rate, profile.rate, z, timestamp)
+                    anomalies = (anomalies or []) + (anomaly or [])
+            profile.rate.add(rate, self.alpha)
+            if bucket - profile.bucket > 1:
+                profile.rate.add(0, self.alpha)  # Паузу учитываем одним нулевым интервалом
+            profile.bucket = bucket
+            profile.bucket_count = 0
+        profile.bucket_count += 1
+        profile.last_time = timestamp
+        return anomalies
+    
+    def _host_anomaly(self, profile: HostProfile, key: Tuple[str, str], metric: str,
+                      value: float, stats: EWMAStats, z: float, timestamp: float) -> Optional[List[Dict]]:
+        last_alert = profile.last_alert.get(metric)
+        if last_alert is not None and timestamp - last_alert < self.alert_cooldown:
+            return None
+        profile.last_alert[metric] = timestamp
+        if self.host_anomalies >= self.max_host_anomalies:
+            self.suppressed_anomalies[f'HOST_{metric}_ANOMALY'] += 1
+            return None
+        self.host_anomalies += 1
+        host, protocol = key
+        unit = {'SIZE': 'bytes', 'GAP': 's'}.get(metric, 'packets/s')
+        return [{
+            'type': f'HOST_{metric}_ANOMALY',
+            'severity': 'MEDIUM',
+            'source_ip': host,
+            'protocol': protocol,
+            'value': value,
+            'baseline_mean': round(stats.mean, 2),
+            'baseline_std': round(stats.stdev, 2),
+            'deviation': round(abs(z), 2),
+            'timestamp': timestamp,
+            'description': f'{host} {protocol} {metric.lower()} {value} {unit} '
+                           f'vs baseline {stats.mean:.2f}±{stats.stdev:.2f}'
+        }]
+    
+    def host_baselines(self, top_n: int = 10) -> List[Dict]:
+        """Профили самых активных отправителей для отчета"""
+        busiest = heapq.nlargest(top_n, self.profiles.items(), key=lambda item: item[1].size.count)
+        return [{
+            'host': host,
+            'protocol': protocol,
+            'packets': profile.size.count,
+            'avg_size': round(profile.size.mean, 2),
+            'std_size': round(profile.size.stdev, 2),
+            'avg_gap': round(profile.gap.mean, 6),
+            'avg_rate': round(profile.rate.mean, 2)
+        } for (host, protocol), profile in busiest]
+    
+    def merge(self, other: 'BehavioralAnalyzer'):
+        """Слияние состояния следующего по порядку шарда.
+        База берется из первого шарда, набравшего window_size пакетов;
+        профили одного отправителя объединяются по моментам EWMA."""
+        if not self.baseline_established and other.baseline_established:
+            self.network_baseline = other.network_baseline
+            self.baseline_established = True
+        self._seen += other._seen
+        self._recent_sizes.extend(other._recent_sizes)
+        for key, profile in other.profiles.items():
+            current = self.profiles.pop(key, None)
+            if current is not None:
+                current.merge(profile, self.alpha)
+                profile = current
+            self.profiles[key] = profile
+        while len(self.profiles) > self.max_profiles:
+            self.profiles.popitem(last=False)
+            self.profiles_evicted += 1
+        self.profiles_evicted += other.profiles_evicted
+        self.host_anomalies += other.host_anomalies
+        self.suppressed_anomalies.update(other.suppressed_anomalies)
+    
+    def finalize(self) -> List[Dict]:
+        """Поиск аномалий по накопленному потоковому состоянию"""
+        anomalies = []
+        if self.suppressed_anomalies:
+            suppressed = sum(self.suppressed_anomalies.values())
+            anomalies.append({
+                'type': 'HOST_ANOMALIES_SUPPRESSED',
+                'severity': 'LOW',
+                'count': suppressed,
+                'by_type': dict(self.suppressed_anomalies),
+                'description': f'{suppressed} more host anomalies over the limit of '
+                               f'{self.max_host_anomalies} were not listed'
+            })
+        if self._seen > self.window_size:
+            anomalies.extend(self._size_anomalies(list(self._recent_sizes)))
+        return anomalies
+    
+    def reset_window(self):
+        """Начало нового окна: finalize() оценит только пакеты после сброса,
+        лимит аномалий по отправителям начинается заново"""
+        self._recent_sizes.clear()
+        self.host_anomalies = 0
+        self.suppressed_anomalies.clear()
+        
+    def establish_baseline(self, packets: List, window_size: int = 1000):
+        """Установка базового профиля сетевого поведения"""
+        if len(packets) < window_size:
+            return
+            
+        protocols = []
+        packet_sizes = []
+        time_deltas = []
+        
+        for i, packet in enumerate(packets[:window_size]):
+            protocols.append(packet.highest_layer)
+            if hasattr(packet, 'length'):
+                packet_sizes.append(int(packet.length))
+            
+            if i > 0 and hasattr(packet, 'sniff_time'):
+                prev_time = packets[i-1].sniff_time
+                curr_time = packet.sniff_time
+                delta = (curr_time - prev_time).total_seconds()
+                time_deltas.append(delta)
+        
+        self.network_baseline = {
+            'protocol_distribution': dict(Counter(protocols)),
+            'avg_packet_size': statistics.mean(packet_sizes) if packet_sizes else 0,
+            'std_packet_size': statistics.stdev(packet_sizes) if len(packet_sizes) > 1 else 0,
+            'avg_time_delta': statistics.mean(time_deltas) if time_deltas else 0,
+            'std_time_delta': statistics.stdev(time_deltas) if len(time_deltas) > 1 else 0
+        }
+        self.baseline_established = True
+        
+    def detect_anomalies(self, packets: List) -> List[Dict]:
+        """Обнаружение аномалий на основе базового профиля"""
+        if not self.baseline_established:
+            return []
+
+        # Анализ последних пакетов
+        recent_packets = packets[-500:]  # Последние 500 пакетов
+        recent_sizes = [int(p.length) for p in recent_packets if hasattr(p, 'length')]
+        
+        return self._size_anomalies(recent_sizes)
+    
+    def _size_anomalies(self, recent_sizes: List[int]) -> List[Dict]:
+        anomalies = []
+        
+        if recent_sizes:
+            avg_recent_size = statistics.mean(recent_sizes)
+            baseline_avg = self.network_baseline['avg_packet_size']
+            baseline_std = self.network_baseline['std_packet_size']
+            
+            # Обнаружение аномального размера пакетов
+            if baseline_std and abs(avg_recent_size - baseline_avg) > 2 * baseline_std:
+                anomalies.append({
+                    'type': 'SIZE_ANOMALY',
+                    'severity': 'MEDIUM',
+                    'description': f'Average packet size anomaly: {avg_recent_size:.2f} vs baseline {baseline_avg:.2f}',
+                    'deviation': abs(avg_recent_size - baseline_avg) / baseline_std
+                })
+        
+        return anomalies
+
+# Оценка числа различных значений (HyperLogLog)
+class HyperLogLog:
+    """2^precision однобайтовых регистров; при precision=8 - 256 байт
+    и стандартная ошибка около 6.5%"""
+    __slots__ = ('precision', 'registers')
+    
+    MASK64 = (1 << 64) - 1
+    
+    def __init__(self, precision: int = 8):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+    
+    @classmethod
+    def hash64(cls, value: int) -> int:
+        """Перемешивание splitmix64: дешевый хеш для целых (порты)"""
+        z = (value + 0x9E3779B97F4A7C15) & cls.MASK64
+        z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & cls.MASK64
+        z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & cls.MASK64
+        return z ^ (z >> 31)
+    
+    def add(self, value: int) -> bool:
+        """Добавление значения; True, если оценка могла измениться"""
+        h = self.hash64(value)
+        bits = 64 - self.precision
+        index = h >> bits
+        rank = bits - (h & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+            return True
+        return False
+    
+    def merge(self, other: 'HyperLogLog'):
+        self.registers = bytearray(map(max, self.registers, other.registers))
+    
+    def __len__(self) -> int:
+        m = len(self.registers)
+        registers = self.registers
+        # Подсчет по значениям регистров: различных рангов единицы, а не m
+        harmonic = sum(registers.count(r) * 2.0 ** -r for r in set(registers))
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / harmonic
+        zeros = registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)  # Поправка для малых значений
+        return int(round(estimate))
+
+# Агрегаты DNS запросов к одному зарегистрированному домену
+class DomainQueryStats:
+    __slots__ = ('queries', 'bytes', 'subdomains', 'entropy_sum', 'length_sum',
+                 'max_length', 'first_seen', 'last_seen', 'checked_queries')
+    
+    def __init__(self, timestamp: float):
+        self.queries = 0
+        self.bytes = 0
+        self.subdomains = HyperLogLog()
+        self.entropy_sum = 0.0
+        self.length_sum = 0
+        self.max_length = 0
+        self.first_seen = timestamp
+        self.last_seen = timestamp
+        self.checked_queries = 0
+    
+    def merge(self, other: 'DomainQueryStats'):
+        self.queries += other.queries
+        self.bytes += other.bytes
+        self.subdomains.merge(other.subdomains)
+        self.entropy_sum += other.entropy_sum
+        self.length_sum += other.length_sum
+        self.max_length = max(self.max_length, other.max_length)
+        self.first_seen = min(self.first_seen, other.first_seen)
+        self.last_seen = max(self.last_seen, other.last_seen)
+
+# Потоковый детектор DNS туннелирования
+class DNSTunnelingDetector:
+    """Кроме правила длины (qry_name длиннее max_length) ведутся агрегаты
+    по зарегистрированному домену: число уникальных поддоменов (HyperLogLog),
+    доля запросов к новым именам, средняя энтропия и длина поддомена,
+    частота запросов и объем. Учитываются только запросы (QR = 0): ответ
+    повторяет имя запроса. На пакет - O(длины имени); проверка порогов
+    выполняется пачкой раз в check_interval запросов и только для доменов с новыми запросами. Доменов не больше
+    max_domains; простаивающие дольше idle_timeout секунд вытесняются."""
+    
+    # Вторые уровни в национальных зонах (co.uk, com.au, ...)
+    SECOND_LEVEL = {'co', 'com', 'net', 'org', 'gov', 'edu', 'ac', 'or', 'ne', 'go'}
+    
+    def __init__(self, max_length: int = 100, max_candidates: int = 10,
+                 max_domains: int = 50000, idle_timeout: float = 600.0,
+                 check_interval: int = 1000, min_unique: int = 50,
+                 entropy_threshold: float = 3.5, length_threshold: float = 40.0,
+                 novelty_threshold: float = 0.8):
+        self.max_length = max_length
+        self.max_candidates = max_candidates
+        self.candidates = []
+        self.total_suspicious = 0
+        
+        self.max_domains = max_domains
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.min_unique = min_unique
+        self.entropy_threshold = entropy_threshold
+        self.length_threshold = length_threshold
+        self.novelty_threshold = novelty_threshold
+        self.domains = OrderedDict()  # registered domain -> DomainQueryStats (LRU)
+        self.findings = {}
+        self.evicted = 0
+        self._since_check = 0
+        self._now = 0.0
+    
+    @classmethod
+    def registered_domain(cls, name: str) -> Tuple[str, str]:
+        """Разделение имени на (поддомен, зарегистрированный домен)"""
+        labels = name.rstrip('.').lower().split('.')
+        keep = 3 if len(labels) > 2 and len(labels[-1]) == 2 and labels[-2] in cls.SECOND_LEVEL else 2
+        return '.'.join(labels[:-keep]), '.'.join(labels[-keep:])
+    
+    @staticmethod
+    def entropy(text: str) -> float:
+        """Энтропия Шеннона по символам, бит на символ"""
+        length = len(text)
+        result = 0.0
+        for char in set(text):
+            p = text.count(char) / length
+            result -= p * math.log2(p)
+        return result
+    
+    def process_packet(self, packet):
+        """Проверка одного запроса: хранятся только первые max_candidates примеров"""
+        if is_dns_query(packet):
+            domain = packet.dns.qry_name
+            # Подозрительные длинные DNS запросы
+            if len(domain) > self.max_length:
+                self.total_suspicious += 1
+                if len(self.candidates) < self.max_candidates:
+                    self.candidates.append({
+                        'domain': domain,
+                        'length': len(domain),
+                        'packet_time': getattr(packet, 'sniff_time', datetime.now())
+                    })
+            self._update_domain(packet, domain)
+    
+    def _update_domain(self, packet, name: str):
+        subdomain, registered = self.registered_domain(name)
+        if not subdomain:
+            return
+        timestamp = float(packet.sniff_timestamp)
+        self._now = max(self._now, timestamp)
+        
+        stats = self.domains.get(registered)
+        if stats is None:
+            stats = self.domains[registered] = DomainQueryStats(timestamp)
+            if len(self.domains) > self.max_domains:
+                self._evict_oldest()
+        else:
+            self.domains.move_to_end(registered)
+        
+        stats.queries += 1
+        stats.bytes += int(packet.length)
+        stats.last_seen = timestamp
+        stats.subdomains.add(zlib.crc32(subdomain.encode()) | (len(subdomain) << 32))
+        stats.entropy_sum += self.entropy(subdomain.replace('.', ''))
+        stats.length_sum += len(subdomain)
+        stats.max_length = max(stats.max_length, len(subdomain))
+        
+        self._since_check += 1
+        if self._since_check >= self.check_interval:
+            self.check_domains()
+    
+    def check_domains(self):
+        """Пачечная проверка доменов с новыми запросами и вытеснение простаивающих"""
+        self._since_check = 0
+        for registered, stats in self.domains.items():
+            if stats.queries != stats.checked_queries:
+                stats.checked_queries = stats.queries
+                finding = self._score(registered, stats)
+                if finding:
+                    self.findings[registered] = finding
+        
+        # Домены упорядочены по последнему запросу: простаивающие - в начале
+        while self.domains:
+            stats = next(iter(self.domains.values()))
+            if self._now - stats.last_seen < self.idle_timeout:
+                break
+            self._evict_oldest()
+    
+    def _evict_oldest(self):
+        """Вытеснение с последней проверкой, чтобы не потерять находку"""
+        registered, stats = self.domains.popitem(last=False)
+        self.evicted += 1
+        if stats.queries != stats.checked_queries:
+            finding = self._score(registered, stats)
+            if finding:
+                self.findings[registered] = finding
+    
+    def _score(self, registered: str, stats: DomainQueryStats) -> Optional[Dict]:
+        """Признаки: высокая энтропия, длинные поддомены и почти каждый запрос
+        к новому имени; один признак - MEDIUM, два и больше - HIGH"""
+        if stats.queries < self.min_unique:
+            return None
+        unique = len(stats.subdomains)
+        if unique < self.min_unique:
+            return None
+        avg_entropy = stats.entropy_sum / stats.queries
+        avg_length = stats.length_sum / stats.queries
+        novelty = min(unique / stats.queries, 1.0)
+        signals = ((avg_entropy >= self.entropy_threshold) + (avg_length >= self.length_threshold) +
+                   (novelty >= self.novelty_threshold))
+        if not signals:
+            return None
+        
+        duration = max(stats.last_seen - stats.first_seen, 1.0)
+        return {
+            'type': 'DNS_TUNNELING',
+            'severity': 'HIGH' if signals >= 2 else 'MEDIUM',
+            'domain': registered,
+            'unique_subdomains': unique,
+            'queries': stats.queries,
+            'bytes': stats.bytes,
+            'avg_entropy': round(avg_entropy, 2),
+            'avg_subdomain_length': round(avg_length, 1),
+            'unique_ratio': round(novelty, 2),
+            'max_subdomain_length': stats.max_length,
+            'queries_per_second': round(stats.queries / duration, 2),
+            'description': f'{registered}: ~{unique} unique subdomains, '
+                           f'entropy {avg_entropy:.2f} bits/char, avg length {avg_length:.0f}'
+        }
+    
+    def merge(self, other: 'DNSTunnelingDetector'):
+        self.total_suspicious += other.total_suspicious
+        free = self.max_candidates - len(self.candidates)
+        self.candidates.extend(other.candidates[:max(free, 0)])
+        
+        self._now = max(self._now, other._now)
+        for registered, stats in other.domains.items():
+            current = self.domains.pop(registered, None)
+            if current is not None:
+                stats.merge(current)
+                stats.checked_queries = 0
+            self.domains[registered] = stats
+        while len(self.domains) > self.max_domains:
+            self._evict_oldest()
+        for registered, finding in other.findings.items():
+            if finding['queries'] > self.findings.get(registered, {}).get('queries', 0):
+                self.findings[registered] = finding
+    
+    def finalize(self) -> List[Dict]:
+        self.check_domains()
+        detections = sorted(self.findings.values(), key=lambda f: -f['unique_subdomains'])
+        if not self.total_suspicious:
+            return detections
+        return [{
+            'type': 'DNS_TUNNELING_SUSPICION',
+            'severity': 'HIGH',
+            'candidates': self.candidates,  # Ограничение вывода
+            'total_suspicious': self.total_suspicious
+        }] + detections
+
+# Различные порты источника в текущем и предыдущем окне
+class PortWindow:
+    __slots__ = ('start', 'ports', 'previous', 'last_seen')
+    
+    def __init__(self, start: float, ports):
+        self.start = start
+        self.ports = ports
+        self.previous = None
+        self.last_seen = start
+
+# Потоковый детектор сканирования портов с ограниченным числом источников
+class PortScanDetector:
+    """Сканер - источник, обратившийся к threshold различным TCP портам за
+    окно window секунд. Окно скользящее в приближении двух интервалов:
+    учитываются порты текущего и предыдущего интервала. При threshold
+    до SPARSE_LIMIT порты хранятся точным множеством (оно не растет
+    больше threshold), выше - в HyperLogLog фиксированного размера.
+    Источники без пакетов дольше двух окон и сверх max_sources вытесняются."""
+    
+    SPARSE_LIMIT = 64
+    
+    def __init__(self, threshold: int = 20, max_sources: int = 100000, window: float = 60.0):
+        self.threshold = threshold
+        self.max_sources = max_sources
+        self.window = window
+        self.use_hll = threshold > self.SPARSE_LIMIT
+        self.sources = OrderedDict()  # src_ip -> PortWindow (LRU по времени последнего пакета)
+        self.scanners = {}  # src_ip -> число портов на момент срабатывания
+        self.evicted = 0
+    
+    def _new_ports(self):
+        return HyperLogLog() if self.use_hll else set()
+    
+    def _distinct(self, state: PortWindow) -> int:
+        if state.previous is None:
+            return len(state.ports)
+        if self.use_hll:
+            union = HyperLogLog()
+            union.registers = bytearray(map(max, state.ports.registers, state.previous.registers))
+            return len(union)
+        return len(state.ports | state.previous)
+    
+    def process_packet(self, packet):
+        if 'IP' not in packet or 'TCP' not in packet:
+            return
+        src_ip = packet.ip.src
+        if src_ip in self.scanners:
+            return
+        try:
+            dst_port = int(packet.tcp.dstport)
+            timestamp = float(packet.sniff_timestamp)
+        except (AttributeError, ValueError):
+            return
+        
+        sources = self.sources
+        state = sources.get(src_ip)
+        if state is None:
+            state = sources[src_ip] = PortWindow(timestamp - timestamp % self.window, self._new_ports())
+            self._evict(timestamp)
+        else:
+            sources.move_to_end(src_ip)
+            if timestamp - state.start >= self.window:
+                # Новый интервал: текущий становится предыдущим, если они соседние
+                elapsed = int((timestamp - state.start) // self.window)
+                state.previous = state.ports if elapsed == 1 else None
+                state.ports = self._new_ports()
+                state.start += elapsed * self.window
+        state.last_seen = timestamp
+        
+        ports = state.ports
+        if self.use_hll:
+            if not ports.add(dst_port):
+                return
+        elif dst_port in ports:
+            return
+        else:
+            ports.add(dst_port)
+        
+        distinct = self._distinct(state)
+        if distinct >= self.threshold:
+            # После срабатывания состояние источника больше не нужно
+            self.scanners[src_ip] = distinct
+            del sources[src_ip]
+    
+    def _evict(self, now: float):
+        """Источники упорядочены по последнему пакету: простаивающие - в начале"""
+        sources = self.sources
+        while sources:
+            src_ip, state = next(iter(sources.items()))
+            if len(sources) <= self.max_sources and now - state.last_seen < 2 * self.window:
+                break
+            del sources[src_ip]
+            self.evicted += 1
+    
+    def merge(self, other: 'PortScanDetector'):
+        """Слияние со следующим по порядку шардом"""
+        for src_ip, ports_count in other.scanners.items():
+            self.scanners[src_ip] = max(ports_count, self.scanners.get(src_ip, 0))
+            self.sources.pop(src_ip, None)
+        
+        for src_ip, state in other.sources.items():
+            if src_ip in self.scanners:
+                continue
+            current = self.sources.pop(src_ip, None)
+            if current is not None and current.start == state.start:
+                # Интервал разрезан границей шардов: объединяем порты
+                if self.use_hll:
+                    state.ports.merge(current.ports)
+                else:
+                    state.ports |= current.ports
+                state.previous = state.previous if state.previous is not None else current.previous
+            elif current is not None and state.previous is None and state.start - current.start == self.window:
+                state.previous = current.ports
+            self.sources[src_ip] = state
+            distinct = self._distinct(state)
+            if distinct >= self.threshold:
+                self.scanners[src_ip] = distinct
+                del self.sources[src_ip]
+        
+        while len(self.sources) > self.max_sources:
+            self.sources.popitem(last=False)
+            self.evicted += 1
+    
+    def finalize(self) -> List[Dict]:
+        approx = 'about ' if self.use_hll else 'at least '
+        return [{
+            'type': 'PORT_SCAN',
+            'severity': 'HIGH',
+            'source_ip': src_ip,
+            'ports_scanned': ports_count,
+            'window_seconds': self.window,
+            'description': f'{src_ip} contacted {approx}{ports_count} distinct TCP ports within {self.window:g}s'
+        } for src_ip, ports_count in self.scanners.items()]
+
+# Двунаправленный поток (5-tuple); src/sport - сторона, отправившая первый пакет
+class FlowRecord:
+    __slots__ = ('src', 'dst', 'sport', 'dport', 'proto', 'first_seen', 'last_seen',
+                 'connection_start', 'packets_fwd', 'packets_rev', 'bytes_fwd', 'bytes_rev',
+                 'flags_fwd', 'flags_rev', 'end_reason')
+    
+    TCP_FIN = 0x01
+    TCP_RST = 0x04
+    
+    def __init__(self, src: str, dst: str, sport: int, dport: int, proto: str,
+                 timestamp: float, connection_start: Optional[float] = None):
+        self.src, self.dst, self.sport, self.dport, self.proto = src, dst, sport, dport, proto
+        self.first_seen = self.last_seen = timestamp
+        # Начало соединения сохраняется, когда поток разрезан активным таймаутом
+        self.connection_start = timestamp if connection_start is None else connection_start
+        self.packets_fwd = self.packets_rev = 0
+        self.bytes_fwd = self.bytes_rev = 0
+        self.flags_fwd = self.flags_rev = 0
+        self.end_reason = None
+    
+    @property
+    def duration(self) -> float:
+        return self.last_seen - self.first_seen
+    
+    @property
+    def closed(self) -> bool:
+        """Сброс (RST) или FIN с обеих сторон"""
+        return bool((self.flags_fwd | self.flags_rev) & self.TCP_RST or
+                    self.flags_fwd & self.flags_rev & self.TCP_FIN)
+    
+    def merge(self, other: 'FlowRecord'):
+        """Продолжение того же потока (например, из следующего шарда). Шард мог
+        начаться с ответного пакета - тогда направления other обратные."""
+        self.last_seen = max(self.last_seen, other.last_seen)
+        if (other.src, other.sport) == (self.src, self.sport):
+            self.packets_fwd += other.packets_fwd
+            self.packets_rev += other.packets_rev
+            self.bytes_fwd += other.bytes_fwd
+            self.bytes_rev += other.bytes_rev
+            self.flags_fwd |= other.flags_fwd
+            self.flags_rev |= other.flags_rev
+        else:
+            self.packets_fwd += other.packets_rev
+            self.packets_rev += other.packets_fwd
+            self.bytes_fwd += other.bytes_rev
+            self.bytes_rev += other.bytes_fwd
+            self.flags_fwd |= other.flags_rev
+            self.flags_rev |= other.flags_fwd
+    
+    def to_dict(self) -> Dict:
+        return {
+            'src': self.src, 'dst': self.dst, 'sport': self.sport, 'dport': self.dport,
+            'proto': self.proto,
+            'first_seen': datetime.fromtimestamp(self.first_seen).isoformat(),
+            'last_seen': datetime.fromtimestamp(self.last_seen).isoformat(),
+            'duration': round(self.duration, 3),
+            'packets_fwd': self.packets_fwd, 'packets_rev': self.packets_rev,
+            'bytes_fwd': self.bytes_fwd, 'bytes_rev': self.bytes_rev,
+            'flags_fwd': self.flags_fwd, 'flags_rev': self.flags_rev,
+            'end_reason': self.end_reason
+        }
+
+# Таблица потоков: агрегация пакетов в двунаправленные потоки
+class FlowTable:
+    """Поток завершается по простою (idle_timeout), по длительности
+    (active_timeout - длинное соединение выгружается частями), после
+    FIN с обеих сторон или RST (closed_timeout) и при вытеснении сверх
+    max_flows. Завершенные потоки передаются потребителям (process_flow,
+    merge, finalize), которые работают с потоками вместо пакетов; сама
+    таблица ведет сводку для отчета. Состояние ограничено max_flows."""
+    
+    def __init__(self, idle_timeout: float = 60.0, active_timeout: float = 1800.0,
+                 closed_timeout: float = 5.0, max_flows: int = 200000,
+                 consumers: Optional[List] = None, top_n: int = 10):
+        self.idle_timeout = idle_timeout
+        self.active_timeout = active_timeout
+        self.closed_timeout = closed_timeout
+        self.max_flows = max_flows
+        self.consumers = consumers or []
+        self.top_n = top_n
+        
+        self.flows = OrderedDict()  # ключ -> FlowRecord (LRU по последнему пакету)
+        self.closing = deque()  # (время закрытия, ключ)
+        self.flows_exported = 0
+        self.end_reasons = Counter()
+        self.talkers = SpaceSavingCounter(1000)  # байты по отправителю
+        self.top_flows = []  # куча (байты, номер, поток)
+        self._seq = 0
+        self._next_check = 0.0
+    
+    def process_packet(self, packet):
+        if 'IP' in packet:
+            layer = packet.ip
+        elif 'IPV6' in packet:
+            layer = packet.ipv6
+        else:
+            return
+        src, dst = layer.src, layer.dst
+        proto = getattr(packet, 'transport_layer', None) or packet.highest_layer
+        sport = dport = 0
+        flags = 0
+        try:
+            if proto == 'TCP':
+                sport, dport = int(packet.tcp.srcport), int(packet.tcp.dstport)
+                tcp_flags = packet.tcp.flags
+                flags = int(tcp_flags, 16) if isinstance(tcp_flags, str) else int(tcp_flags)
+            elif proto == 'UDP':
+                sport, dport = int(packet.udp.srcport), int(packet.udp.dstport)
+        except (AttributeError, ValueError):
+            pass
+        timestamp = float(packet.sniff_timestamp)
+        size = int(packet.length)
+        
+        key = (src, sport, dst, dport, proto) if (src, sport) <= (dst, dport) else (dst, dport, src, sport, proto)
+        flows = self.flows
+        flow = flows.get(key)
+        if flow is not None and timestamp - flow.first_seen >= self.active_timeout:
+            del flows[key]
+            self._export(flow, 'active')
+            flow = flows[key] = FlowRecord(flow.src, flow.dst, flow.sport, flow.dport, proto,
+                                           timestamp, flow.connection_start)
+        elif flow is None:
+            flow = flows[key] = FlowRecord(src, dst, sport, dport, proto, timestamp)
+            if len(flows) > self.max_flows:
+                _, oldest = flows.popitem(last=False)
+                self._export(oldest, 'evicted')
+        else:
+            flows.move_to_end(key)
+        
+        was_closed = flow.closed
+        if src == flow.src and sport == flow.sport:
+            flow.packets_fwd += 1
+            flow.bytes_fwd += size
+            flow.flags_fwd |= flags
+        else:
+            flow.packets_rev += 1
+            flow.bytes_rev += size
+            flow.flags_rev |= flags
+        flow.last_seen = max(flow.last_seen, timestamp)
+        if flags and not was_closed and flow.closed:
+            self.closing.append((timestamp, key))
+        
+        if timestamp >= self._next_check:
+            self.expire(timestamp)
+            self._next_check = timestamp + 1.0
+    
+    def expire(self, now: float):
+        """Выгрузка закрытых и простаивающих потоков"""
+        flows = self.flows
+        while self.closing and now - self.closing[0][0] >= self.closed_timeout:
+            _, key = self.closing.popleft()
+            flow = flows.get(key)
+            if flow is not None and flow.closed and now - flow.last_seen >= self.closed_timeout:
+                del flows[key]
+                self._export(flow, 'closed')
+        while flows:
+            flow = next(iter(flows.values()))
+            if now - flow.last_seen < self.idle_timeout:
+                break
+            flows.popitem(last=False)
+            self._export(flow, 'idle')
+    
+    def _export(self, flow: FlowRecord, reason: str):
+        flow.end_reason = reason
+        self.flows_exported += 1
+        self.end_reasons[reason] += 1
+        total_bytes = flow.bytes_fwd + flow.bytes_rev
+        self.talkers.update(flow.src, flow.bytes_fwd)
+        if flow.bytes_rev:
+            self.talkers.update(flow.dst, flow.bytes_rev)
+        self._seq += 1
+        entry = (total_bytes, self._seq, flow)
+        if len(self.top_flows) < self.top_n:
+            heapq.heappush(self.top_flows, entry)
+        elif total_bytes > self.top_flows[0][0]:
+            heapq.heapreplace(self.top_flows, entry)
+        for consumer in self.consumers:
+            consumer.process_flow(flow)
+    
+    def merge(self, other: 'FlowTable'):
+        """Слияние со следующим по порядку шардом. Потоки, активные на
+        границе шардов, объединяются; уже выгруженные части остаются
+        отдельными потоками."""
+        for key, flow in other.flows.items():
+            current = self.flows.pop(key, None)
+            if current is not None and flow.first_seen - current.last_seen < self.idle_timeout:
+                current.merge(flow)
+                flow = current
+            elif current is not None:
+                self._export(current, 'idle')
+            self.flows[key] = flow
+        while len(self.flows) > self.max_flows:
+            _, oldest = self.flows.popitem(last=False)
+            self._export(oldest, 'evicted')
+        
+        self.flows_exported += other.flows_exported
+        self.end_reasons.update(other.end_reasons)
+        self.talkers.merge(other.talkers)
+        for entry in other.top_flows:
+            self._seq += 1
+            entry = (entry[0], self._seq, entry[2])
+            if len(self.top_flows) < self.top_n:
+                heapq.heappush(self.top_flows, entry)
+            elif entry[0] > self.top_flows[0][0]:
+                heapq.heapreplace(self.top_flows, entry)
+        for consumer, other_consumer in zip(self.consumers, other.consumers):
+            consumer.merge(other_consumer)
+    
+    def finalize(self) -> List[Dict]:
+        """Выгрузка оставшихся потоков и выводы потребителей"""
+        while self.flows:
+            _, flow = self.flows.popitem(last=False)
+            self._export(flow, 'end_of_capture')
+        self.closing.clear()
+        return [d for consumer in self.consumers for d in consumer.finalize()]
+    
+    def summary(self) -> Dict:
+        return {
+            'flows': self.flows_exported,
+            'end_reasons': dict(self.end_reasons),
+            'top_talkers': self.talkers.most_common(self.top_n),
+            'top_flows': [flow.to_dict() for _, _, flow in sorted(self.top_flows, key=lambda e: -e[0])]
+        }
+
+# Детектор по завершенным потокам: эксфильтрация и долгие соединения
+class FlowAnomalyDetector:
+    """Поток из внутренней сети наружу с объемом не меньше exfil_bytes,
+    в ratio раз больше обратного - DATA_EXFILTRATION; суммарный объем
+    отправителя наружу не меньше volume_bytes - HIGH_OUTBOUND_VOLUME;
+    соединение дольше long_duration секунд - LONG_CONNECTION."""
+    
+    def __init__(self, exfil_bytes: int = 50 * 1024 * 1024, ratio: float = 10.0,
+                 volume_bytes: int = 500 * 1024 * 1024, long_duration: float = 3600.0,
+                 max_findings: int = 1000):
+        self.exfil_bytes = exfil_bytes
+        self.ratio = ratio
+        self.volume_bytes = volume_bytes
+        self.long_duration = long_duration
+        self.max_findings = max_findings
+        self.findings = []
+        self.suppressed = 0
+        self.outbound = SpaceSavingCounter(1000)
+        self.long_connections = {}  # ключ соединения -> наибольшая длительность
+        self._local_cache = {}
+    
+    def _is_local(self, ip: str) -> bool:
+        local = self._local_cache.get(ip)
+        if local is None:
+            try:
+                address = ipaddress.ip_address(ip)
+                local = address.is_private or address.is_loopback or address.is_link_local
+            except ValueError:
+                local = False
+            if len(self._local_cache) < 100000:
+                self._local_cache[ip] = local
+        return local
+    
+    def _add_finding(self, finding: Dict):
+        if len(self.findings) < self.max_findings:
+            self.findings.append(finding)
+        else:
+            self.suppressed += 1
+    
+    def process_flow(self, flow: FlowRecord):
+        # Направление наружу: внутренний отправитель и внешний получатель
+        if self._is_local(flow.src) and not self._is_local(flow.dst):
+            self.outbound.update(flow.src, flow.bytes_fwd)
+            if flow.bytes_fwd >= self.exfil_bytes and flow.bytes_fwd >= self.ratio * flow.bytes_rev:
+                self._add_finding({
+                    'type': 'DATA_EXFILTRATION',
+                    'severity': 'HIGH',
+                    'source_ip': flow.src,
+                    'destination_ip': flow.dst,
+                    'bytes_out': flow.bytes_fwd,
+                    'bytes_in': flow.bytes_rev,
+                    'flow': flow.to_dict(),
+                    'description': f'{flow.src} sent {flow.bytes_fwd / 1048576:.1f} MB to {flow.dst}:{flow.dport} '
+                                   f'({flow.bytes_rev / 1048576:.1f} MB back)'
+                })
+        
+        connection_time = flow.last_seen - flow.connection_start
+        if connection_time >= self.long_duration:
+            key = (flow.src, flow.sport, flow.dst, flow.dport, flow.proto)
+            self.long_connections[key] = max(connection_time, self.long_connections.get(key, 0))
+            if len(self.long_connections) > self.max_findings:
+                self.long_connections.pop(min(self.long_connections, key=self.long_connections.get))
+                self.suppressed += 1
+    
+    def merge(self, other: 'FlowAnomalyDetector'):
+        for finding in other.findings:
+            self._add_finding(finding)
+        self.suppressed += other.suppressed
+        self.outbound.merge(other.outbound)
+        for key, duration in other.long_connections.items():
+            self.long_connections[key] = max(duration, self.long_connections.get(key, 0))
+    
+    def finalize(self) -> List[Dict]:
+        detections = list(self.findings)
+        for src_ip, total in self.outbound.most_common():
+            if total < self.volume_bytes:
+                break
+            detections.append({
+                'type': 'HIGH_OUTBOUND_VOLUME',
+                'severity': 'MEDIUM',
+                'source_ip': src_ip,
+                'bytes_out': total,
+                'description': f'{src_ip} sent up to {total / 1048576:.1f} MB to external hosts'
+            })
+        for (src, sport, dst, dport, proto), duration in sorted(self.long_connections.items(),
+                                                                 key=lambda kv: -kv[1]):
+            detections.append({
+                'type': 'LONG_CONNECTION',
+                'severity': 'LOW',
+                'source_ip': src,
+                'destination_ip': dst,
+                'duration': round(duration, 1),
+                'description': f'{proto} {src}:{sport} -> {dst}:{dport} open for {duration / 3600:.1f}h'
+            })
+        if self.suppressed:
+            detections.append({
+                'type': 'FLOW_FINDINGS_TRUNCATED',
+                'severity': 'LOW',
+                'suppressed': self.suppressed,
+                'description': f'{self.suppressed} more flow findings were not kept'
+            })
+        return detections
+
+# Проверка принадлежности адреса к частным сетям (кешируется: адреса повторяются)
+@lru_cache(maxsize=65536)
+def _is_private_ip(ip: str) -> bool:
+    try:
+        return ipaddress.ip_address(ip).is_private
+    except ValueError:
+        return False
+
+# Базовый анализатор угроз: сверка адресов и DNS запросов с IOC фидом
+class ThreatAnalyzer:
+    """Фид задается в секции [IOC]: ioc_file - JSON фид или скомпилированный снимок"""
+    
+    def __init__(self, config: EnterpriseConfig):
+        self.config = config
+        self.ioc_manager = IOCManager()
+        self.ioc_file = config.get_ioc_settings().get('ioc_file', '')
+        if self.ioc_file:
+            self.ioc_manager.load_from_file(self.ioc_file)
+    
+    def is_local_ip(self, ip: str) -> bool:
+        return _is_private_ip(ip)
+    
+    def analyze_packet_threats(self, packet) -> List[Dict]:
+        """Угрозы одного пакета по IOC: адреса отправителя/получателя и DNS запрос"""
+        threats = []
+        if 'IP' in packet:
+            layer = packet.ip
+        elif 'IPV6' in packet:
+            layer = packet.ipv6
+        else:
+            layer = None
+        
+        if layer is not None:
+            for ip in (layer.src, layer.dst):
+                malicious, info = self.ioc_manager.check_ip(ip)
+                if malicious:
+                    threats.append({
+                        'type': 'MALICIOUS_IP',
+                        'ip': ip,
+                        'severity': 'HIGH',
+                        'description': f'Communication with known malicious IP {ip}',
+                        **info
+                    })
+        
+        if 'DNS' in packet and hasattr(packet.dns, 'qry_name'):
+            domain = packet.dns.qry_name.lower()
+            suspicious, info = self.ioc_manager.check_domain(domain)
+            if suspicious:
+                threats.append({
+                    'type': 'SUSPICIOUS_DOMAIN',
+                    'domain': domain,
+                    'severity': 'MEDIUM',
+                    'description': f'DNS query for suspicious domain {domain}',
+                    **info
+                })
+        return threats
+
+# Расширенный анализатор угроз с интеграцией VirusTotal
 class AdvancedThreatAnalyzer(ThreatAnalyzer):
     def __init__(self, config: EnterpriseConfig):
         super().__init__(config)
@@ -248,218 +3413,1488 @@ class AdvancedThreatAnalyzer(ThreatAnalyzer):
         self.suspicious_ports = {21, 22, 23, 25, 53, 80, 110, 135, 139, 143, 443, 445, 
                                993, 995, 1723, 3306, 3389, 5900, 8080}
         
-    async def analyze_packet_threats_advanced(self, packet) -> Dict:
-        """Расширенный анализ угроз с интеграцией внешних источников"""
-        threats = await super().analyze_packet_threats(packet)
-        
-        # Проверка подозрительных портов
+    def suspicious_port_threats(self, packet) -> List[Dict]:
+        """Проверка подозрительных портов"""
         if 'TCP' in packet:
             try:
                 dst_port = int(packet.tcp.dstport)
                 if dst_port in self.suspicious_ports:
-                    threats.append({
+                    return [{
                         'type': 'SUSPICIOUS_PORT',
                         'port': dst_port,
                         'severity': 'LOW',
                         'description': f'Communication on suspicious port {dst_port}'
-                    })
+                    }]
             except (AttributeError, ValueError):
                 pass
-        
-        # Проверка через VirusTotal для внешних IP
-        if 'IP' in packet and not self.is_local_ip(packet.ip.src):
-            vt_result = await self.vt_integration.check_ip_reputation(packet.ip.src)
-            if vt_result and 'data' in vt_result:
-                stats = vt_result['data']['attributes'].get('last_analysis_stats', {})
-                malicious_count = stats.get('malicious', 0)
-                
-                if malicious_count > 0:
-                    threats.append({
-                        'type': 'VT_MALICIOUS_IP',
-                        'ip': packet.ip.src,
-                        'malicious_engines': malicious_count,
-                        'total_engines': sum(stats.values()),
-                        'severity': 'HIGH' if malicious_count > 5 else 'MEDIUM'
-                    })
-        
-        return threats
+        return []
+    
+    def vt_ip_threat(self, ip: str, vt_result: Optional[Dict]) -> Optional[Dict]:
+        """Угроза по ответу VirusTotal для IP адреса"""
+        if vt_result and 'data' in vt_result:
+            stats = vt_result['data']['attributes'].get('last_analysis_stats', {})
+            malicious_count = stats.get('malicious', 0)
+            
+            if malicious_count > 0:
+                return {
+                    'type': 'VT_MALICIOUS_IP',
+                    'ip': ip,
+                    'malicious_engines': malicious_count,
+                    'total_engines': sum(stats.values()),
+                    'severity': 'HIGH' if malicious_count > 5 else 'MEDIUM'
+                }
+        return None
     
     def detect_data_exfiltration(self, packets: List) -> List[Dict]:
         """Обнаружение потенциальной эксфильтрации данных"""
-        exfiltration_signs = []
-        dns_tunneling_candidates = []
-        
+        detector = DNSTunnelingDetector()
         for packet in packets:
-            # Обнаружение DNS туннелирования
-            if 'DNS' in packet and hasattr(packet.dns, 'qry_name'):
-                domain = packet.dns.qry_name
-                # Подозрительные длинные DNS запросы
-                if len(domain) > 100:
-                    dns_tunneling_candidates.append({
-                        'domain': domain,
-                        'length': len(domain),
-                        'packet_time': getattr(packet, 'sniff_time', datetime.now())
-                    })
+            detector.process_packet(packet)
+        return detector.finalize()
+
+# Фоновое обогащение индикаторов: ограниченная очередь и асинхронные воркеры
+class EnrichmentQueue:
+    """Цикл обработки пакетов только ставит внешние IP в очередь,
+    а воркеры параллельно опрашивают VirusTotal. Каждый IP проверяется
+    один раз. При переполнении очереди backpressure='drop' (по умолчанию)
+    отбрасывает индикатор (он может быть поставлен снова позже), и задержка
+    VirusTotal не замедляет разбор пакетов; 'block' - ждет места."""
+    
+    def __init__(self, threat_analyzer: 'AdvancedThreatAnalyzer', workers: int = 4,
+                 max_queue: int = 1000, backpressure: str = 'drop',
+                 metrics: Optional['PipelineMetrics'] = None):
+        self.threat_analyzer = threat_analyzer
+        self.metrics = metrics
+        self.workers = workers
+        self.backpressure = backpressure
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.threats = []
+        self.seen = set()
+        self.stats = Counter()
+        self._tasks = []
+    
+    def start(self):
+        self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+    
+    async def submit(self, ip: str) -> bool:
+        if ip in self.seen:
+            return True
         
-        if dns_tunneling_candidates:
-            exfiltration_signs.append({
-                'type': 'DNS_TUNNELING_SUSPICION',
-                'severity': 'HIGH',
-                'candidates': dns_tunneling_candidates[:10],  # Ограничение вывода
-                'total_suspicious': len(dns_tunneling_candidates)
-            })
+        if self.backpressure == 'block':
+            if self.queue.full():
+                self.stats['blocked'] += 1
+            await self.queue.put(ip)
+        else:
+            try:
+                self.queue.put_nowait(ip)
+            except asyncio.QueueFull:
+                self.stats['dropped'] += 1
+                if self.metrics:
+                    self.metrics.counters['enrichment_dropped'] += 1
+                return False
+        
+        self.seen.add(ip)
+        self.stats['submitted'] += 1
+        if self.metrics:
+            self.metrics.counters['enrichment_queued'] += 1
+        self.stats['max_queue_depth'] = max(self.stats['max_queue_depth'], self.queue.qsize())
+        return True
+    
+    async def _worker(self):
+        while True:
+            ip = await self.queue.get()
+            started = time.perf_counter()
+            try:
+                vt_result = await self.threat_analyzer.vt_integration.check_ip_reputation(ip)
+                threat = self.threat_analyzer.vt_ip_threat(ip, vt_result)
+                if threat:
+                    self.threats.append(threat)
+                self.stats['completed'] += 1
+            except Exception as e:
+                self.stats['errors'] += 1
+                logging.error(f"Enrichment failed for {ip}: {e}")
+            finally:
+                # Время ожидания ответа; воркеры работают параллельно, сумма может превышать длительность анализа
+                if self.metrics:
+                    self.metrics.add('enrichment', time.perf_counter() - started)
+                self.queue.task_done()
+    
+    async def join(self) -> List[Dict]:
+        """Дождаться обработки очереди и вернуть найденные угрозы"""
+        await self.queue.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        return self.threats
+
+# Система отчетов в форматах STIX/TAXII
+class STIXReportGenerator:
+    SEVERITY_ORDER = {'LOW': 1, 'MEDIUM': 2, 'HIGH': 3, 'CRITICAL': 4}
+    ID_NAMESPACE = uuid.UUID('6f1d2a8e-5b3c-4e7a-9d0f-2c8b7a61e4d5')
+    
+    def __init__(self):
+        self.stix_version = "2.1"
+        # Наблюдаемое значение -> [first_seen, last_seen] по времени пакетов
+        self.sightings: Dict[Tuple[str, str], List[float]] = {}
+    
+    def observe(self, threat: Dict, timestamp: float):
+        """Учет времени пакета с угрозой для first_seen/last_seen в Sighting"""
+        observable = self._threat_observable(threat)
+        if observable is None:
+            return
+        seen = self.sightings.get(observable)
+        if seen is None:
+            self.sightings[observable] = [timestamp, timestamp]
+        elif timestamp < seen[0]:
+            seen[0] = timestamp
+        elif timestamp > seen[1]:
+            seen[1] = timestamp
+    
+    def sightings_state(self) -> List[List]:
+        """Наблюдения списком [тип, значение, first_seen, last_seen] (JSON, pickle)"""
+        return [[kind, value, first, last] for (kind, value), (first, last) in self.sightings.items()]
+    
+    def merge_sightings(self, state: List[List]):
+        """Слияние наблюдений шарда, контрольной точки или кеша"""
+        for kind, value, first, last in state:
+            seen = self.sightings.get((kind, value))
+            if seen is None:
+                self.sightings[(kind, value)] = [first, last]
+            else:
+                seen[0] = min(seen[0], first)
+                seen[1] = max(seen[1], last)
+    
+    def generate_stix_bundle(self, threats: List[Dict], metadata: Dict) -> Dict:
+        """Генерация отчета в формате STIX 2.1"""
+        bundle = self.stream_stix_bundle(threats, metadata)
+        bundle["objects"] = list(bundle["objects"])
+        return bundle
+    
+    def stream_stix_bundle(self, threats: List[Dict], metadata: Dict) -> Dict:
+        """Бандл, в котором objects - генератор (для StreamingReportWriter)"""
+        return {
+            "type": "bundle",
+            "id": f"bundle--{hashlib.md5(str(datetime.now()).encode()).hexdigest()}",
+            "spec_version": self.stix_version,
+            "objects": self.iter_stix_objects(threats)
+        }
+    
+    def iter_stix_objects(self, threats: List[Dict]):
+        for threat in threats:
+            # Создание объекта Indicator для каждой угрозы
+            indicator = {
+                "type": "indicator",
+                "id": f"indicator--{hashlib.md5(str(threat).encode()).hexdigest()}",
+                "created": datetime.now().isoformat(),
+                "modified": datetime.now().isoformat(),
+                "pattern": self._create_stix_pattern(threat),
+                "pattern_type": "stix",
+                "valid_from": datetime.now().isoformat(),
+                "labels": ["malicious-activity"],
+                "name": f"Threat: {threat.get('type', 'Unknown')}",
+                "description": f"Detected threat: {threat}"
+            }
+            yield indicator
+    
+    def stream_aggregated_stix_bundle(self, threats: List[Dict], metadata: Dict) -> Dict:
+        """Бандл с одним Indicator на уникальный IP/домен и Sighting к нему"""
+        return {
+            "type": "bundle",
+            "id": f"bundle--{uuid.uuid4()}",
+            "spec_version": self.stix_version,
+            "objects": self.iter_aggregated_stix_objects(threats, metadata)
+        }
+    
+    def iter_aggregated_stix_objects(self, threats: List[Dict], metadata: Dict):
+        """Угрозы группируются по наблюдаемому значению за один проход;
+        идентификаторы детерминированы (UUIDv5), поэтому повторная выгрузка
+        того же индикатора в TIP обновляет объект, а не создает новый.
+        Угрозы без IP/домена (например, по порту) в бандл не попадают."""
+        observables = {}
+        for threat in threats:
+            observable = self._threat_observable(threat)
+            if observable is None:
+                continue
+            entry = observables.get(observable)
+            if entry is None:
+                entry = observables[observable] = {'count': 0, 'types': Counter(), 'severity': 'LOW'}
+            entry['count'] += 1
+            entry['types'][threat.get('type', 'Unknown')] += 1
+            severity = threat.get('severity', 'LOW')
+            if self.SEVERITY_ORDER.get(severity, 0) > self.SEVERITY_ORDER.get(entry['severity'], 0):
+                entry['severity'] = severity
+        
+        now = self._stix_time(time.time())
+        source = metadata.get('file_hash') or metadata.get('filename', '')
+        for (kind, value), entry in observables.items():
+            pattern = f"[{kind}:value = '{self._escape_pattern(value)}']"
+            indicator_id = f"indicator--{uuid.uuid5(self.ID_NAMESPACE, pattern)}"
+            threat_types = ', '.join(f"{t} x{n}" for t, n in entry['types'].most_common())
+            yield {
+                "type": "indicator",
+                "spec_version": self.stix_version,
+                "id": indicator_id,
+                "created": now,
+                "modified": now,
+                "pattern": pattern,
+                "pattern_type": "stix",
+                "valid_from": now,
+                "labels": ["malicious-activity", entry['severity'].lower()],
+                "name": f"{entry['types'].most_common(1)[0][0]}: {value}",
+                "description": f"Detected threats: {threat_types}"
+            }
+            
+            # Угрозы без времени пакета (обогащение) датируются моментом выгрузки
+            seen = self.sightings.get((kind, value))
+            first_seen, last_seen = (self._stix_time(seen[0]), self._stix_time(seen[1])) if seen else (now, now)
+            yield {
+                "type": "sighting",
+                "spec_version": self.stix_version,
+                "id": f"sighting--{uuid.uuid5(self.ID_NAMESPACE, indicator_id + source)}",
+                "created": now,
+                "modified": now,
+                "sighting_of_ref": indicator_id,
+                "count": min(entry['count'], 999999999),
+                "first_seen": first_seen,
+                "last_seen": last_seen,
+                "description": f"Observed in {metadata.get('filename', 'capture')}"
+            }
+    
+    @staticmethod
+    def _stix_time(timestamp: float) -> str:
+        return datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+    
+    @staticmethod
+    def _escape_pattern(value: str) -> str:
+        return value.replace('\\', '\\\\').replace("'", "\\'")
+    
+    @staticmethod
+    def _threat_observable(threat: Dict) -> Optional[Tuple[str, str]]:
+        """Тип и значение наблюдаемого объекта STIX для угрозы"""
+        ip = threat.get('ip') or threat.get('source_ip')
+        if ip:
+            return ('ipv6-addr' if ':' in str(ip) else 'ipv4-addr', str(ip))
+        if threat.get('domain'):
+            return ('domain-name', str(threat['domain']).lower())
+        return None
+    
+    def _create_stix_pattern(self, threat: Dict) -> str:
+        """Создание STIX паттерна для угрозы"""
+        if 'ip' in threat:
+            return f"[ipv4-addr:value = '{threat['ip']}']"
+        elif 'domain' in threat:
+            return f"[domain-name:value = '{threat['domain']}']"
+        else:
+            return "[threat:value = 'unknown']"
+
+# Потоковая запись отчетов: большие списки сериализуются поэлементно
+class StreamingReportWriter:
+    """JSON с тем же форматированием, что json.dump(indent=2), или NDJSON.
+    Значения-итераторы (генераторы) в документе пишутся по одному элементу,
+    поэтому ни список, ни полная строка отчета в памяти не собираются.
+    В NDJSON первая строка - поля документа без итераторов, далее по строке
+    на элемент с полем record, указывающим путь к списку."""
+    
+    FORMATS = ('json', 'ndjson')
+    
+    def __init__(self, file_path: str, fmt: str = 'json', indent: int = 2,
+                 buffer_size: int = 1 << 20):
+        if fmt not in self.FORMATS:
+            raise ValueError(f"Unsupported report format: {fmt}")
+        self.file_path = file_path
+        self.fmt = fmt
+        self.indent = indent
+        self.buffer_size = buffer_size
+        self.items_written = 0
+        self._encode = json.JSONEncoder(indent=indent, ensure_ascii=False).encode
+    
+    @staticmethod
+    def report_path(base_path: str, fmt: str) -> str:
+        return f"{base_path}.{'ndjson' if fmt == 'ndjson' else 'json'}"
+    
+    @staticmethod
+    def _is_stream(value) -> bool:
+        return hasattr(value, '__next__')
+    
+    def _has_streams(self, value) -> bool:
+        return isinstance(value, dict) and any(
+            self._is_stream(item) or self._has_streams(item) for item in value.values())
+    
+    def write(self, document: Dict) -> str:
+        with open(self.file_path, 'w', encoding='utf-8', buffering=self.buffer_size) as f:
+            if self.fmt == 'ndjson':
+                self._write_ndjson(f, document)
+            else:
+                self._write_value(f, document, 0)
+        return self.file_path
+    
+    def _dumps(self, value, level: int) -> str:
+        text = self._encode(value)
+        if level and '\n' in text:
+            text = text.replace('\n', '\n' + ' ' * (self.indent * level))
+        return text
+    
+    def _write_value(self, f, value, level: int):
+        pad = ' ' * (self.indent * (level + 1))
+        if self._has_streams(value):
+            f.write('{')
+            for i, (key, item) in enumerate(value.items()):
+                f.write(('\n' if i == 0 else ',\n') + pad + json.dumps(key, ensure_ascii=False) + ': ')
+                self._write_value(f, item, level + 1)
+            f.write('\n' + ' ' * (self.indent * level) + '}')
+        elif self._is_stream(value):
+            empty = True
+            for item in value:
+                f.write(('[\n' if empty else ',\n') + pad + self._dumps(item, level + 1))
+                empty = False
+                self.items_written += 1
+            f.write('[]' if empty else '\n' + ' ' * (self.indent * level) + ']')
+        else:
+            f.write(self._dumps(value, level))
+    
+    def _split_streams(self, document: Dict, prefix: str, streams: List) -> Dict:
+        header = {}
+        for key, value in document.items():
+            path = f"{prefix}{key}"
+            if self._is_stream(value):
+                streams.append((path, value))
+            elif self._has_streams(value):
+                header[key] = self._split_streams(value, f"{path}.", streams)
+            else:
+                header[key] = value
+        return header
+    
+    def _write_ndjson(self, f, document: Dict):
+        streams = []
+        header = self._split_streams(document, '', streams)
+        encode = json.JSONEncoder(ensure_ascii=False, separators=(',', ':')).encode
+        f.write(encode({'record': 'header', **header}) + '\n')
+        for path, stream in streams:
+            for item in stream:
+                record = {'record': path, **item} if isinstance(item, dict) else {'record': path, 'value': item}
+                f.write(encode(record) + '\n')
+                self.items_written += 1
+
+# Контрольные точки для инкрементального анализа растущих файлов
+class AnalysisCheckpoint:
+    """Позиция чтения и сериализованное состояние статистики и детекторов.
+    Файл считается тем же, если совпадают устройство, inode и начало
+    файла; иначе (ротация, перезапись) анализ начинается заново.
+    Состояние подписано HMAC-SHA256 ключом из key_file (0600, создается
+    при первом запуске): неподписанная или измененная точка не
+    десериализуется. Вместо SHA-256 всего файла ведется цепочка дайджестов
+    по дописанным частям: повторно читаются только новые байты."""
+    
+    VERSION = 3
+    MAGIC = b'NACP\x02'
+    HEAD_SIZE = 4096
+    DIGEST_LABEL = 'sha256-chain:'
+    DEFAULT_KEY_FILE = os.path.join(os.path.expanduser('~'), '.net-analyz', 'checkpoint.key')
+    
+    def __init__(self, checkpoint_file: str, file_path: str, key_file: Optional[str] = None):
+        self.checkpoint_file = checkpoint_file
+        self.file_path = file_path
+        self.key_file = key_file or self.DEFAULT_KEY_FILE
+        self._key = None
+    
+    def _head_hash(self, length: int) -> str:
+        with open(self.file_path, 'rb') as f:
+            return hashlib.sha256(f.read(length)).hexdigest()
+    
+    @property
+    def key(self) -> bytes:
+        """Ключ подписи; при одновременном создании побеждает первый os.link"""
+        if self._key is None:
+            if not os.path.exists(self.key_file):
+                directory = os.path.dirname(os.path.abspath(self.key_file))
+                os.makedirs(directory, mode=0o700, exist_ok=True)
+                fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.checkpoint-key-')
+                try:
+                    with os.fdopen(fd, 'wb') as f:
+                        f.write(os.urandom(32))
+                    os.link(tmp_path, self.key_file)
+                except FileExistsError:
+                    pass
+                finally:
+                    os.remove(tmp_path)
+            with open(self.key_file, 'rb') as f:
+                self._key = f.read()
+        return self._key
+    
+    def _sign(self, payload: bytes) -> bytes:
+        return hmac.new(self.key, self.MAGIC + payload, hashlib.sha256).digest()
+    
+    def load(self) -> Optional[Dict]:
+        if not os.path.exists(self.checkpoint_file):
+            return None
+        try:
+            with open(self.checkpoint_file, 'rb') as f:
+                data = f.read()
+            magic, signature, payload = data[:len(self.MAGIC)], data[len(self.MAGIC):len(self.MAGIC) + 32], \
+                data[len(self.MAGIC) + 32:]
+            if magic != self.MAGIC or not hmac.compare_digest(signature, self._sign(payload)):
+                raise ValueError("missing or invalid signature")
+            state = pickle.loads(payload)
+        except Exception as e:
+            logging.error(f"Cannot read checkpoint {self.checkpoint_file}: {e}")
+            return None
+        
+        file_stat = os.stat(self.file_path)
+        if (state.get('version') != self.VERSION or
+                (state['device'], state['inode']) != (file_stat.st_dev, file_stat.st_ino) or
+                file_stat.st_size < state['offset'] or
+                self._head_hash(state['head_size']) != state['head_hash']):
+            logging.info(f"Capture {self.file_path} was rotated or rewritten, starting over")
+            return None
+        return state
+    
+    def chain_digest(self, state: Optional[Dict]) -> Tuple[str, int]:
+        """(цепочка, число хешированных байт): SHA-256 от значения из точки
+        и байт, дописанных после нее. Это не SHA-256 файла - значение зависит
+        от того, какими частями файл дочитывался; без точки совпадает с ним"""
+        digest = hashlib.sha256()
+        hashed_size = 0
+        if state:
+            digest.update(state['chain_digest'].encode())
+            hashed_size = state['hashed_size']
+        with open(self.file_path, 'rb') as f:
+            f.seek(hashed_size)
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+                hashed_size += len(chunk)
+        return digest.hexdigest(), hashed_size
+    
+    def save(self, offset: int, section: Optional[Tuple], stats: Dict, detectors: List,
+             chain_digest: Tuple[str, int], sightings: List[List]):
+        file_stat = os.stat(self.file_path)
+        head_size = min(file_stat.st_size, self.HEAD_SIZE)
+        state = {
+            'version': self.VERSION,
+            'file_path': self.file_path,
+            'device': file_stat.st_dev,
+            'inode': file_stat.st_ino,
+            'head_size': head_size,
+            'head_hash': self._head_hash(head_size),
+            'offset': offset,
+            'section': section,
+            'chain_digest': chain_digest[0],
+            'hashed_size': chain_digest[1],
+            'stats': stats,
+            'detectors': detectors,
+            'sightings': sightings,
+            'saved_at': datetime.now()
+        }
+        payload = pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+        # Атомарная замена: прерванная запись не портит предыдущую точку
+        tmp_file = f"{self.checkpoint_file}.tmp"
+        with open(tmp_file, 'wb') as f:
+            f.write(self.MAGIC + self._sign(payload) + payload)
+        os.replace(tmp_file, self.checkpoint_file)
+
+# Быстрый отпечаток файла захвата и кеш результатов анализа по нему
+class AnalysisResultCache:
+    """Результаты хранятся в cache_dir в JSON под ключом BLAKE2b отпечатка
+    содержимого, параметров анализа, конфигурации и версии фида IOC. Полный отпечаток читает файл
+    через mmap блоками; выборочный (sampled) хеширует размер и
+    SAMPLE_COUNT блоков по SAMPLE_SIZE байт - быстрее, но не заметит
+    правку вне выборки. Для неизменного файла (путь, размер, mtime, inode)
+    отпечаток берется из индекса без чтения. Старые записи вытесняются,
+    когда общий размер кеша превышает max_size_mb."""
+    
+    CHUNK_SIZE = 8 * 1024 * 1024
+    SAMPLE_SIZE = 1024 * 1024
+    SAMPLE_COUNT = 16
+    INDEX_LIMIT = 10000
+    
+    def __init__(self, cache_dir: str, max_size_mb: float = 1024, sampled: bool = False):
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.sampled = sampled
+        self.index_file = os.path.join(cache_dir, 'index.json')
+        os.makedirs(cache_dir, exist_ok=True)
+        try:
+            with open(self.index_file, 'r') as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = {}
+    
+    @classmethod
+    def compute_fingerprint(cls, file_path: str, sampled: bool = False) -> str:
+        digest = hashlib.blake2b(digest_size=20)
+        size = os.path.getsize(file_path)
+        digest.update(f"{size}:{'sampled' if sampled else 'full'}".encode())
+        if not size:
+            return digest.hexdigest()
+        
+        with open(file_path, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            view = memoryview(mm)
+            try:
+                if sampled and size > cls.SAMPLE_SIZE * cls.SAMPLE_COUNT:
+                    step = (size - cls.SAMPLE_SIZE) // (cls.SAMPLE_COUNT - 1)
+                    for i in range(cls.SAMPLE_COUNT):
+                        digest.update(view[i * step:i * step + cls.SAMPLE_SIZE])
+                else:
+                    for offset in range(0, size, cls.CHUNK_SIZE):
+                        digest.update(view[offset:offset + cls.CHUNK_SIZE])
+            finally:
+                view.release()
+        return digest.hexdigest()
+    
+    def fingerprint(self, file_path: str) -> str:
+        """Отпечаток с быстрым путем по размеру/mtime/inode"""
+        path = os.path.abspath(file_path)
+        file_stat = os.stat(path)
+        identity = [file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino, self.sampled]
+        entry = self.index.get(path)
+        if entry and entry[:4] == identity:
+            return entry[4]
+        
+        fingerprint = self.compute_fingerprint(path, self.sampled)
+        self.index.pop(path, None)
+        self.index[path] = identity + [fingerprint]
+        while len(self.index) > self.INDEX_LIMIT:
+            self.index.pop(next(iter(self.index)))
+        self._write_index()
+        return fingerprint
+    
+    def _write_index(self):
+        tmp_file = f"{self.index_file}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp_file, self.index_file)
+    
+    @staticmethod
+    def result_key(fingerprint: str, options: Dict) -> str:
+        """Ключ учитывает параметры анализа: от них зависит результат"""
+        options_text = json.dumps(options, sort_keys=True)
+        return hashlib.blake2b(f"{fingerprint}:{options_text}".encode(), digest_size=20).hexdigest()
+    
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.result.json")
+    
+    @classmethod
+    def _encode(cls, value):
+        """Приведение результата к JSON: сводки, Counter и время помечаются тегами"""
+        if isinstance(value, SpaceSavingCounter):
+            return {'__sketch__': value.to_state()}
+        if isinstance(value, Counter):
+            return {'__counter__': [[item, count] for item, count in value.items()]}
+        if isinstance(value, datetime):
+            return {'__datetime__': value.isoformat()}
+        if isinstance(value, timedelta):
+            return {'__timedelta__': value.total_seconds()}
+        if isinstance(value, dict):
+            return {key: cls._encode(item) for key, item in value.items()}
+        if isinstance(value, (list, tuple, set)):
+            return [cls._encode(item) for item in value]
+        return value
+    
+    @staticmethod
+    def _decode(obj: Dict):
+        if len(obj) == 1:
+            if '__sketch__' in obj:
+                return SpaceSavingCounter.from_state(obj['__sketch__'])
+            if '__counter__' in obj:
+                return Counter({item: count for item, count in obj['__counter__']})
+            if '__datetime__' in obj:
+                return datetime.fromisoformat(obj['__datetime__'])
+            if '__timedelta__' in obj:
+                return timedelta(seconds=obj['__timedelta__'])
+        return obj
+    
+    def get(self, key: str) -> Optional[Dict]:
+        entry_path = self._entry_path(key)
+        try:
+            with open(entry_path, 'r') as f:
+                result = json.load(f, object_hook=self._decode)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.warning(f"Discarding unreadable cache entry {entry_path}: {e}")
+            os.remove(entry_path)
+            return None
+        os.utime(entry_path)  # Отметка использования для вытеснения LRU
+        return result
+    
+    def put(self, key: str, result: Dict):
+        entry_path = self._entry_path(key)
+        tmp_file = f"{entry_path}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(self._encode(result), f, separators=(',', ':'))
+        os.replace(tmp_file, entry_path)
+        self.evict()
+    
+    def evict(self):
+        """Удаление давно неиспользованных записей сверх лимита размера"""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            # .result - записи прежнего формата, они только вытесняются
+            if name.endswith(('.result.json', '.result')):
+                entry_stat = os.stat(os.path.join(self.cache_dir, name))
+                entries.append((entry_stat.st_mtime, entry_stat.st_size, name))
+        
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+            os.remove(os.path.join(self.cache_dir, name))
+            total -= size
+
+# История анализов в SQLite: нормализованная схема с индексами
+class CaptureHistoryStore:
+    """Захваты, IP, домены и угрозы в отдельных таблицах. Запись одного
+    захвата - одна транзакция в режиме WAL с пакетными executemany;
+    запросы "какие захваты контактировали с X" идут по индексам.
+    Захват определяется путем, устройством и inode: повторный анализ
+    дописанного файла заменяет строку, ротация дает новую. Со сводками
+    (--sketch-capacity) сохраняются только top-K IP и доменов, и запросы
+    по редким адресам не находят такие захваты."""
+    
+    CAPTURES_TABLE = """
+        CREATE TABLE IF NOT EXISTS captures (
+            id INTEGER PRIMARY KEY,
+            file_path TEXT NOT NULL,
+            device INTEGER,
+            inode INTEGER,
+            file_hash TEXT NOT NULL,
+            captured_at TEXT,
+            analyzed_at TEXT NOT NULL,
+            total_packets INTEGER,
+            threat_count INTEGER
+        );
+"""
+    SCHEMA = CAPTURES_TABLE + """
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_captures_identity ON captures(file_path, device, inode);
+        CREATE INDEX IF NOT EXISTS idx_captures_captured_at ON captures(captured_at);
+        
+        CREATE TABLE IF NOT EXISTS ips (
+            id INTEGER PRIMARY KEY,
+            ip TEXT NOT NULL UNIQUE
+        );
+        CREATE TABLE IF NOT EXISTS capture_ips (
+            ip_id INTEGER NOT NULL REFERENCES ips(id),
+            capture_id INTEGER NOT NULL REFERENCES captures(id) ON DELETE CASCADE,
+            packets INTEGER NOT NULL,
+            PRIMARY KEY (ip_id, capture_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_capture_ips_capture ON capture_ips(capture_id);
+        
+        CREATE TABLE IF NOT EXISTS domains (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE,
+            reversed_name TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_domains_reversed ON domains(reversed_name);
+        CREATE TABLE IF NOT EXISTS capture_domains (
+            domain_id INTEGER NOT NULL REFERENCES domains(id),
+            capture_id INTEGER NOT NULL REFERENCES captures(id) ON DELETE CASCADE,
+            queries INTEGER NOT NULL,
+            PRIMARY KEY (domain_id, capture_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_capture_domains_capture ON capture_domains(capture_id);
+        
+        CREATE TABLE IF NOT EXISTS threats (
+            id INTEGER PRIMARY KEY,
+            capture_id INTEGER NOT NULL REFERENCES captures(id) ON DELETE CASCADE,
+            type TEXT NOT NULL,
+            severity TEXT,
+            indicator TEXT,
+            occurrences INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_threats_capture ON threats(capture_id);
+        CREATE INDEX IF NOT EXISTS idx_threats_indicator ON threats(indicator);
+        CREATE INDEX IF NOT EXISTS idx_threats_type ON threats(type);
+    """
+    
+    def __init__(self, db_path: str = "weframe_history.db"):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self._migrate()
+        self.conn.execute("PRAGMA foreign_keys=ON")
+        self.conn.executescript(self.SCHEMA)
+    
+    def _migrate(self):
+        """Таблица captures прежней версии (UNIQUE file_hash, без inode) пересоздается;
+        внешние ключи при этом выключены, чтобы DROP не удалил связанные строки"""
+        columns = {row['name'] for row in self.conn.execute("PRAGMA table_info(captures)")}
+        if not columns or 'inode' in columns:
+            return
+        with self.conn:
+            self.conn.execute("DROP INDEX IF EXISTS idx_captures_captured_at")
+            self.conn.execute(self.CAPTURES_TABLE.replace('captures (', 'captures_new (', 1))
+            self.conn.execute(
+                """INSERT INTO captures_new (id, file_path, file_hash, captured_at, analyzed_at,
+                                             total_packets, threat_count)
+                   SELECT id, file_path, file_hash, captured_at, analyzed_at, total_packets, threat_count
+                   FROM captures""")
+            self.conn.execute("DROP TABLE captures")
+            self.conn.execute("ALTER TABLE captures_new RENAME TO captures")
+    
+    @staticmethod
+    def _reverse_domain(name: str) -> str:
+        return '.'.join(reversed(name.split('.')))
+    
+    @staticmethod
+    def _threat_indicator(threat: Dict) -> Optional[str]:
+        for key in ('ip', 'domain', 'source_ip', 'port'):
+            if key in threat:
+                return str(threat[key])
+        return None
+    
+    def record_capture(self, file_path: str, file_hash: str, stats: Dict,
+                       ip_counter, dns_counter) -> int:
+        """Сохранение захвата; повторный анализ того же файла заменяет запись"""
+        if isinstance(ip_counter, SpaceSavingCounter):
+            logging.warning(f"History of {file_path} keeps only the top {ip_counter.capacity} IPs "
+                            f"and domains (sketch mode)")
+        threats = Counter(
+            (t.get('type', 'UNKNOWN'), t.get('severity'), self._threat_indicator(t))
+            for t in stats['threats_found']
+        )
+        ip_counts = list(ip_counter.most_common())
+        domain_counts = [(name.lower().rstrip('.'), count) for name, count in dns_counter.most_common()]
+        file_path = os.path.abspath(file_path)
+        device = inode = captured_at = None
+        if os.path.exists(file_path):
+            file_stat = os.stat(file_path)
+            device, inode = file_stat.st_dev, file_stat.st_ino
+            captured_at = datetime.fromtimestamp(file_stat.st_mtime).isoformat()
         
-        return exfiltration_signs
+        with self.conn:
+            # Дописанный файл сохраняет путь и inode, меняется только хеш
+            self.conn.execute("DELETE FROM captures WHERE file_path = ? AND device IS ? AND inode IS ?",
+                              (file_path, device, inode))
+            capture_id = self.conn.execute(
+                """INSERT INTO captures (file_path, device, inode, file_hash, captured_at, analyzed_at,
+                                         total_packets, threat_count)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                (file_path, device, inode, file_hash, captured_at, datetime.now().isoformat(),
+                 stats['total_packets'], len(stats['threats_found']))
+            ).lastrowid
+            
+            self.conn.executemany("INSERT OR IGNORE INTO ips (ip) VALUES (?)",
+                                  ((ip,) for ip, _ in ip_counts))
+            self.conn.executemany(
+                "INSERT INTO capture_ips (ip_id, capture_id, packets) SELECT id, ?, ? FROM ips WHERE ip = ?",
+                ((capture_id, count, ip) for ip, count in ip_counts))
+            
+            self.conn.executemany("INSERT OR IGNORE INTO domains (name, reversed_name) VALUES (?, ?)",
+                                  ((name, self._reverse_domain(name)) for name, _ in domain_counts))
+            self.conn.executemany(
+                """INSERT INTO capture_domains (domain_id, capture_id, queries)
+                   SELECT id, ?, ? FROM domains WHERE name = ?
+                   ON CONFLICT (domain_id, capture_id) DO UPDATE SET queries = queries + excluded.queries""",
+                ((capture_id, count, name) for name, count in domain_counts))
+            
+            self.conn.executemany(
+                "INSERT INTO threats (capture_id, type, severity, indicator, occurrences) VALUES (?, ?, ?, ?, ?)",
+                ((capture_id, threat_type, severity, indicator, count)
+                 for (threat_type, severity, indicator), count in threats.items()))
+        return capture_id
+    
+    def _since_clause(self, since: Optional[datetime]) -> Tuple[str, tuple]:
+        if since is None:
+            return '', ()
+        return ' AND c.captured_at >= ?', (since.isoformat(),)
+    
+    def captures_for_ip(self, ip: str, since: Optional[datetime] = None) -> List[Dict]:
+        """Захваты, в которых встречался IP адрес"""
+        clause, params = self._since_clause(since)
+        rows = self.conn.execute(
+            f"""SELECT c.file_path, c.file_hash, c.captured_at, c.analyzed_at, ci.packets AS hits
+                FROM ips i
+                JOIN capture_ips ci ON ci.ip_id = i.id
+                JOIN captures c ON c.id = ci.capture_id
+                WHERE i.ip = ?{clause}
+                ORDER BY c.captured_at DESC""",
+            (ip,) + params)
+        return [dict(row) for row in rows]
+    
+    def captures_for_domain(self, domain: str, since: Optional[datetime] = None,
+                            include_subdomains: bool = True) -> List[Dict]:
+        """Захваты с DNS запросами к домену (и его поддоменам)"""
+        name = domain.lower().rstrip('.')
+        reversed_name = self._reverse_domain(name)
+        clause, params = self._since_clause(since)
+        domain_clause = "d.reversed_name = ?"
+        domain_params = (reversed_name,)
+        if include_subdomains:
+            # Диапазон по обращенному имени использует индекс, в отличие от LIKE '%.domain'
+            domain_clause = "(d.reversed_name = ? OR (d.reversed_name >= ? AND d.reversed_name < ?))"
+            domain_params = (reversed_name, reversed_name + '.', reversed_name + '/')
+        rows = self.conn.execute(
+            f"""SELECT c.file_path, c.file_hash, c.captured_at, c.analyzed_at,
+                       SUM(cd.queries) AS hits
+                FROM domains d
+                JOIN capture_domains cd ON cd.domain_id = d.id
+                JOIN captures c ON c.id = cd.capture_id
+                WHERE {domain_clause}{clause}
+                GROUP BY c.id
+                ORDER BY c.captured_at DESC""",
+            domain_params + params)
+        return [dict(row) for row in rows]
+    
+    def threats_for_indicator(self, indicator: str, since: Optional[datetime] = None) -> List[Dict]:
+        """Угрозы по индикатору (IP, домен, порт) во всех захватах"""
+        clause, params = self._since_clause(since)
+        rows = self.conn.execute(
+            f"""SELECT c.file_path, c.captured_at, t.type, t.severity, t.occurrences AS hits
+                FROM threats t
+                JOIN captures c ON c.id = t.capture_id
+                WHERE t.indicator = ?{clause}
+                ORDER BY c.captured_at DESC""",
+            (indicator,) + params)
+        return [dict(row) for row in rows]
+    
+    def close(self):
+        self.conn.close()
 
-# Система отчетов в форматах STIX/TAXII
-class STIXReportGenerator:
-    def __init__(self):
-        self.stix_version = "2.1"
+# Инструментирование стадий конвейера и экспорт метрик
+class PipelineMetrics:
+    """Суммарное время и число вызовов по стадиям, счетчики и память процесса.
+    Стадии могут быть вложенными (ioc_lookup входит в threat_analysis).
+    Счетчики: packets, threats, ioc_hits, enrichment_queued, enrichment_dropped.
+    Объект создается только при включенных метриках, поэтому без них горячий
+    путь не меняется. Файл перезаписывается атомарно не чаще раза в interval
+    секунд: JSON или текстовый формат Prometheus (для textfile collector)."""
     
-    def generate_stix_bundle(self, threats: List[Dict], metadata: Dict) -> Dict:
-        """Генерация отчета в формате STIX 2.1"""
-        bundle = {
-            "type": "bundle",
-            "id": f"bundle--{hashlib.md5(str(datetime.now()).encode()).hexdigest()}",
-            "spec_version": self.stix_version,
-            "objects": []
+    FORMATS = ('json', 'prometheus')
+    PREFIX = 'netanalyz'
+    
+    def __init__(self, output_file: Optional[str] = None, fmt: Optional[str] = None,
+                 interval: float = 30.0):
+        if fmt is None:
+            fmt = 'prometheus' if output_file and output_file.endswith('.prom') else 'json'
+        if fmt not in self.FORMATS:
+            raise ValueError(f"Unknown metrics format: {fmt}")
+        self.output_file = output_file
+        self.format = fmt
+        self.interval = interval
+        self.seconds = defaultdict(float)
+        self.calls = Counter()
+        self.counters = Counter()
+        self.started = time.time()
+        self.rss_mb = 0.0
+        self.peak_rss_mb = 0.0
+        self._last_export = time.monotonic()
+    
+    def add(self, stage: str, seconds: float, calls: int = 1):
+        self.seconds[stage] += seconds
+        self.calls[stage] += calls
+    
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+    
+    def timed_iter(self, name: str, iterable):
+        """Замер получения каждого элемента (декодирование пакетов)"""
+        iterator = iter(iterable)
+        perf_counter = time.perf_counter
+        seconds, calls = self.seconds, self.calls
+        while True:
+            started = perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                seconds[name] += perf_counter() - started
+                return
+            seconds[name] += perf_counter() - started
+            calls[name] += 1
+            yield item
+    
+    def instrument(self, obj, stage: str, *methods: str, hits: Optional[str] = None):
+        """Замер методов конкретного объекта; класс не меняется. С hits
+        результат (найдено, данные) увеличивает счетчик hits при совпадении."""
+        counters = self.counters
+        for name in methods:
+            method = getattr(obj, name)
+            
+            def timed(*args, _method=method, **kwargs):
+                started = time.perf_counter()
+                try:
+                    result = _method(*args, **kwargs)
+                finally:
+                    self.add(stage, time.perf_counter() - started)
+                if hits and result[0]:
+                    counters[hits] += 1
+                return result
+            setattr(obj, name, timed)
+    
+    def reset(self):
+        self.seconds.clear()
+        self.calls.clear()
+        self.counters.clear()
+    
+    def sample_memory(self):
+        self.rss_mb = _current_rss_mb()
+        self.peak_rss_mb = max(self.peak_rss_mb, _peak_rss_mb())
+    
+    def merge(self, snapshot: Dict):
+        """Добавление снимка другого процесса (шарда)"""
+        for name, stage in snapshot['stages'].items():
+            self.add(name, stage['seconds'], stage['calls'])
+        self.counters.update(snapshot['counters'])
+        self.peak_rss_mb = max(self.peak_rss_mb, snapshot['memory']['peak_rss_mb'])
+    
+    def snapshot(self) -> Dict:
+        return {
+            'timestamp': datetime.now().isoformat(),
+            'uptime_seconds': round(time.time() - self.started, 3),
+            'stages': {name: {'seconds': round(self.seconds[name], 6), 'calls': self.calls[name]}
+                       for name in sorted(self.seconds, key=self.seconds.get, reverse=True)},
+            'counters': dict(self.counters),
+            'memory': {'rss_mb': round(self.rss_mb, 1), 'peak_rss_mb': round(self.peak_rss_mb, 1)}
         }
+    
+    def to_prometheus(self) -> str:
+        prefix = self.PREFIX
         
-        for threat in threats:
-            # Создание объекта Indicator для каждой угрозы
-            indicator = {
-                "type": "indicator",
-                "id": f"indicator--{hashlib.md5(str(threat).encode()).hexdigest()}",
-                "created": datetime.now().isoformat(),
-                "modified": datetime.now().isoformat(),
-                "pattern": self._create_stix_pattern(threat),
-                "pattern_type": "stix",
-                "valid_from": datetime.now().isoformat(),
-                "labels": ["malicious-activity"],
-                "name": f"Threat: {threat.get('type', 'Unknown')}",
-                "description": f"Detected threat: {threat}"
-            }
-            bundle["objects"].append(indicator)
+        def label(value: str) -> str:
+            return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
         
-        return bundle
+        lines = [f"# HELP {prefix}_stage_seconds_total Time spent in each pipeline stage.",
+                 f"# TYPE {prefix}_stage_seconds_total counter"]
+        lines += [f'{prefix}_stage_seconds_total{{stage="{label(name)}"}} {seconds:.6f}'
+                  for name, seconds in self.seconds.items()]
+        lines += [f"# HELP {prefix}_stage_calls_total Calls of each pipeline stage.",
+                  f"# TYPE {prefix}_stage_calls_total counter"]
+        lines += [f'{prefix}_stage_calls_total{{stage="{label(name)}"}} {calls}'
+                  for name, calls in self.calls.items()]
+        for name, value in self.counters.items():
+            lines += [f"# TYPE {prefix}_{name}_total counter", f"{prefix}_{name}_total {value}"]
+        lines += [f"# TYPE {prefix}_memory_rss_bytes gauge",
+                  f"{prefix}_memory_rss_bytes {int(self.rss_mb * 1024 * 1024)}",
+                  f"# TYPE {prefix}_memory_peak_rss_bytes gauge",
+                  f"{prefix}_memory_peak_rss_bytes {int(self.peak_rss_mb * 1024 * 1024)}",
+                  f"# TYPE {prefix}_uptime_seconds gauge",
+                  f"{prefix}_uptime_seconds {time.time() - self.started:.3f}"]
+        return '\n'.join(lines) + '\n'
     
-    def _create_stix_pattern(self, threat: Dict) -> str:
-        """Создание STIX паттерна для угрозы"""
-        if 'ip' in threat:
-            return f"[ipv4-addr:value = '{threat['ip']}']"
-        elif 'domain' in threat:
-            return f"[domain-name:value = '{threat['domain']}']"
-        else:
-            return "[threat:value = 'unknown']"
+    def maybe_export(self):
+        if self.output_file and time.monotonic() - self._last_export >= self.interval:
+            self.export()
+    
+    def export(self):
+        """Запись файла метрик через временный файл и переименование"""
+        self._last_export = time.monotonic()
+        self.sample_memory()
+        if not self.output_file:
+            return
+        tmp_path = f"{self.output_file}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                if self.format == 'prometheus':
+                    f.write(self.to_prometheus())
+                else:
+                    json.dump(self.snapshot(), f, indent=2)
+            os.replace(tmp_path, self.output_file)
+        except OSError as e:
+            logging.error(f"Error writing metrics file: {e}")
+    
+    def print_summary(self):
+        print("\nSTAGE TIMINGS:")
+        for name, stage in self.snapshot()['stages'].items():
+            per_call = stage['seconds'] / stage['calls'] * 1e6 if stage['calls'] else 0
+            print(f"  {name:<36} {stage['seconds']:>10.3f}s {stage['calls']:>10} calls "
+                  f"{per_call:>9.2f} us/call")
+        for name, value in sorted(self.counters.items()):
+            print(f"  {name:<36} {value:>10}")
+        print(f"  Peak RSS: {self.peak_rss_mb:.1f} MB")
+
+# Базовый анализатор захватов: статистика, отчет и сохранение результатов в SQLite
+class EnterpriseNetworkAnalyzer:
+    """Списки ip_addresses/dns_requests/protocols в self.stats могут быть заменены
+    на Counter или SpaceSavingCounter (сводки, параллельный режим), поэтому отчеты
+    читают их только через stat_counter. База задается в [DATABASE]: db_path."""
+    
+    REPORT_TOP_N = 100
+    
+    def __init__(self, config_file: str = "enterprise_config.ini"):
+        self.config = EnterpriseConfig(config_file)
+        self.threat_analyzer = ThreatAnalyzer(self.config)
+        self.db_path = self.config.get_database_settings().get('db_path', 'enterprise_analysis.db')
+        self.stats = {
+            'total_packets': 0,
+            'ip_addresses': [],
+            'dns_requests': [],
+            'protocols': [],
+            'threats_found': [],
+            'suspicious_activities': []
+        }
+    
+    def is_local_ip(self, ip: str) -> bool:
+        return _is_private_ip(ip)
+    
+    def stat_counter(self, key: str):
+        """Счетчик для отчета: сводка, Counter или список значений"""
+        value = self.stats[key]
+        if isinstance(value, (Counter, SpaceSavingCounter)):
+            return value
+        return Counter(value)
+    
+    @staticmethod
+    def calculate_file_hash(file_path: str) -> str:
+        """SHA-256 файла потоковым чтением"""
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+    
+    @staticmethod
+    def get_protocol_name(packet) -> str:
+        return packet.highest_layer
+    
+    def create_comprehensive_report(self, file_path: str, file_hash: str) -> Dict:
+        """Полный отчет: сводка, top-N счетчиков, угрозы и подозрительная активность"""
+        threats = self.stats['threats_found']
+        return {
+            'metadata': {
+                'file_path': file_path,
+                'file_hash': file_hash,
+                'generated_at': datetime.now().isoformat()
+            },
+            'summary': {
+                'total_packets': self.stats['total_packets'],
+                'threats_found': len(threats),
+                'suspicious_activities': len(self.stats['suspicious_activities']),
+                'threats_by_type': dict(Counter(t.get('type', 'UNKNOWN') for t in threats)),
+                'threats_by_severity': dict(Counter(t.get('severity', 'UNKNOWN') for t in threats))
+            },
+            'top_external_ips': self.stat_counter('ip_addresses').most_common(self.REPORT_TOP_N),
+            'top_dns_requests': self.stat_counter('dns_requests').most_common(self.REPORT_TOP_N),
+            'protocols': self.stat_counter('protocols').most_common(self.REPORT_TOP_N),
+            'threats': threats,
+            'suspicious_activities': self.stats['suspicious_activities']
+        }
+    
+    def save_to_database(self, file_path: str, file_hash: str):
+        """Сводка анализа и найденные угрозы в SQLite"""
+        threats = self.stats['threats_found']
+        try:
+            conn = sqlite3.connect(self.db_path)
+            try:
+                with conn:
+                    conn.executescript("""
+                        CREATE TABLE IF NOT EXISTS analyses (
+                            id INTEGER PRIMARY KEY,
+                            file_path TEXT NOT NULL,
+                            file_hash TEXT NOT NULL,
+                            analyzed_at TEXT NOT NULL,
+                            total_packets INTEGER,
+                            threat_count INTEGER,
+                            suspicious_count INTEGER,
+                            top_ips TEXT,
+                            top_domains TEXT
+                        );
+                        CREATE TABLE IF NOT EXISTS analysis_threats (
+                            analysis_id INTEGER NOT NULL REFERENCES analyses(id),
+                            type TEXT,
+                            severity TEXT,
+                            details TEXT
+                        );
+                    """)
+                    cursor = conn.execute(
+                        """INSERT INTO analyses (file_path, file_hash, analyzed_at, total_packets,
+                                                 threat_count, suspicious_count, top_ips, top_domains)
+                           VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                        (file_path, file_hash, datetime.now().isoformat(), self.stats['total_packets'],
+                         len(threats), len(self.stats['suspicious_activities']),
+                         json.dumps(self.stat_counter('ip_addresses').most_common(self.REPORT_TOP_N)),
+                         json.dumps(self.stat_counter('dns_requests').most_common(self.REPORT_TOP_N))))
+                    conn.executemany(
+                        "INSERT INTO analysis_threats (analysis_id, type, severity, details) VALUES (?, ?, ?, ?)",
+                        ((cursor.lastrowid, t.get('type'), t.get('severity'), json.dumps(t, default=str))
+                         for t in threats))
+            finally:
+                conn.close()
+            logging.info(f"Analysis saved to database: {self.db_path}")
+        except sqlite3.Error as e:
+            logging.error(f"Database error: {e}")
 
 # Расширенный класс основного анализатора
 class AdvancedEnterpriseNetworkAnalyzer(EnterpriseNetworkAnalyzer):
+    SKETCH_STATS = ('ip_addresses', 'dns_requests', 'protocols')
+    STREAM_LIST_THRESHOLD = 1000
+    
     def __init__(self, config_file: str = "enterprise_config.ini"):
         super().__init__(config_file)
         self.advanced_threat_analyzer = AdvancedThreatAnalyzer(self.config)
         self.quarantine_system = QuarantineSystem(self.config)
         self.stix_generator = STIXReportGenerator()
+        self.siem_exporter = SIEMExporter(self.config)
+        self.alert_pipeline = AlertPipeline(self.config)
         self.performance_stats = {
             'analysis_start_time': None,
             'analysis_end_time': None,
             'packets_per_second': 0,
             'memory_usage': 0
         }
+        self.sketch_capacity = 0
+        self.history_store = None
+        self.report_format = 'json'
+        self.stix_per_threat = False
+        self.metrics = None
+    
+    def enable_metrics(self, output_file: Optional[str] = None, fmt: Optional[str] = None,
+                       interval: float = 30.0) -> PipelineMetrics:
+        """Замер стадий конвейера; методы оборачиваются только у этого экземпляра"""
+        metrics = self.metrics = PipelineMetrics(output_file, fmt, interval)
+        metrics.instrument(self.threat_analyzer, 'threat_analysis', 'analyze_packet_threats')
+        metrics.instrument(self, 'packet_stats', 'collect_packet_stats')
+        for owner in (self.threat_analyzer, self.advanced_threat_analyzer):
+            for value in list(vars(owner).values()):
+                if isinstance(value, IOCManager):
+                    metrics.instrument(value, 'ioc_lookup', 'check_ip', 'check_domain', 'check_hash',
+                                       hits='ioc_hits')
+        return metrics
+    
+    def timed(self, stage: str):
+        """Замер участка, если метрики включены"""
+        return self.metrics.stage(stage) if self.metrics else contextlib.nullcontext()
+    
+    def finish_performance_stats(self, packets: int):
+        """Время, скорость и пиковая память по завершении анализа"""
+        self.performance_stats['analysis_end_time'] = datetime.now()
+        duration = (self.performance_stats['analysis_end_time'] -
+                    self.performance_stats['analysis_start_time']).total_seconds()
+        self.performance_stats['packets_per_second'] = packets / duration if duration > 0 else 0
+        self.performance_stats['memory_usage'] = round(_peak_rss_mb(), 1)
+        if self.metrics:
+            self.metrics.sample_memory()
+            self.performance_stats['memory_usage'] = round(self.metrics.peak_rss_mb, 1)
+            self.performance_stats['stages'] = self.metrics.snapshot()['stages']
+    
+    def enable_sketches(self, capacity: int):
+        """Замена списков IP/DNS/протоколов на Space-Saving сводки (top-N с ограниченной памятью)"""
+        self.sketch_capacity = capacity
+        for key in self.SKETCH_STATS:
+            self.stats[key] = SpaceSavingCounter(capacity)
+    
+    def aggregate_stats(self):
+        """Замена списков IP/DNS/протоколов точными счетчиками; сводки остаются"""
+        for key in self.SKETCH_STATS:
+            if isinstance(self.stats[key], list):
+                self.stats[key] = ExactCounter(self.stats[key])
     
     async def analyze_pcapng_advanced(self, file_path: str, top_n: int = 10, 
                                     save_report: bool = False, 
                                     enable_vt: bool = False,
-                                    behavioral_analysis: bool = True):
+                                    behavioral_analysis: bool = True,
+                                    streaming: bool = False,
+                                    backend: str = 'native',
+                                    checkpoint_file: Optional[str] = None,
+                                    result_cache: Optional[AnalysisResultCache] = None):
         """Расширенный анализ с дополнительными функциями"""
         
         self.performance_stats['analysis_start_time'] = datetime.now()
-        file_hash = self.calculate_file_hash(file_path)
+        
+        # Неизмененный файл с теми же параметрами отдается из кеша результатов
+        cache_key = None
+        if result_cache and not checkpoint_file:
+            cache_key = result_cache.result_key(result_cache.fingerprint(file_path), {
+                'enable_vt': enable_vt,
+                'behavioral_analysis': behavioral_analysis,
+                'streaming': streaming,
+                'backend': backend,
+                'sketch_capacity': self.sketch_capacity,
+                'config': self.config.digest(),
+                'ioc_feed': self.threat_analyzer.ioc_manager.feed_digest()
+            })
+            cached = result_cache.get(cache_key)
+            if cached:
+                self.restore_cached_result(cached, file_path, top_n, save_report)
+                return
         
         logging.info(f"Starting advanced enterprise analysis of {file_path}")
         
+        # Контрольная точка требует потокового режима и нативного чтения по смещениям
+        checkpoint = AnalysisCheckpoint(checkpoint_file, file_path) if checkpoint_file else None
+        if checkpoint:
+            streaming, backend = True, 'native'
+        # Потоковый режим не хранит значения по каждому пакету
+        if streaming:
+            self.aggregate_stats()
+        
         try:
-            cap = pyshark.FileCapture(file_path)
+            cap = open_capture(file_path, backend)
         except Exception as e:
             logging.error(f"Error opening file: {e}")
             return
         
+        # В потоковом режиме пакеты не накапливаются: детекторы
+        # обрабатывают их по одному и хранят ограниченное состояние
         all_packets = []
+        stream_detectors = self.create_stream_detectors(behavioral_analysis) if streaming else []
         high_severity_threats = []
+        packets = cap
+        
+        if checkpoint:
+            if not isinstance(cap, NativePcapReader):
+                cap.close()
+                logging.error(f"Checkpointing requires a pcap/pcapng file: {file_path}")
+                return
+            state = checkpoint.load()
+            if state:
+                self.stats = state['stats']
+                stream_detectors = state['detectors']
+                self.stix_generator.merge_sightings(state.get('sightings', []))
+                packets = cap.iter_from(state['offset'], state['section'])
+                print(f"Resuming from checkpoint: {self.stats['total_packets']} packets already analyzed")
+            # В отчетах цепочка помечена: это не SHA-256 файла
+            file_digest = checkpoint.chain_digest(state)
+            file_hash = checkpoint.DIGEST_LABEL + file_digest[0]
+        else:
+            file_hash = self.calculate_file_hash(file_path)
+        packets_before = self.stats['total_packets']
+        metrics = self.metrics
+        if metrics:
+            packets = metrics.timed_iter('decode', packets)
+        
+        # Обогащение через VirusTotal идет в фоне и не задерживает разбор пакетов
+        enrichment = self.create_enrichment_queue() if enable_vt else None
+        if enrichment:
+            enrichment.start()
         
         print(f"Advanced Enterprise Analysis: {file_path}")
         print("Processing packets with advanced threat detection...")
         
         try:
-            for i, packet in enumerate(cap):
+            for i, packet in enumerate(packets):
                 if i % 1000 == 0:
                     print(f"Processed packets: {i}")
+                    if metrics:
+                        metrics.maybe_export()
                 
-                all_packets.append(packet)
-                self.stats['total_packets'] += 1
+                if not streaming:
+                    all_packets.append(packet)
                 
                 # Расширенный анализ угроз
-                if enable_vt:
-                    threats = await self.advanced_threat_analyzer.analyze_packet_threats_advanced(packet)
-                else:
-                    threats = self.threat_analyzer.analyze_packet_threats(packet)
+                threats = self.threat_analyzer.analyze_packet_threats(packet)
+                if enrichment:
+                    threats = threats + self.advanced_threat_analyzer.suspicious_port_threats(packet)
+                    if 'IP' in packet and not self.is_local_ip(packet.ip.src):
+                        await enrichment.submit(packet.ip.src)
+                    # Дать воркерам обогащения обработать ответы между пакетами
+                    if i % 64 == 0:
+                        await asyncio.sleep(0)
                 
-                self.stats['threats_found'].extend(threats)
-                high_sev = [t for t in threats if t.get('severity') == 'HIGH']
+                high_sev = self.process_packet(packet, threats, stream_detectors)
                 high_severity_threats.extend(high_sev)
                 
-                # Сбор статистики
-                if 'IP' in packet:
-                    src_ip = packet.ip.src
-                    dst_ip = packet.ip.dst
-                    
-                    if not self.is_local_ip(src_ip):
-                        self.stats['ip_addresses'].append(src_ip)
-                    if not self.is_local_ip(dst_ip):
-                        self.stats['ip_addresses'].append(dst_ip)
-                
-                if 'DNS' in packet and hasattr(packet.dns, 'qry_name'):
-                    self.stats['dns_requests'].append(packet.dns.qry_name.lower())
-                
-                protocol = self.get_protocol_name(packet)
-                self.stats['protocols'].append(protocol)
-                
         except Exception as e:
             logging.error(f"Error processing packets: {e}")
         finally:
+            resume_offset = getattr(cap, 'position', None)
+            resume_section = cap.section_state() if checkpoint else None
             cap.close()
         
-        # Поведенческий анализ
-        if behavioral_analysis and len(all_packets) > 1000:
-            self.advanced_threat_analyzer.behavioral_analyzer.establish_baseline(all_packets)
-            behavioral_anomalies = self.advanced_threat_analyzer.behavioral_analyzer.detect_anomalies(all_packets)
-            self.stats['suspicious_activities'].extend(behavioral_anomalies)
+        # Присоединение результатов обогащения до построения отчета
+        if enrichment:
+            enrichment_threats = await enrichment.join()
+            await self.advanced_threat_analyzer.vt_integration.close()
+            self.stats['threats_found'].extend(enrichment_threats)
+            high_severity_threats.extend(t for t in enrichment_threats if t.get('severity') == 'HIGH')
+            self.performance_stats['enrichment'] = dict(enrichment.stats)
         
-        # Обнаружение эксфильтрации данных
-        exfiltration_signs = self.advanced_threat_analyzer.detect_data_exfiltration(all_packets)
-        self.stats['suspicious_activities'].extend(exfiltration_signs)
+        # Точка сохраняется до финализации детекторов, чтобы их выводы не дублировались
+        if checkpoint:
+            checkpoint.save(resume_offset, resume_section, self.stats, stream_detectors, file_digest,
+                            self.stix_generator.sightings_state())
         
-        # Дополнительный анализ
-        port_scanners = self.detect_port_scan(all_packets)
-        self.stats['suspicious_activities'].extend(port_scanners)
+        if streaming:
+            self.finalize_detectors(stream_detectors)
+        else:
+            self.run_batch_detectors(all_packets, behavioral_analysis)
         
         # Расчет производительности
-        self.performance_stats['analysis_end_time'] = datetime.now()
-        duration = (self.performance_stats['analysis_end_time'] - 
-                   self.performance_stats['analysis_start_time']).total_seconds()
-        self.performance_stats['packets_per_second'] = self.stats['total_packets'] / duration if duration > 0 else 0
+        self.finish_performance_stats(self.stats['total_packets'] - packets_before)
+        
+        if cache_key:
+            result_cache.put(cache_key, {
+                'stats': self.stats,
+                'file_hash': file_hash,
+                'performance_stats': self.performance_stats,
+                'sightings': self.stix_generator.sightings_state()
+            })
         
         # Генерация отчетов
         self.generate_advanced_report(file_path, file_hash, top_n, save_report)
         
-        # Оповещения
+        # Оповещения: один дайджест по сгруппированным угрозам
         if high_severity_threats:
-            self.send_alerts(high_severity_threats, file_path)
+            self.alert_pipeline.add(high_severity_threats, file_path)
+        self.alert_pipeline.close()
         
         # Интеграция с SIEM
-        asyncio.run(self.send_to_siem(file_path, self.stats))
+        with self.timed('siem_export'):
+            await self.export_to_siem(file_path, file_hash)
+        if metrics:
+            metrics.export()
         
         logging.info(f"Advanced enterprise analysis completed for {file_path}")
     
+    async def export_to_siem(self, file_path: str, file_hash: str):
+        """Пакетная выгрузка событий анализа в SIEM"""
+        exporter = self.siem_exporter
+        if not exporter.enabled:
+            return
+        await exporter.start()
+        try:
+            for event in exporter.capture_events(file_path, file_hash, self.stats):
+                await exporter.submit(event)
+        finally:
+            await exporter.close()
+        self.performance_stats['siem_export'] = dict(exporter.stats)
+        logging.info(f"SIEM export: {dict(exporter.stats)}")
+    
+    def restore_cached_result(self, cached: Dict, file_path: str, top_n: int, save_report: bool):
+        """Отчет по сохраненному результату; оповещения и SIEM уже отправлялись при анализе"""
+        start_time = self.performance_stats['analysis_start_time']
+        self.stats = cached['stats']
+        self.stix_generator.merge_sightings(cached.get('sightings', []))
+        self.performance_stats = dict(cached['performance_stats'])
+        self.performance_stats['cached_analysis_time'] = (
+            self.performance_stats['analysis_end_time'] - self.performance_stats['analysis_start_time'])
+        self.performance_stats['analysis_start_time'] = start_time
+        self.performance_stats['analysis_end_time'] = datetime.now()
+        
+        print(f"Cached result for {file_path} (unchanged since last analysis)")
+        self.generate_advanced_report(file_path, cached['file_hash'], top_n, save_report)
+    
+    def create_enrichment_queue(self) -> EnrichmentQueue:
+        """Очередь обогащения с параметрами из секции [VIRUSTOTAL]"""
+        vt_settings = self.config.get_virustotal_settings()
+        return EnrichmentQueue(
+            self.advanced_threat_analyzer,
+            workers=int(vt_settings.get('enrichment_workers', 4)),
+            max_queue=int(vt_settings.get('enrichment_queue_size', 1000)),
+            backpressure=vt_settings.get('enrichment_backpressure', 'drop'),
+            metrics=self.metrics
+        )
+    
+    def create_stream_detectors(self, behavioral_analysis: bool = True) -> List:
+        """Набор потоковых детекторов с ограниченным состоянием"""
+        detectors = [
+            DNSTunnelingDetector(),
+            self.create_port_scan_detector(),
+            self.create_flow_table()
+        ]
+        if behavioral_analysis:
+            detectors.append(BehavioralAnalyzer())
+        return detectors
+    
+    def create_port_scan_detector(self) -> PortScanDetector:
+        """Настройки [ALERTS]: port_scan_threshold, port_scan_window, port_scan_max_sources"""
+        thresholds = self.config.get_alert_thresholds()
+        return PortScanDetector(threshold=int(thresholds.get('port_scan_threshold', 20)),
+                                max_sources=int(thresholds.get('port_scan_max_sources', 100000)),
+                                window=float(thresholds.get('port_scan_window', 60)))
+    
+    def create_flow_table(self) -> FlowTable:
+        """Настройки [ALERTS]: flow_idle_timeout, flow_active_timeout, flow_max_flows,
+        exfil_threshold_mb, outbound_volume_mb, long_connection_hours"""
+        thresholds = self.config.get_alert_thresholds()
+        detector = FlowAnomalyDetector(
+            exfil_bytes=int(float(thresholds.get('exfil_threshold_mb', 50)) * 1024 * 1024),
+            volume_bytes=int(float(thresholds.get('outbound_volume_mb', 500)) * 1024 * 1024),
+            long_duration=float(thresholds.get('long_connection_hours', 1)) * 3600
+        )
+        return FlowTable(idle_timeout=float(thresholds.get('flow_idle_timeout', 60)),
+                         active_timeout=float(thresholds.get('flow_active_timeout', 1800)),
+                         max_flows=int(thresholds.get('flow_max_flows', 200000)),
+                         consumers=[detector])
+    
+    def finalize_detectors(self, detectors: List):
+        """Выводы детекторов; сводка таблицы потоков сохраняется для отчета"""
+        for detector in detectors:
+            started = time.perf_counter()
+            self.stats['suspicious_activities'].extend(detector.finalize())
+            if self.metrics:
+                self.metrics.add(f"detector.{type(detector).__name__}", time.perf_counter() - started, 0)
+            if isinstance(detector, FlowTable):
+                self.stats['flow_summary'] = detector.summary()
+    
+    def run_batch_detectors(self, all_packets: List, behavioral_analysis: bool = True):
+        """Пакетный режим: детекторы работают по полному списку пакетов"""
+        # Поведенческий анализ тем же потоковым проходом, что и в streaming режиме
+        if behavioral_analysis:
+            behavioral_analyzer = self.advanced_threat_analyzer.behavioral_analyzer
+            with self.timed('detector.BehavioralAnalyzer'):
+                for packet in all_packets:
+                    anomalies = behavioral_analyzer.process_packet(packet)
+                    if anomalies:
+                        self.stats['suspicious_activities'].extend(anomalies)
+                self.stats['suspicious_activities'].extend(behavioral_analyzer.finalize())
+        
+        # Обнаружение эксфильтрации данных
+        with self.timed('detector.data_exfiltration'):
+            exfiltration_signs = self.advanced_threat_analyzer.detect_data_exfiltration(all_packets)
+        self.stats['suspicious_activities'].extend(exfiltration_signs)
+        
+        # Сканирование портов и потоки: окна по источникам вместо прохода по всему списку
+        detectors = [self.create_port_scan_detector(), self.create_flow_table()]
+        for packet in all_packets:
+            self.run_detectors(packet, detectors)
+        self.finalize_detectors(detectors)
+    
+    def process_packet(self, packet, threats: List[Dict], stream_detectors: List) -> List[Dict]:
+        """Учет пакета: детекторы, угрозы и статистика; возвращает угрозы HIGH"""
+        self.stats['total_packets'] += 1
+        if self.metrics:
+            self.metrics.counters['packets'] += 1
+            self.metrics.counters['threats'] += len(threats)
+        self.run_detectors(packet, stream_detectors)
+        
+        if threats:
+            timestamp = float(packet.sniff_timestamp)
+            for threat in threats:
+                self.stix_generator.observe(threat, timestamp)
+            self.stats['threats_found'].extend(threats)
+        
+        # Сбор статистики
+        self.collect_packet_stats(packet)
+        return [t for t in threats if t.get('severity') == 'HIGH']
+    
+    def run_detectors(self, packet, detectors: List):
+        """Пакет через детекторы; с метриками - замер по каждому детектору"""
+        metrics = self.metrics
+        for detector in detectors:
+            if metrics is None:
+                anomalies = detector.process_packet(packet)
+            else:
+                started = time.perf_counter()
+                anomalies = detector.process_packet(packet)
+                metrics.add(f"detector.{type(detector).__name__}", time.perf_counter() - started)
+            if anomalies:
+                self.stats['suspicious_activities'].extend(anomalies)
+    
+    def collect_packet_stats(self, packet):
+        """Сбор статистики по одному пакету"""
+        if 'IP' in packet:
+            src_ip = packet.ip.src
+            dst_ip = packet.ip.dst
+            
+            if not self.is_local_ip(src_ip):
+                self.stats['ip_addresses'].append(src_ip)
+            if not self.is_local_ip(dst_ip):
+                self.stats['ip_addresses'].append(dst_ip)
+        
+        if is_dns_query(packet):
+            self.stats['dns_requests'].append(packet.dns.qry_name.lower())
+        
+        protocol = self.get_protocol_name(packet)
+        self.stats['protocols'].append(protocol)
+    
     def generate_advanced_report(self, file_path: str, file_hash: str, 
                                top_n: int, save_report: bool):
         """Генерация расширенного отчета безопасности"""
@@ -469,9 +4904,9 @@ class AdvancedEnterpriseNetworkAnalyzer(EnterpriseNetworkAnalyzer):
         print("="*80)
         
         # Базовая статистика
-        ip_counter = Counter(self.stats['ip_addresses'])
-        dns_counter = Counter(self.stats['dns_requests'])
-        protocol_counter = Counter(self.stats['protocols'])
+        ip_counter = self.stat_counter('ip_addresses')
+        dns_counter = self.stat_counter('dns_requests')
+        protocol_counter = self.stat_counter('protocols')
         
         # Угрозы по категориям
         threat_by_type = Counter([t['type'] for t in self.stats['threats_found']])
@@ -492,28 +4927,62 @@ class AdvancedEnterpriseNetworkAnalyzer(EnterpriseNetworkAnalyzer):
         print(f"  Packets per second: {self.performance_stats['packets_per_second']:.2f}")
         print(f"  Memory usage: {self.performance_stats.get('memory_usage', 'N/A')} MB")
         
+        enrichment = self.performance_stats.get('enrichment')
+        if enrichment:
+            print(f"\nENRICHMENT QUEUE:")
+            for key in ('submitted', 'completed', 'dropped', 'blocked', 'errors', 'max_queue_depth'):
+                print(f"  {key.replace('_', ' ').capitalize()}: {enrichment.get(key, 0)}")
+        
+        flow_summary = self.stats.get('flow_summary')
+        if flow_summary:
+            print("\nFLOWS:")
+            print(f"  Total flows: {flow_summary['flows']}")
+            print(f"  Ended by: {', '.join(f'{k}={v}' for k, v in flow_summary['end_reasons'].items())}")
+            print("  Top talkers by bytes sent:")
+            for host, sent in flow_summary['top_talkers'][:top_n]:
+                print(f"    {host}: {sent} bytes")
+            print(f"  Largest flows:")
+            for flow in flow_summary['top_flows'][:top_n]:
+                print(f"    {flow['proto']} {flow['src']}:{flow['sport']} -> {flow['dst']}:{flow['dport']} "
+                      f"{flow['bytes_fwd']}/{flow['bytes_rev']} bytes, {flow['duration']}s")
+        
+        # История анализов для запросов по множеству захватов
+        if self.history_store:
+            with self.timed('report.history'):
+                self.history_store.record_capture(file_path, file_hash, self.stats, ip_counter, dns_counter)
+        
         # Сохранение в базу данных
         if save_report:
-            self.save_to_database(file_path, file_hash)
+            with self.timed('report.database'):
+                self.save_to_database(file_path, file_hash)
             
-            # Расширенный JSON отчет
-            report = self.create_comprehensive_report(file_path, file_hash)
-            report_file = f"{file_path}_advanced_report.json"
-            with open(report_file, 'w', encoding='utf-8') as f:
-                json.dump(report, f, indent=2, ensure_ascii=False)
+            # Расширенный JSON отчет: крупные списки пишутся поэлементно
+            with self.timed('report.json'):
+                report = self.create_comprehensive_report(file_path, file_hash)
+                for key, value in report.items():
+                    if isinstance(value, list) and len(value) > self.STREAM_LIST_THRESHOLD:
+                        report[key] = iter(value)
+                report_file = StreamingReportWriter.report_path(f"{file_path}_advanced_report", self.report_format)
+                StreamingReportWriter(report_file, self.report_format).write(report)
+                del report
             
             # STIX отчет
-            stix_report = self.stix_generator.generate_stix_bundle(
+            stix_bundle = (self.stix_generator.stream_stix_bundle if self.stix_per_threat
+                           else self.stix_generator.stream_aggregated_stix_bundle)
+            stix_report = stix_bundle(
                 self.stats['threats_found'], 
                 {'filename': file_path, 'file_hash': file_hash}
             )
-            stix_file = f"{file_path}_stix_report.json"
-            with open(stix_file, 'w', encoding='utf-8') as f:
-                json.dump(stix_report, f, indent=2, ensure_ascii=False)
+            stix_file = StreamingReportWriter.report_path(f"{file_path}_stix_report", self.report_format)
+            with self.timed('report.stix'):
+                StreamingReportWriter(stix_file, self.report_format).write(stix_report)
             
             print(f"\nReports saved:")
             print(f"  Full report: {report_file}")
             print(f"  STIX report: {stix_file}")
+        
+        if self.metrics:
+            self.metrics.print_summary()
 
 # Утилиты для работы с большими файлами
 class LargeFileProcessor:
@@ -535,38 +5004,701 @@ class LargeFileProcessor:
     @staticmethod
     def _fallback_split(file_path: str, chunk_size: int) -> List[str]:
         """Резервный метод разделения файлов"""
-        # Простая реализация через tshark
-        output_files = []
+        # editcap за один проход пишет все части по chunk_size пакетов
         base_name = os.path.splitext(file_path)[0]
         
         try:
-            # Получение общего количества пакетов
-            result = subprocess.run(
-                ['capinfos', '-c', file_path], 
-                capture_output=True, 
-                text=True
+            subprocess.run(
+                ['editcap', '-c', str(chunk_size), file_path, f"{base_name}_part.pcapng"],
+                check=True
             )
-            total_packets = int(result.stdout.split(':')[-1].strip())
-            
-            # Разделение на части
-            for i in range(0, total_packets, chunk_size):
-                output_file = f"{base_name}_part{i//chunk_size}.pcap"
-                subprocess.run([
-                    'tshark', '-r', file_path, 
-                    '-w', output_file,
-                    '-c', str(chunk_size)
-                ])
-                output_files.append(output_file)
-                
         except Exception as e:
             logging.error(f"Fallback split failed: {e}")
+            return []
+        
+        return sorted(glob.glob(f"{glob.escape(base_name)}_part_*.pcapng"))
+
+# Состояние анализатора в рабочем процессе (создается один раз на процесс)
+_shard_analyzer = None
+_shard_initial_stats = None
+
+def _init_shard_worker(config_file: str, sketch_capacity: int = 0, metrics: bool = False):
+    global _shard_analyzer, _shard_initial_stats
+    _shard_analyzer = AdvancedEnterpriseNetworkAnalyzer(config_file)
+    if sketch_capacity:
+        _shard_analyzer.enable_sketches(sketch_capacity)
+    _shard_analyzer.aggregate_stats()
+    if metrics:
+        _shard_analyzer.enable_metrics()
+    _shard_initial_stats = copy.deepcopy(_shard_analyzer.stats)
+
+def _analyze_shard(file_path: str, shard: Optional[Dict], behavioral_analysis: bool) -> Dict:
+    """Анализ одного шарда: диапазона байт файла или отдельного файла-части"""
+    analyzer = _shard_analyzer
+    analyzer.stats = copy.deepcopy(_shard_initial_stats)
+    analyzer.stix_generator.sightings.clear()
+    detectors = analyzer.create_stream_detectors(behavioral_analysis)
+    high_severity_threats = []
+    
+    if shard is None:
+        cap = open_capture(file_path)
+        packets = cap
+    else:
+        cap = NativePcapReader(file_path)
+        packets = cap.iter_range(shard['start'], shard['end'], shard['section'])
+    metrics = analyzer.metrics
+    if metrics:
+        metrics.reset()
+        packets = metrics.timed_iter('decode', packets)
+    
+    try:
+        for packet in packets:
+            threats = analyzer.threat_analyzer.analyze_packet_threats(packet)
+            high_severity_threats.extend(analyzer.process_packet(packet, threats, detectors))
+    finally:
+        cap.close()
+    if metrics:
+        metrics.sample_memory()
+    
+    # Статистика шарда уже собрана в счетчики (aggregate_stats)
+    return {
+        'total_packets': analyzer.stats['total_packets'],
+        'threats_found': analyzer.stats['threats_found'],
+        'suspicious_activities': analyzer.stats['suspicious_activities'],
+        'ip_addresses': analyzer.stat_counter('ip_addresses'),
+        'dns_requests': analyzer.stat_counter('dns_requests'),
+        'protocols': analyzer.stat_counter('protocols'),
+        'detectors': detectors,
+        'high_severity_threats': high_severity_threats,
+        'sightings': analyzer.stix_generator.sightings_state(),
+        'metrics': metrics.snapshot() if metrics else None
+    }
+
+# Параллельный анализ больших файлов в пуле процессов
+class ParallelNetworkAnalyzer:
+    def __init__(self, analyzer: 'AdvancedEnterpriseNetworkAnalyzer',
+                 config_file: str = "enterprise_config.ini",
+                 workers: Optional[int] = None):
+        self.analyzer = analyzer
+        self.config_file = config_file
+        self.workers = workers or multiprocessing.cpu_count()
+    
+    def plan_shards(self, file_path: str, split_size: int) -> Tuple[List[Optional[Dict]], List[str]]:
+        """Шарды по границам записей; без нативного формата - разделение на файлы"""
+        try:
+            reader = NativePcapReader(file_path)
+        except ValueError as e:
+            logging.warning(f"Cannot shard in place ({e}), splitting into files")
+            parts = LargeFileProcessor.split_large_pcap(file_path, split_size)
+            return [None] * len(parts), parts
+        
+        try:
+            # Несколько шардов на процесс сглаживают неравномерную нагрузку
+            shards = reader.split(self.workers * 4, max_packets=split_size)
+        finally:
+            reader.close()
+        return shards, [file_path] * len(shards)
+    
+    def analyze_large_file(self, file_path: str, split_size: int = 1000000,
+                           top_n: int = 10, save_report: bool = False,
+                           behavioral_analysis: bool = True):
+        """Параллельный анализ с объединением счетчиков, угроз и детекторов"""
+        analyzer = self.analyzer
+        analyzer.performance_stats['analysis_start_time'] = datetime.now()
+        file_hash = analyzer.calculate_file_hash(file_path)
+        
+        shards, shard_files = self.plan_shards(file_path, split_size)
+        print(f"Parallel analysis: {len(shards)} shards on {self.workers} workers")
+        
+        counters = {key: None for key in analyzer.SKETCH_STATS}
+        detectors = None
+        high_severity_threats = []
+        
+        try:
+            with ProcessPoolExecutor(max_workers=self.workers,
+                                     initializer=_init_shard_worker,
+                                     initargs=(self.config_file, analyzer.sketch_capacity,
+                                               analyzer.metrics is not None)) as pool:
+                futures = [pool.submit(_analyze_shard, shard_file, shard, behavioral_analysis)
+                           for shard, shard_file in zip(shards, shard_files)]
+                
+                # Слияние в порядке шардов: порядок угроз совпадает с файлом
+                for i, future in enumerate(futures):
+                    result = future.result()
+                    analyzer.stats['total_packets'] += result['total_packets']
+                    analyzer.stats['threats_found'].extend(result['threats_found'])
+                    analyzer.stats['suspicious_activities'].extend(result['suspicious_activities'])
+                    high_severity_threats.extend(result['high_severity_threats'])
+                    analyzer.stix_generator.merge_sightings(result['sightings'])
+                    for key, counter in counters.items():
+                        counters[key] = result[key] if counter is None else merge_counts(counter, result[key])
+                    
+                    if detectors is None:
+                        detectors = result['detectors']
+                    else:
+                        for detector, shard_detector in zip(detectors, result['detectors']):
+                            detector.merge(shard_detector)
+                    if analyzer.metrics:
+                        analyzer.metrics.merge(result['metrics'])
+                        analyzer.metrics.maybe_export()
+                    print(f"Merged shard {i + 1}/{len(shards)}: {analyzer.stats['total_packets']} packets")
+        finally:
+            if shard_files and shard_files[0] != file_path:
+                for part in shard_files:
+                    os.remove(part)
+        
+        analyzer.stats.update({key: counter for key, counter in counters.items() if counter is not None})
+        analyzer.finalize_detectors(detectors or [])
+        analyzer.finish_performance_stats(analyzer.stats['total_packets'])
+        
+        analyzer.generate_advanced_report(file_path, file_hash, top_n, save_report)
+        
+        if high_severity_threats:
+            analyzer.alert_pipeline.add(high_severity_threats, file_path)
+        analyzer.alert_pipeline.close()
+        
+        with analyzer.timed('siem_export'):
+            asyncio.run(analyzer.export_to_siem(file_path, file_hash))
+        if analyzer.metrics:
+            analyzer.metrics.export()
+
+# Источники пакетов для живого анализа
+def replay_capture(file_path: str, speed: float = 1.0):
+    """Воспроизведение файла в темпе записи (speed=0 - без пауз)"""
+    reader = NativePcapReader(file_path)
+    try:
+        first_ts = started = None
+        for packet in reader:
+            if speed > 0:
+                if first_ts is None:
+                    first_ts, started = packet.sniff_timestamp, time.monotonic()
+                delay = (packet.sniff_timestamp - first_ts) / speed - (time.monotonic() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            yield packet
+    finally:
+        reader.close()
+
+class CaptureError(RuntimeError):
+    """Поток захвата с интерфейса завершился с ошибкой"""
+
+def live_capture(interface: str, backend: str = 'scapy', max_queue: int = 10000,
+                 idle_timeout: float = 1.0, stats: Optional[Counter] = None):
+    """Захват с интерфейса в отдельном потоке через ограниченную очередь.
+    При простое отдается None, чтобы окна закрывались по часам. Ошибка
+    потока захвата (нет scapy, нет прав, интерфейс пропал) передается
+    через очередь и поднимается как CaptureError; после штатной
+    остановки захвата генератор завершается."""
+    packets = queue.Queue(maxsize=max_queue)
+    stats = stats if stats is not None else Counter()
+    end = object()
+
+    def enqueue(packet):
+        try:
+            packets.put_nowait(packet)
+        except queue.Full:
+            stats['capture_dropped'] += 1
+
+    def capture_scapy():
+        from scapy.all import sniff, Ether
+
+        def handle(pkt):
+            raw = bytes(pkt)
+            linktype = LINKTYPE_ETHERNET if isinstance(pkt, Ether) else LINKTYPE_RAW
+            enqueue(decode_frame(raw, 0, len(raw), len(raw), linktype, float(pkt.time)))
+
+        sniff(iface=interface, prn=handle, store=0)
+
+    def capture_pyshark():
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        for packet in pyshark.LiveCapture(interface=interface).sniff_continuously():
+            enqueue(packet)
+
+    def run_capture():
+        # Итог захвата кладется с ожиданием: он не должен потеряться при полной очереди
+        try:
+            (capture_scapy if backend == 'scapy' else capture_pyshark)()
+            packets.put(end)
+        except Exception as e:
+            packets.put(e)
+
+    thread = threading.Thread(target=run_capture, name=f"capture-{interface}", daemon=True)
+    thread.start()
+
+    while True:
+        try:
+            item = packets.get(timeout=idle_timeout)
+        except queue.Empty:
+            if not thread.is_alive() and packets.empty():
+                raise CaptureError(f"Capture thread on {interface} exited unexpectedly")
+            yield None
+            continue
+        if item is end:
+            return
+        if isinstance(item, Exception):
+            raise CaptureError(f"Capture on {interface} failed: {item}") from item
+        yield item
+
+# Живой анализ с временными окнами (tumbling / sliding)
+class LiveStreamAnalyzer:
+    """Окно длиной window секунд сдвигается на slide секунд (slide=0 -
+    неперекрывающиеся окна). Состояние хранится по сегментам длиной slide:
+    в памяти не больше window/slide сегментов с ограниченными детекторами,
+    окно собирается слиянием сегментов при выдаче результата."""
+
+    def __init__(self, analyzer: 'AdvancedEnterpriseNetworkAnalyzer', window: float = 10.0,
+                 slide: float = 0, behavioral_analysis: bool = True, top_n: int = 5,
+                 output_file: Optional[str] = None):
+        self.analyzer = analyzer
+        self.window = window
+        self.slide = slide or window
+        self.top_n = top_n
+        self.output_file = output_file
+        self.panes = deque(maxlen=max(1, round(window / self.slide)))
+        self.pane = None
+        self.behavioral = BehavioralAnalyzer() if behavioral_analysis else None
+        self.source_stats = Counter()
+        self.windows_emitted = 0
+
+    def _new_pane(self, start: float) -> Dict:
+        return {
+            'start': start,
+            'packets': 0,
+            'bytes': 0,
+            'sources': SpaceSavingCounter(1000),
+            'threats': Counter(),
+            'high_severity': [],
+            'anomalies': [],
+            'detectors': [DNSTunnelingDetector(), self.analyzer.create_port_scan_detector()]
+        }
+
+    def process_packet(self, packet):
+        self.advance(float(packet.sniff_timestamp))
+        pane = self.pane
+        pane['packets'] += 1
+        pane['bytes'] += int(packet.length)
+        if 'IP' in packet:
+            pane['sources'].update(packet.ip.src)
+        for detector in pane['detectors']:
+            detector.process_packet(packet)
+        if self.behavioral:
+            anomalies = self.behavioral.process_packet(packet)
+            if anomalies:
+                pane['anomalies'].extend(anomalies)
+
+        threats = self.analyzer.threat_analyzer.analyze_packet_threats(packet)
+        for threat in threats:
+            pane['threats'][threat.get('type', 'UNKNOWN')] += 1
+            if threat.get('severity') == 'HIGH' and len(pane['high_severity']) < 100:
+                pane['high_severity'].append(threat)
+        metrics = self.analyzer.metrics
+        if metrics:
+            metrics.counters['packets'] += 1
+            metrics.counters['threats'] += len(threats)
+
+    def advance(self, now: float):
+        """Закрытие сегментов и выдача окон, чьи границы уже пройдены"""
+        if self.pane is None:
+            self.pane = self._new_pane(now - now % self.slide)
+            return
+
+        steps = int((now - self.pane['start']) // self.slide)
+        if steps <= 0:
+            return
+        # После долгой паузы достаточно выдать окна, пока старые сегменты не вытеснятся
+        for _ in range(min(steps, self.panes.maxlen)):
+            self.panes.append(self.pane)
+            self.emit_window()
+            self.pane = self._new_pane(self.pane['start'] + self.slide)
+        if steps > self.panes.maxlen:
+            self.pane = self._new_pane(now - now % self.slide)
+
+    def emit_window(self) -> Dict:
+        panes = list(self.panes)
+        window_end = panes[-1]['start'] + self.slide
+        window_start = max(panes[0]['start'], window_end - self.window)
+
+        # Слияние портит сегменты, поэтому для скользящего окна берется копия первого
+        sources, detectors = panes[0]['sources'], panes[0]['detectors']
+        if len(panes) > 1:
+            sources, detectors = copy.deepcopy((sources, detectors))
+        threats = Counter()
+        for pane in panes:
+            if pane is not panes[0]:
+                sources.merge(pane['sources'])
+                for detector, pane_detector in zip(detectors, pane['detectors']):
+                    detector.merge(pane_detector)
+            threats.update(pane['threats'])
+        # Оповещения только по новому сегменту, чтобы скользящие окна не дублировали их
+        high_severity = panes[-1]['high_severity']
+
+        detections = [d for detector in detectors for d in detector.finalize()]
+        if self.behavioral:
+            # Размеры пакетов оцениваются по новому сегменту, как и аномалии отправителей
+            detections.extend(self.behavioral.finalize())
+            self.behavioral.reset_window()
+            detections.extend(panes[-1]['anomalies'])
+
+        packets = sum(pane['packets'] for pane in panes)
+        result = {
+            'window_start': datetime.fromtimestamp(window_start).isoformat(),
+            'window_end': datetime.fromtimestamp(window_end).isoformat(),
+            'packets': packets,
+            'bytes': sum(pane['bytes'] for pane in panes),
+            'packets_per_second': packets / (window_end - window_start),
+            'top_sources': sources.most_common(self.top_n),
+            'threats_by_type': dict(threats),
+            'detections': detections,
+            'capture_dropped': self.source_stats.get('capture_dropped', 0)
+        }
+        self.windows_emitted += 1
+
+        print(f"[{result['window_start']} - {result['window_end']}] "
+              f"packets={packets} pps={result['packets_per_second']:.1f} "
+              f"threats={sum(threats.values())} detections={len(detections)}")
+        for detection in detections:
+            print(f"  [{detection.get('severity', 'UNKNOWN')}] {detection['type']}: {detection.get('description', '')}")
+
+        if self.output_file:
+            with open(self.output_file, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(result, default=str, ensure_ascii=False) + '\n')
+
+        # Дайджест уходит по окончании окна оповещений, а не на каждое окно анализа
+        if high_severity:
+            self.analyzer.alert_pipeline.add(high_severity, f"live window {result['window_end']}")
+        self.analyzer.alert_pipeline.flush()
+        if self.analyzer.metrics:
+            self.analyzer.metrics.maybe_export()
+        return result
+
+    def run(self, packets):
+        """Обработка источника; None от живого захвата продвигает окна по часам.
+        CaptureError поднимается после выдачи последнего сегмента."""
+        error = None
+        try:
+            for packet in packets:
+                if packet is None:
+                    self.advance(time.time())
+                else:
+                    self.process_packet(packet)
+        except KeyboardInterrupt:
+            print("\nLive analysis stopped")
+        except CaptureError as e:
+            error = e
+
+        # Выдача последнего незакрытого сегмента
+        if self.pane is not None and self.pane['packets']:
+            self.panes.append(self.pane)
+            self.emit_window()
+            self.pane = None
+        self.analyzer.alert_pipeline.close()
+        if self.analyzer.metrics:
+            self.analyzer.metrics.export()
+        if error:
+            raise error
+
+# Генератор синтетических захватов для бенчмарков
+class SyntheticCaptureGenerator:
+    """Пишет pcap (Ethernet/IPv4/TCP/UDP/DNS) с заданной смесью трафика.
+    Виды трафика: web - короткие TCP обмены с внешними узлами, dns -
+    запросы (часть - похожие на туннель) и ответы резолвера на них,
+    scan - перебор портов, bulk - крупные потоки наружу. hosts - число
+    внутренних узлов."""
+    
+    MIXES = {
+        'mixed': ({'web': 0.6, 'dns': 0.2, 'scan': 0.05, 'bulk': 0.15}, 1000),
+        'dns_heavy': ({'dns': 0.8, 'web': 0.2}, 500),
+        'scan': ({'scan': 0.7, 'web': 0.3}, 200),
+        'large_flows': ({'bulk': 0.9, 'dns': 0.1}, 50),
+        'many_hosts': ({'web': 0.85, 'dns': 0.15}, 200000),
+    }
+    
+    def __init__(self, mix: str = 'mixed', hosts: Optional[int] = None,
+                 seed: int = 1, packets_per_second: float = 10000.0):
+        if mix not in self.MIXES:
+            raise ValueError(f"Unknown traffic mix: {mix}")
+        weights, default_hosts = self.MIXES[mix]
+        self.mix = mix
+        self.kinds = list(weights)
+        self.weights = list(weights.values())
+        self.hosts = hosts or default_hosts
+        self.random = random.Random(seed)
+        self.interval = 1.0 / packets_per_second
+        self._scan_port = 0
+    
+    def _internal(self, index: int) -> bytes:
+        return bytes((10, (index >> 16) & 0xFF, (index >> 8) & 0xFF, index & 0xFF))
+    
+    @staticmethod
+    def _frame(src: bytes, dst: bytes, proto: int, transport: bytes, payload_size: int) -> bytes:
+        total = 20 + len(transport) + payload_size
+        ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, total, 0, 0, 64, proto, 0, src, dst)
+        return b'\x02\x00\x00\x00\x00\x01\x02\x00\x00\x00\x00\x02\x08\x00' + ip + transport + bytes(payload_size)
+    
+    def _tcp(self, src, dst, sport, dport, flags, payload_size):
+        header = struct.pack('!HHIIBBHHH', sport, dport, 0, 0, 0x50, flags, 65535, 0, 0)
+        return self._frame(src, dst, 6, header, payload_size)
+    
+    def _dns(self, src, dst, name: str, response: bool = False) -> bytes:
+        question = b''.join(bytes([len(label)]) + label.encode() for label in name.split('.')) + b'\x00\x00\x01\x00\x01'
+        sport, dport = 40000 + len(name), 53
+        if response:
+            # QR=1 и одна запись A со ссылкой на имя из вопроса (0xC00C)
+            answer = struct.pack('!HHHIH4s', 0xC00C, 1, 1, 300, 4, b'\x5d\xb8\xd8\x22')
+            payload = bytearray(struct.pack('!HHHHHH', 0x1234, 0x0100, 1, 1, 0, 0) + question + answer)
+            payload[2] |= 0x80
+            sport, dport = dport, sport
+        else:
+            payload = struct.pack('!HHHHHH', 0x1234, 0x0100, 1, 0, 0, 0) + question
+        udp = struct.pack('!HHHH', sport, dport, 8 + len(payload), 0) + payload
+        return self._frame(src, dst, 17, udp, 0)
+    
+    def _packet(self, kind: str) -> bytes:
+        rnd = self.random
+        host = self._internal(rnd.randrange(self.hosts))
+        if kind == 'web':
+            server = bytes((93, 184, rnd.randrange(256), rnd.randrange(1, 255)))
+            port = rnd.randrange(30000, 60000)
+            if rnd.random() < 0.5:
+                return self._tcp(host, server, port, 443, 0x18, rnd.randrange(0, 600))
+            return self._tcp(server, host, 443, port, 0x18, rnd.randrange(0, 1400))
+        if kind == 'dns':
+            if rnd.random() < 0.05:
+                label = ''.join(rnd.choice('abcdefghijklmnopqrstuvwxyz234567') for _ in range(40))
+                name = f"{label}.t.tunnel-example.com"
+            else:
+                name = f"{rnd.choice(('www', 'api', 'cdn', 'mail'))}.site{rnd.randrange(5000)}.com"
+            # Половина пакетов - ответы резолвера 8.8.8.8:53 узлу
+            if rnd.random() < 0.5:
+                return self._dns(b'\x08\x08\x08\x08', host, name, response=True)
+            return self._dns(host, b'\x08\x08\x08\x08', name)
+        if kind == 'scan':
+            self._scan_port = (self._scan_port + 1) % 65535
+            scanner = self._internal(rnd.randrange(4))
+            target = self._internal(rnd.randrange(self.hosts))
+            return self._tcp(scanner, target, 55555, self._scan_port + 1, 0x02, 0)
+        # bulk: крупный поток наружу с редкими подтверждениями
+        sender = self._internal(rnd.randrange(min(self.hosts, 8)))
+        if rnd.random() < 0.1:
+            return self._tcp(b'\x08\x08\x04\x04', sender, 443, 50000, 0x10, 0)
+        return self._tcp(sender, b'\x08\x08\x04\x04', 50000, 443, 0x18, 1400)
+    
+    def write(self, path: str, packets: int) -> str:
+        record = struct.Struct('<IIII')
+        timestamp = 1700000000.0
+        kinds = self.random.choices(self.kinds, self.weights, k=packets)
+        with open(path, 'wb', buffering=1 << 20) as f:
+            f.write(struct.pack('<IHHiIII', 0xA1B2C3D4, 2, 4, 0, 0, 65535, LINKTYPE_ETHERNET))
+            for kind in kinds:
+                frame = self._packet(kind)
+                timestamp += self.interval
+                seconds = int(timestamp)
+                f.write(record.pack(seconds, int((timestamp - seconds) * 1e6), len(frame), len(frame)))
+                f.write(frame)
+        return path
+
+def _peak_rss_mb() -> float:
+    """Пиковый RSS процесса (VmHWM), МБ"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss: килобайты в Linux, байты в macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (1024 * 1024) if sys.platform == 'darwin' else maxrss / 1024
+
+def _current_rss_mb() -> float:
+    """Текущий RSS процесса, МБ (без /proc - пиковый)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError):
+        return _peak_rss_mb()
+
+def _reset_peak_rss():
+    """Сброс VmHWM до текущего RSS (Linux 4.0+), чтобы пик относился к замеру"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def _benchmark_case(file_path: str, backend: str, config_file: str,
+                    max_packets: Optional[int], run_pipeline: bool) -> Dict:
+    """Один замер в отдельном процессе: декодирование, стадии, полный конвейер"""
+    _reset_peak_rss()
+    result = {'backend': backend, 'stages': {}}
+    
+    def stage(name: str, seconds: float, packets: int):
+        result['stages'][name] = {
+            'seconds': round(seconds, 4),
+            'packets_per_second': round(packets / seconds, 1) if seconds > 0 else None
+        }
+    
+    # Декодирование; пакеты сохраняются для замера остальных стадий по отдельности
+    cap = open_capture(file_path, backend)
+    result['reader'] = type(cap).__name__
+    packets = []
+    started = time.perf_counter()
+    try:
+        for packet in cap:
+            packets.append(packet)
+            if max_packets and len(packets) >= max_packets:
+                break
+    finally:
+        cap.close()
+    count = len(packets)
+    result['packets'] = count
+    stage('decode', time.perf_counter() - started, count)
+    if not count:
+        result['error'] = 'no packets decoded'
+        return result
+    
+    analyzer = AdvancedEnterpriseNetworkAnalyzer(config_file)
+    started = time.perf_counter()
+    for packet in packets:
+        analyzer.threat_analyzer.analyze_packet_threats(packet)
+    stage('threat_analysis', time.perf_counter() - started, count)
+    
+    started = time.perf_counter()
+    for packet in packets:
+        analyzer.collect_packet_stats(packet)
+    stage('packet_stats', time.perf_counter() - started, count)
+    
+    for detector in analyzer.create_stream_detectors(behavioral_analysis=True):
+        started = time.perf_counter()
+        for packet in packets:
+            detector.process_packet(packet)
+        detector.finalize()
+        stage(type(detector).__name__, time.perf_counter() - started, count)
+    
+    del packets
+    result['peak_rss_mb_stages'] = round(_peak_rss_mb(), 1)
+    
+    # Полный потоковый конвейер, как при обычном запуске
+    if run_pipeline:
+        _reset_peak_rss()
+        analyzer = AdvancedEnterpriseNetworkAnalyzer(config_file)
+        started = time.perf_counter()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            asyncio.run(analyzer.analyze_pcapng_advanced(file_path, streaming=True, backend=backend))
+        elapsed = time.perf_counter() - started
+        stage('pipeline', elapsed, analyzer.stats['total_packets'])
+        result['pipeline_packets'] = analyzer.stats['total_packets']
+        result['peak_rss_mb_pipeline'] = round(_peak_rss_mb(), 1)
+    return result
+
+def run_benchmark(output_file: str, mixes: Optional[List[str]] = None, packets: int = 200000,
+                  backends: Tuple[str, ...] = CAPTURE_BACKENDS, config_file: str = "enterprise_config.ini",
+                  pyshark_limit: int = 20000, baseline_file: Optional[str] = None,
+                  work_dir: Optional[str] = None) -> Dict:
+    """Бенчмарк по смесям трафика и бэкендам; результат - JSON для сравнения версий.
+    Каждый замер идет в новом процессе, чтобы пиковый RSS не смешивался."""
+    mixes = mixes or list(SyntheticCaptureGenerator.MIXES)
+    report = {
+        'timestamp': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': multiprocessing.cpu_count(),
+        'packets': packets,
+        'results': []
+    }
+    
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp_dir:
+        for mix in mixes:
+            capture = SyntheticCaptureGenerator(mix).write(os.path.join(tmp_dir, f"{mix}.pcap"), packets)
+            for backend in backends:
+                # pyshark на порядки медленнее: ограничиваем число пакетов
+                limit = pyshark_limit if backend == 'pyshark' else None
+                run_pipeline = backend != 'pyshark' or packets <= pyshark_limit
+                with ProcessPoolExecutor(max_workers=1) as pool:
+                    try:
+                        result = pool.submit(_benchmark_case, capture, backend, config_file,
+                                             limit, run_pipeline).result()
+                    except Exception as e:
+                        result = {'backend': backend, 'error': str(e)[:200]}
+                result['mix'] = mix
+                report['results'].append(result)
+                
+                stages = result.get('stages', {})
+                pipeline = stages.get('pipeline', {}).get('packets_per_second')
+                print(f"{mix:<12} {backend:<8} decode={stages.get('decode', {}).get('packets_per_second')} pps "
+                      f"pipeline={pipeline} pps rss={result.get('peak_rss_mb_pipeline', result.get('peak_rss_mb_stages'))} MB"
+                      + (f" error={result['error']}" if 'error' in result else ''))
+    
+    with open(output_file, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"Benchmark results saved: {output_file}")
+    
+    if baseline_file:
+        compare_benchmarks(baseline_file, report)
+    return report
+
+def compare_benchmarks(baseline_file: str, report: Dict):
+    """Изменение скорости стадий относительно сохраненного прогона"""
+    with open(baseline_file, encoding='utf-8') as f:
+        baseline = json.load(f)
+    previous = {(r['mix'], r['backend']): r for r in baseline.get('results', [])}
+    print(f"\nChange vs {baseline_file} ({baseline.get('timestamp', 'unknown')}):")
+    for result in report['results']:
+        old = previous.get((result['mix'], result['backend']))
+        if not old or 'stages' not in result:
+            continue
+        changes = []
+        for name, current in result['stages'].items():
+            old_pps = old.get('stages', {}).get(name, {}).get('packets_per_second')
+            if old_pps and current['packets_per_second']:
+                changes.append(f"{name} {(current['packets_per_second'] / old_pps - 1) * 100:+.1f}%")
+        print(f"  {result['mix']:<12} {result['backend']:<8} " + ', '.join(changes))
+
+# Запросы к истории анализов из командной строки
+def query_history(args):
+    store = CaptureHistoryStore(args.history_db)
+    since = datetime.now() - timedelta(days=args.since_days) if args.since_days else None
+    try:
+        if args.query_ip:
+            rows = store.captures_for_ip(args.query_ip, since)
+            threats = store.threats_for_indicator(args.query_ip, since)
+            print(f"Captures that contacted {args.query_ip}: {len(rows)}")
+        else:
+            rows = store.captures_for_domain(args.query_domain, since)
+            threats = store.threats_for_indicator(args.query_domain, since)
+            print(f"Captures with DNS queries for {args.query_domain}: {len(rows)}")
         
-        return output_files
+        for row in rows:
+            print(f"  {row['captured_at']}  {row['file_path']}  ({row['hits']} hits, {row['file_hash'][:16]})")
+        if threats:
+            print("Threats:")
+            for row in threats:
+                print(f"  {row['captured_at']}  {row['file_path']}  [{row['severity']}] {row['type']} x{row['hits']}")
+    finally:
+        store.close()
+
+def _bench_mixes(value: str) -> List[str]:
+    """Список смесей трафика для --bench-mixes с проверкой имен"""
+    mixes = value.split(',')
+    unknown = [mix for mix in mixes if mix not in SyntheticCaptureGenerator.MIXES]
+    if unknown:
+        raise argparse.ArgumentTypeError(
+            f"unknown traffic mix: {', '.join(unknown)} (choose from {', '.join(SyntheticCaptureGenerator.MIXES)})")
+    return mixes
+
+def _bench_backends(value: str) -> Tuple[str, ...]:
+    """Список бэкендов чтения для --bench-backends с проверкой имен"""
+    backends = tuple(value.split(','))
+    unknown = [backend for backend in backends if backend not in CAPTURE_BACKENDS]
+    if unknown:
+        raise argparse.ArgumentTypeError(
+            f"unknown capture backend: {', '.join(unknown)} (choose from {', '.join(CAPTURE_BACKENDS)})")
+    return backends
 
 # Главная функция с расширенными опциями
 def main():
     parser = argparse.ArgumentParser(description='Advanced Enterprise Network Analyzer')
-    parser.add_argument('file', help='Path to PCAPNG file')
+    parser.add_argument('file', nargs='?', help='Path to PCAPNG file')
     parser.add_argument('-n', '--top-n', type=int, default=10,
                        help='Number of top results to display (default: 10)')
     parser.add_argument('-s', '--save-report', action='store_true',
@@ -575,40 +5707,192 @@ def main():
                        help='Path to configuration file')
     parser.add_argument('--parallel', action='store_true',
                        help='Use parallel processing for large files')
+    parser.add_argument('--workers', type=int, default=None,
+                       help='Worker processes for --parallel (default: CPU count)')
     parser.add_argument('--virustotal', action='store_true',
                        help='Enable VirusTotal integration')
     parser.add_argument('--behavioral', action='store_true',
                        help='Enable behavioral analysis')
+    parser.add_argument('--report-format', choices=StreamingReportWriter.FORMATS, default='json',
+                       help='Saved report format: indented JSON or NDJSON, one record per line (default: json)')
     parser.add_argument('--stix', action='store_true',
                        help='Generate STIX report')
+    parser.add_argument('--stix-per-threat', action='store_true',
+                       help='One STIX indicator per threat instead of one per unique IP/domain with sightings')
     parser.add_argument('--split-size', type=int, default=1000000,
                        help='Packet count per split for large files')
+    parser.add_argument('--streaming', action='store_true',
+                       help='Streaming analysis with bounded memory (packets are not kept)')
+    parser.add_argument('--sketch-capacity', type=int, default=0,
+                       help='Keep top IPs/DNS names/protocols in Space-Saving sketches of this size '
+                            '(bounded memory, counts overestimated by at most packets/size)')
+    parser.add_argument('--compile-ioc', nargs=2, metavar=('FEED_JSON', 'SNAPSHOT'),
+                       help='Compile a JSON IOC feed into a memory-mapped snapshot and exit')
+    parser.add_argument('--backend', choices=CAPTURE_BACKENDS, default='native',
+                       help='Capture decoder: built-in mmap pcap/pcapng reader, tshark field '
+                            'extraction or pyshark (default: native)')
+    parser.add_argument('--stage-timings', action='store_true',
+                       help='Time each pipeline stage (decode, threats, IOC, detectors, reports) and print a breakdown')
+    parser.add_argument('--metrics-file', metavar='PATH',
+                       help='Periodically write stage metrics to PATH (implies --stage-timings)')
+    parser.add_argument('--metrics-format', choices=PipelineMetrics.FORMATS, default=None,
+                       help='Metrics file format (default: prometheus for *.prom, otherwise json)')
+    parser.add_argument('--metrics-interval', type=float, default=30.0,
+                       help='Seconds between metrics file updates (default: 30)')
+    parser.add_argument('--benchmark', metavar='OUTPUT_JSON',
+                       help='Run the benchmark suite on synthetic captures and save results')
+    parser.add_argument('--bench-mixes', type=_bench_mixes, default=','.join(SyntheticCaptureGenerator.MIXES),
+                       help='Comma-separated traffic mixes for --benchmark/--generate-capture')
+    parser.add_argument('--bench-packets', type=int, default=200000,
+                       help='Packets per synthetic capture (default: 200000)')
+    parser.add_argument('--bench-backends', type=_bench_backends, default=','.join(CAPTURE_BACKENDS),
+                       help='Comma-separated capture backends to benchmark')
+    parser.add_argument('--bench-baseline', metavar='JSON',
+                       help='Previous benchmark results to compare against')
+    parser.add_argument('--generate-capture', metavar='MIX', choices=list(SyntheticCaptureGenerator.MIXES),
+                       help='Write a synthetic capture with the given traffic mix to FILE and exit')
+    parser.add_argument('--compare-backends', action='store_true',
+                       help='Measure packets/sec of each capture backend on the file and exit')
+    parser.add_argument('--compare-limit', type=int, default=None,
+                       help='Packets to read per backend with --compare-backends')
+    parser.add_argument('--checkpoint', nargs='?', const='', default=None, metavar='PATH',
+                       help='Resume from and update a checkpoint, analyzing only appended packets '
+                            '(default path: <file>.checkpoint; implies --streaming)')
+    parser.add_argument('--cache-dir', metavar='DIR',
+                       help='Reuse stored results for captures whose content is unchanged')
+    parser.add_argument('--cache-max-mb', type=float, default=1024,
+                       help='Result cache size limit, least recently used entries are evicted (default: 1024)')
+    parser.add_argument('--cache-sampled', action='store_true',
+                       help='Fingerprint captures from size and sampled blocks instead of the full content')
+    parser.add_argument('--history-db', metavar='SQLITE',
+                       help='Record each analyzed capture in an indexed history database '
+                            '(with --sketch-capacity only the top IPs and domains are recorded)')
+    parser.add_argument('--query-ip', metavar='IP',
+                       help='List captures in --history-db that contacted IP, then exit')
+    parser.add_argument('--query-domain', metavar='DOMAIN',
+                       help='List captures in --history-db with DNS queries for DOMAIN or its subdomains, then exit')
+    parser.add_argument('--since-days', type=float, default=None,
+                       help='Restrict history queries to captures from the last N days')
+    parser.add_argument('--live', metavar='INTERFACE',
+                       help='Continuous windowed analysis of a live interface')
+    parser.add_argument('--live-backend', choices=['scapy', 'pyshark'], default='scapy',
+                       help='Live capture library (default: scapy)')
+    parser.add_argument('--replay', action='store_true',
+                       help='Windowed analysis of FILE replayed at its recorded pace')
+    parser.add_argument('--replay-speed', type=float, default=1.0,
+                       help='Replay speed multiplier, 0 = as fast as possible (default: 1.0)')
+    parser.add_argument('--window', type=float, default=10.0,
+                       help='Window length in seconds for --live/--replay (default: 10)')
+    parser.add_argument('--slide', type=float, default=0,
+                       help='Sliding window step in seconds, 0 = tumbling windows (default: 0)')
+    parser.add_argument('--window-output', metavar='NDJSON',
+                       help='Append per-window results to this NDJSON file')
     
     args = parser.parse_args()
     
+    if args.compile_ioc:
+        IOCSnapshot.compile(*args.compile_ioc)
+        print(f"IOC snapshot written: {args.compile_ioc[1]}")
+        return
+    
+    if args.benchmark:
+        run_benchmark(args.benchmark, args.bench_mixes, args.bench_packets,
+                      args.bench_backends, args.config,
+                      baseline_file=args.bench_baseline)
+        return
+    
+    if args.generate_capture:
+        if not args.file:
+            parser.error('--generate-capture requires an output file')
+        SyntheticCaptureGenerator(args.generate_capture).write(args.file, args.bench_packets)
+        print(f"Synthetic {args.generate_capture} capture written: {args.file}")
+        return
+    
+    if args.query_ip or args.query_domain:
+        if not args.history_db:
+            parser.error('--query-ip/--query-domain require --history-db')
+        query_history(args)
+        return
+    
+    if args.live or args.replay:
+        analyzer = AdvancedEnterpriseNetworkAnalyzer(args.config)
+        if args.stage_timings or args.metrics_file:
+            analyzer.enable_metrics(args.metrics_file, args.metrics_format, args.metrics_interval)
+        live_analyzer = LiveStreamAnalyzer(analyzer, args.window, args.slide,
+                                           behavioral_analysis=args.behavioral,
+                                           top_n=args.top_n,
+                                           output_file=args.window_output)
+        if args.live:
+            print(f"Live analysis on {args.live}: {args.window}s windows. Press Ctrl+C to stop...")
+            source = live_capture(args.live, args.live_backend, stats=live_analyzer.source_stats)
+        elif args.file:
+            source = replay_capture(args.file, args.replay_speed)
+        else:
+            parser.error('--replay requires a capture file')
+        try:
+            live_analyzer.run(source)
+        except CaptureError as e:
+            logging.error(str(e))
+            sys.exit(1)
+        return
+    
+    if not args.file:
+        parser.error('the following arguments are required: file')
+    
+    # Шарды читаются нативным бэкендом без обогащения, контрольных точек и кеша
+    if args.parallel:
+        unsupported = [flag for flag, enabled in (('--virustotal', args.virustotal),
+                                                  ('--checkpoint', args.checkpoint is not None),
+                                                  ('--cache-dir', bool(args.cache_dir)),
+                                                  ('--backend', args.backend != 'native')) if enabled]
+        if unsupported:
+            parser.error(f"--parallel cannot be combined with {', '.join(unsupported)}")
+    
     # Проверка существования файла
     if not os.path.exists(args.file):
         print(f"Error: File {args.file} not found")
         sys.exit(1)
     
+    if args.compare_backends:
+        compare_backends(args.file, max_packets=args.compare_limit)
+        return
+    
     # Обработка больших файлов
     file_size = os.path.getsize(args.file) / (1024 * 1024)  # Размер в MB
-    if file_size > 500 and not args.parallel:  # Файлы больше 500MB
-        print(f"Large file detected ({file_size:.2f} MB). Consider using --parallel option")
+    if file_size > 500 and not args.parallel and not args.streaming:  # Файлы больше 500MB
+        print(f"Large file detected ({file_size:.2f} MB). Consider using --parallel or --streaming option")
     
     # Инициализация расширенного анализатора
     analyzer = AdvancedEnterpriseNetworkAnalyzer(args.config)
+    if args.sketch_capacity:
+        analyzer.enable_sketches(args.sketch_capacity)
+    if args.history_db:
+        analyzer.history_store = CaptureHistoryStore(args.history_db)
+    analyzer.report_format = args.report_format
+    analyzer.stix_per_threat = args.stix_per_threat
+    if args.stage_timings or args.metrics_file:
+        analyzer.enable_metrics(args.metrics_file, args.metrics_format, args.metrics_interval)
     
     if args.parallel:
-        parallel_analyzer = ParallelNetworkAnalyzer(analyzer)
-        parallel_analyzer.analyze_large_file(args.file, args.split_size)
+        parallel_analyzer = ParallelNetworkAnalyzer(analyzer, args.config, args.workers)
+        parallel_analyzer.analyze_large_file(
+            args.file,
+            args.split_size,
+            args.top_n,
+            args.save_report,
+            behavioral_analysis=args.behavioral
+        )
     else:
         asyncio.run(analyzer.analyze_pcapng_advanced(
             args.file, 
             args.top_n, 
             args.save_report,
             enable_vt=args.virustotal,
-            behavioral_analysis=args.behavioral
+            behavioral_analysis=args.behavioral,
+            streaming=args.streaming,
+            backend=args.backend,
+            checkpoint_file=(args.checkpoint or f"{args.file}.checkpoint") if args.checkpoint is not None else None,
+            result_cache=AnalysisResultCache(args.cache_dir, args.cache_max_mb, args.cache_sampled) if args.cache_dir else None
         ))
 
 if __name__ == "__main__":
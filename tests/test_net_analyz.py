@@ -0,0 +1,1412 @@
+import asyncio
+import email
+import hashlib
+import importlib.util
+import io
+import json
+import os
+import random
+import re
+import socket
+import socketserver
+import sqlite3
+import struct
+import sys
+import threading
+import time
+from datetime import datetime
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+MODULE_PATH = os.path.join(os.path.dirname(__file__), '..', 'src', 'network', 'net-analyz.py')
+
+
+@pytest.fixture(scope='module')
+def na():
+    spec = importlib.util.spec_from_file_location('net_analyz', MODULE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['net_analyz'] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def write_config(tmp_path, section, settings):
+    config_file = tmp_path / 'config.ini'
+    lines = [f'[{section}]'] + [f'{key} = {value}' for key, value in settings.items()]
+    config_file.write_text('\n'.join(lines) + '\n')
+    return str(config_file)
+
+
+class StubVirusTotal:
+    """Заглушка API: считает запросы, одновременность и клиентские соединения"""
+
+    def __init__(self, delay=0.05):
+        self.delay = delay
+        self.requests = []
+        self.peers = set()
+        self.active = 0
+        self.max_active = 0
+
+    async def handle(self, request):
+        self.requests.append((request.match_info['value'], time.monotonic()))
+        self.peers.add(request.transport.get_extra_info('peername'))
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.active -= 1
+        if request.match_info['value'].startswith('unknown'):
+            return web.Response(status=404)
+        return web.json_response({'data': {'id': request.match_info['value']}})
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get('/ip_addresses/{value}', self.handle)
+        return app
+
+
+def run_with_stub(na, tmp_path, stub, settings, scenario):
+    async def main():
+        server = TestServer(stub.app())
+        await server.start_server()
+        try:
+            config_file = write_config(tmp_path, 'VIRUSTOTAL', {
+                'api_key': 'test-key',
+                'base_url': str(server.make_url('')).rstrip('/'),
+                'cache_path': str(tmp_path / 'vt_cache.db'),
+                **settings
+            })
+            vt = na.VirusTotalIntegration(na.EnterpriseConfig(config_file))
+            try:
+                return await scenario(vt)
+            finally:
+                await vt.close()
+                vt.cache.close()
+        finally:
+            await server.close()
+    return asyncio.run(main())
+
+
+def test_vt_cache_file_is_created_on_first_lookup_only(na, tmp_path):
+    config_file = write_config(tmp_path, 'VIRUSTOTAL', {'cache_path': str(tmp_path / 'vt_cache.db')})
+    vt = na.VirusTotalIntegration(na.EnterpriseConfig(config_file))
+    assert asyncio.run(vt.check_ip_reputation('203.0.113.1')) is None
+    assert not (tmp_path / 'vt_cache.db').exists()
+
+    stub = StubVirusTotal(delay=0)
+
+    async def scenario(vt):
+        return await vt.check_ip_reputation('203.0.113.1')
+
+    assert run_with_stub(na, tmp_path, stub, {'requests_per_minute': 0}, scenario) == \
+        {'data': {'id': '203.0.113.1'}}
+    assert (tmp_path / 'vt_cache.db').exists()
+
+
+def test_vt_coalesces_identical_lookups_and_caches_results(na, tmp_path):
+    stub = StubVirusTotal()
+
+    async def scenario(vt):
+        results = await asyncio.gather(*(vt.check_ip_reputation('198.51.100.7') for _ in range(5)))
+        missing = await vt.check_ip_reputation('unknown-1')
+        again = await vt.check_ip_reputation('unknown-1')
+        cached = await vt.check_ip_reputation('198.51.100.7')
+        return results, missing, again, cached, vt.lookup_stats
+
+    results, missing, again, cached, stats = run_with_stub(
+        na, tmp_path, stub, {'requests_per_minute': 0}, scenario)
+    assert all(result == {'data': {'id': '198.51.100.7'}} for result in results)
+    assert missing is None and again is None
+    assert cached == results[0]
+    assert [value for value, _ in stub.requests] == ['198.51.100.7', 'unknown-1']
+    assert stats['coalesced'] == 4
+    assert stats['cache_hits'] == 2
+
+
+def test_vt_pools_connections_within_concurrency_limit(na, tmp_path):
+    stub = StubVirusTotal()
+
+    async def scenario(vt):
+        await asyncio.gather(*(vt.check_ip_reputation(f'192.0.2.{i}') for i in range(12)))
+
+    run_with_stub(na, tmp_path, stub, {'requests_per_minute': 0, 'max_concurrency': 3}, scenario)
+    assert len(stub.requests) == 12
+    assert stub.max_active <= 3
+    assert len(stub.peers) <= 3
+
+
+def test_vt_spaces_requests_by_rate_limit(na, tmp_path):
+    stub = StubVirusTotal(delay=0)
+
+    async def scenario(vt):
+        await asyncio.gather(*(vt.check_ip_reputation(f'192.0.2.{i}') for i in range(4)))
+
+    # 600 запросов в минуту - интервал 0.1 с
+    run_with_stub(na, tmp_path, stub, {'requests_per_minute': 600, 'max_concurrency': 4}, scenario)
+    times = sorted(timestamp for _, timestamp in stub.requests)
+    assert len(times) == 4
+    assert all(later - earlier >= 0.09 for earlier, later in zip(times, times[1:]))
+
+
+class StubSIEM:
+    """Заглушка SIEM: отвечает кодами из statuses по очереди, затем 200"""
+
+    def __init__(self, statuses=()):
+        self.statuses = list(statuses)
+        self.received = []
+
+    async def handle(self, request):
+        # aiohttp распаковывает тело с Content-Encoding: gzip
+        body = await request.read()
+        status = self.statuses.pop(0) if self.statuses else 200
+        if status == 200:
+            self.received.extend(json.loads(line) for line in body.decode().splitlines())
+        return web.Response(status=status)
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post('/events', self.handle)
+        return app
+
+
+def export_with_stub(na, tmp_path, stub, events, **settings):
+    async def main():
+        server = TestServer(stub.app())
+        await server.start_server()
+        try:
+            config_file = write_config(tmp_path, 'SIEM', {
+                'url': str(server.make_url('/events')),
+                'batch_size': 2,
+                'max_concurrency': 1,
+                'max_retries': 3,
+                'retry_backoff': 0.01,
+                'spool_dir': str(tmp_path / 'spool'),
+                **settings
+            })
+            exporter = na.SIEMExporter(na.EnterpriseConfig(config_file))
+            await exporter.start()
+            for event in events:
+                await exporter.submit(event)
+            await exporter.close()
+            return exporter.stats
+        finally:
+            await server.close()
+    return asyncio.run(main())
+
+
+def test_siem_counts_client_errors_as_rejected(na, tmp_path):
+    stub = StubSIEM([400])
+    stats = export_with_stub(na, tmp_path, stub, [{'id': i} for i in range(4)])
+    assert stats['rejected_batches'] == 1
+    assert stats['rejected_events'] == 2
+    assert stats['batches_sent'] == 1
+    assert stats['events_sent'] == 2
+    assert stats['retries'] == 0
+    assert [event['id'] for event in stub.received] == [2, 3]
+    assert not list((tmp_path / 'spool').glob('*.ndjson*'))
+
+
+def test_siem_retries_server_errors(na, tmp_path):
+    stub = StubSIEM([503, 429])
+    stats = export_with_stub(na, tmp_path, stub, [{'id': i} for i in range(2)], compression='none')
+    assert stats['retries'] == 2
+    assert stats['events_sent'] == 2
+    assert stats['rejected_batches'] == 0
+    assert [event['id'] for event in stub.received] == [0, 1]
+
+
+def test_siem_spools_undelivered_batches_and_replays_them(na, tmp_path):
+    stats = export_with_stub(na, tmp_path, StubSIEM([503] * 3), [{'id': i} for i in range(2)])
+    assert stats['spooled_events'] == 2
+    assert stats['events_sent'] == 0
+    assert len(list((tmp_path / 'spool').glob('*.ndjson.gz'))) == 1
+
+    stub = StubSIEM()
+    stats = export_with_stub(na, tmp_path, stub, [{'id': 2}])
+    assert stats['spool_replayed'] == 1
+    assert [event['id'] for event in stub.received] == [0, 1, 2]
+    assert not list((tmp_path / 'spool').glob('*.ndjson*'))
+
+
+def pcapng_block(block_type, body):
+    body += b'\x00' * (-len(body) % 4)
+    length = len(body) + 12
+    return struct.pack('<II', block_type, length) + body + struct.pack('<I', length)
+
+
+def test_pcapng_skips_packets_of_undeclared_interfaces(na, tmp_path, caplog):
+    frame = bytes(12) + b'\x08\x00' + bytes.fromhex('450000140000000040060000c0000201c6336407')
+    epb = lambda iface: pcapng_block(6, struct.pack('<IIIII', iface, 0, 1000000, len(frame), len(frame)) + frame)
+    capture = tmp_path / 'broken.pcapng'
+    capture.write_bytes(
+        pcapng_block(0x0A0D0D0A, struct.pack('<IHHq', 0x1A2B3C4D, 1, 0, -1)) +
+        pcapng_block(3, struct.pack('<I', len(frame)) + frame) +  # до описания интерфейса
+        pcapng_block(1, struct.pack('<HHI', 1, 0, 65535)) +
+        epb(5) +
+        epb(0))
+    reader = na.NativePcapReader(str(capture))
+    try:
+        packets = list(reader)
+    finally:
+        reader.close()
+    assert [packet.ip.dst for packet in packets] == ['198.51.100.7']
+    assert reader.position == capture.stat().st_size
+    assert sum('undeclared interface' in record.message for record in caplog.records) == 2
+
+
+def analyzer_config(tmp_path, **sections):
+    config_file = tmp_path / 'analyzer.ini'
+    sections.setdefault('DATABASE', {'db_path': str(tmp_path / 'analysis.db')})
+    sections.setdefault('QUARANTINE', {'quarantine_directory': str(tmp_path / 'quarantine')})
+    lines = []
+    for section, settings in sections.items():
+        lines.append(f'[{section}]')
+        lines.extend(f'{key} = {value}' for key, value in settings.items())
+    config_file.write_text('\n'.join(lines) + '\n')
+    return str(config_file)
+
+
+def test_streaming_aggregates_packet_stats_into_counters(na, tmp_path, capsys):
+    capture = na.SyntheticCaptureGenerator('mixed').write(str(tmp_path / 'mixed.pcap'), 2000)
+    config_file = analyzer_config(tmp_path)
+    results = {}
+    for streaming in (False, True):
+        analyzer = na.AdvancedEnterpriseNetworkAnalyzer(config_file)
+        asyncio.run(analyzer.analyze_pcapng_advanced(capture, streaming=streaming))
+        results[streaming] = analyzer
+    streamed = results[True].stats
+    for key in ('ip_addresses', 'dns_requests', 'protocols'):
+        assert isinstance(streamed[key], na.Counter)
+        assert streamed[key] == results[False].stat_counter(key)
+    assert sum(streamed['protocols'].values()) == 2000
+
+
+def test_split_cuts_shards_at_record_boundaries_near_byte_targets(na, tmp_path):
+    capture = na.SyntheticCaptureGenerator('mixed').write(str(tmp_path / 'mixed.pcap'), 3000)
+    reader = na.NativePcapReader(capture)
+    try:
+        total = len(reader._mm)
+        shards = reader.split(4)
+        assert len(shards) == 4
+        for i, shard in enumerate(shards):
+            assert shard['start'] >= total * i // 4
+            if i:
+                assert shard['start'] == shards[i - 1]['end']
+        assert shards[-1]['end'] == total
+        counts = [sum(1 for _ in reader.iter_range(shard['start'], shard['end'])) for shard in shards]
+        assert counts == [shard['packets'] for shard in shards]
+        assert sum(counts) == 3000
+        # Ограничение размера шарда увеличивает их число
+        assert len(reader.split(2, max_packets=500)) == 6
+    finally:
+        reader.close()
+
+
+def test_checkpoint_chain_digest_rehashes_only_appended_bytes(na, tmp_path):
+    capture = tmp_path / 'growing.pcap'
+    capture.write_bytes(b'first part')
+    checkpoint = na.AnalysisCheckpoint(str(tmp_path / 'state.ckpt'), str(capture),
+                                       key_file=str(tmp_path / 'checkpoint.key'))
+    first = checkpoint.chain_digest(None)
+    assert first == (hashlib.sha256(b'first part').hexdigest(), 10)
+    checkpoint.save(10, None, {}, [], first, [])
+
+    with open(capture, 'ab') as f:
+        f.write(b' appended')
+    state = checkpoint.load()
+    assert state['chain_digest'] == first[0]
+    digest, hashed_size = checkpoint.chain_digest(state)
+    assert hashed_size == 19
+    assert digest == hashlib.sha256(first[0].encode() + b' appended').hexdigest()
+    # Цепочка не выдается за SHA-256 файла
+    assert digest != hashlib.sha256(b'first part appended').hexdigest()
+
+
+def history_stats(na, ips):
+    return {'total_packets': sum(ips.values()), 'threats_found': []}, na.Counter(ips), na.Counter()
+
+
+def test_history_replaces_rows_of_a_growing_capture(na, tmp_path):
+    capture = tmp_path / 'growing.pcap'
+    capture.write_bytes(b'x' * 10)
+    store = na.CaptureHistoryStore(str(tmp_path / 'history.db'))
+    try:
+        store.record_capture(str(capture), 'hash-1', *history_stats(na, {'192.0.2.1': 3}))
+        with open(capture, 'ab') as f:
+            f.write(b'y' * 10)
+        store.record_capture(str(capture), 'hash-2', *history_stats(na, {'192.0.2.1': 5}))
+        rows = store.captures_for_ip('192.0.2.1')
+        assert [(row['file_hash'], row['hits']) for row in rows] == [('hash-2', 5)]
+
+        # Копия с тем же содержимым - другой захват, а не замена
+        copy = tmp_path / 'copy.pcap'
+        copy.write_bytes(capture.read_bytes())
+        store.record_capture(str(copy), 'hash-2', *history_stats(na, {'192.0.2.1': 5}))
+        assert len(store.captures_for_ip('192.0.2.1')) == 2
+    finally:
+        store.close()
+
+
+def test_history_migrates_captures_table_without_identity(na, tmp_path):
+    db_path = str(tmp_path / 'history.db')
+    conn = sqlite3.connect(db_path)
+    conn.executescript(na.CaptureHistoryStore.SCHEMA.replace(
+        'device INTEGER,', '').replace('inode INTEGER,', '').replace(
+        'file_hash TEXT NOT NULL,', 'file_hash TEXT NOT NULL UNIQUE,').replace(
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_captures_identity ON captures(file_path, device, inode);', ''))
+    conn.execute("INSERT INTO captures (id, file_path, file_hash, analyzed_at) VALUES (1, '/old.pcap', 'h', 'now')")
+    conn.execute("INSERT INTO ips (id, ip) VALUES (1, '192.0.2.9')")
+    conn.execute("INSERT INTO capture_ips (ip_id, capture_id, packets) VALUES (1, 1, 4)")
+    conn.commit()
+    conn.close()
+
+    store = na.CaptureHistoryStore(db_path)
+    try:
+        assert [row['hits'] for row in store.captures_for_ip('192.0.2.9')] == [4]
+        capture = tmp_path / 'same.pcap'
+        capture.write_bytes(b'z')
+        # Бывший UNIQUE(file_hash) больше не мешает двум файлам с одним содержимым
+        store.record_capture(str(capture), 'h', *history_stats(na, {'192.0.2.9': 1}))
+        assert len(store.captures_for_ip('192.0.2.9')) == 2
+    finally:
+        store.close()
+
+
+def make_packet(na, timestamp, src='10.0.0.5', dst='198.51.100.7', length=100, transport='UDP',
+                srcport=40000, dstport=53, flags=None, qry_name=None, flags_response=None):
+    packet = na.PacketRecord()
+    layers = ['ETH', 'IP', transport]
+    if qry_name is not None:
+        layers.append('DNS')
+    packet.layers = layers
+    packet.highest_layer = layers[-1]
+    packet.transport_layer = transport
+    packet.length = length
+    packet.sniff_timestamp = timestamp
+    packet.src, packet.dst = src, dst
+    packet.srcport, packet.dstport = srcport, dstport
+    packet.flags = flags
+    packet.qry_name = qry_name
+    packet.flags_response = flags_response
+    return packet
+
+
+def test_behavioral_flags_unusually_long_gap_and_merges_gap_stats(na):
+    times = [1000.0 + 0.5 * i for i in range(200)] + [1200.0]
+    single = na.BehavioralAnalyzer(window_size=10)
+    anomalies = []
+    for timestamp in times:
+        anomalies.extend(single.process_packet(make_packet(na, timestamp)) or [])
+    assert [a['type'] for a in anomalies] == ['HOST_GAP_ANOMALY']
+    assert anomalies[0]['value'] == pytest.approx(100.5)
+    assert single.host_baselines()[0]['avg_gap'] > 0.5
+
+    first, second = na.BehavioralAnalyzer(window_size=10), na.BehavioralAnalyzer(window_size=10)
+    for timestamp in times[:100]:
+        first.process_packet(make_packet(na, timestamp))
+    for timestamp in times[100:-1]:
+        second.process_packet(make_packet(na, timestamp))
+    first.merge(second)
+    merged_gap = first.profiles[('10.0.0.5', 'UDP')].gap
+    assert merged_gap.count == 198  # интервал на границе шардов не виден ни одному из них
+    assert merged_gap.mean == pytest.approx(0.5)
+
+
+def encrypt_bytes(na, keyring, data, chunk_size=16):
+    cipher = na.ChunkedFileCipher(keyring, chunk_size=chunk_size)
+    encrypted = io.BytesIO()
+    cipher.encrypt_stream(io.BytesIO(data), encrypted)
+    return cipher, encrypted.getvalue()
+
+
+def decrypt_bytes(cipher, data):
+    plain = io.BytesIO()
+    cipher.decrypt_stream(io.BytesIO(data), plain)
+    return plain.getvalue()
+
+
+def test_chunked_cipher_round_trips_multiple_chunks(na, tmp_path):
+    keyring = na.QuarantineKeyring(str(tmp_path / 'keys'))
+    for data in (b'', b'x' * 16, bytes(range(256)) * 3 + b'tail'):
+        cipher, encrypted = encrypt_bytes(na, keyring, data)
+        header_size = na.ChunkedFileCipher.HEADER.size
+        chunks = max(1, -(-len(data) // 16))
+        assert len(encrypted) == header_size + len(data) + chunks * na.ChunkedFileCipher.TAG_SIZE
+        assert decrypt_bytes(cipher, encrypted) == data
+        assert cipher.decrypt_stream(io.BytesIO(encrypted), io.BytesIO()) == \
+            (len(data), hashlib.sha256(data).hexdigest())
+
+
+def test_chunked_cipher_rejects_tampering_reordering_and_truncation(na, tmp_path):
+    keyring = na.QuarantineKeyring(str(tmp_path / 'keys'))
+    cipher, encrypted = encrypt_bytes(na, keyring, bytes(range(64)))
+    header_size = na.ChunkedFileCipher.HEADER.size
+    block = 16 + na.ChunkedFileCipher.TAG_SIZE
+    header, body = encrypted[:header_size], encrypted[header_size:]
+    blocks = [body[i:i + block] for i in range(0, len(body), block)]
+    assert len(blocks) == 4
+
+    flipped_chunk = bytearray(encrypted)
+    flipped_chunk[header_size + block + 3] ^= 1
+    flipped_salt = bytearray(encrypted)
+    flipped_salt[20] ^= 1  # salt входит в AAD и вывод ключа файла
+    corrupted = {
+        'chunk': bytes(flipped_chunk),
+        'header': bytes(flipped_salt),
+        'reordered': header + blocks[1] + blocks[0] + blocks[2] + blocks[3],
+        'truncated': header + b''.join(blocks[:3]),
+        'truncated header': encrypted[:header_size - 1],
+    }
+    for name, data in corrupted.items():
+        with pytest.raises(ValueError):
+            decrypt_bytes(cipher, data)
+
+
+def test_quarantine_keyring_persists_and_keeps_rotated_keys(na, tmp_path):
+    key_file = str(tmp_path / 'keys' / 'quarantine.keys')
+    keyring = na.QuarantineKeyring(key_file)
+    assert os.stat(key_file).st_mode & 0o777 == 0o600
+    cipher, encrypted = encrypt_bytes(na, keyring, b'sample' * 10)
+
+    reopened = na.QuarantineKeyring(key_file)
+    assert reopened.active == keyring.active
+    new_key_id = reopened.rotate()
+    assert reopened.active[0] == new_key_id != keyring.active[0]
+
+    # Ключ из другого процесса подхватывается при расшифровке старых файлов
+    assert decrypt_bytes(na.ChunkedFileCipher(na.QuarantineKeyring(key_file)), encrypted) == b'sample' * 10
+    assert keyring.get(new_key_id) == reopened.active[1]
+    with pytest.raises(KeyError):
+        keyring.get(b'\x00' * 8)
+
+
+def quarantine_system(na, tmp_path):
+    config_file = analyzer_config(tmp_path, QUARANTINE={'quarantine_directory': str(tmp_path / 'quarantine'),
+                                                        'chunk_size_kb': 1})
+    return na.QuarantineSystem(na.EnterpriseConfig(config_file))
+
+
+def test_quarantine_deduplicates_blobs_and_removes_them_with_last_instance(na, tmp_path):
+    quarantine = quarantine_system(na, tmp_path)
+    payload = b'malware sample ' * 500
+    ids = []
+    for name in ('first.bin', 'second.bin'):
+        sample = tmp_path / name
+        sample.write_bytes(payload)
+        ids.append(quarantine.quarantine_file(str(sample), 'test', {'name': name}))
+        assert not sample.exists()
+    blob = quarantine.blob_path(hashlib.sha256(payload).hexdigest())
+    stats = quarantine.storage_stats()
+    assert (stats['instances'], stats['unique_blobs']) == (2, 1)
+    assert stats['deduplicated_bytes'] == len(payload)
+
+    assert quarantine.delete(ids[0])
+    assert os.path.exists(blob)
+    restored = tmp_path / 'restored.bin'
+    assert quarantine.restore_file(ids[1], str(restored))
+    assert restored.read_bytes() == payload
+
+    assert quarantine.delete(ids[1])
+    assert not os.path.exists(blob)
+    assert quarantine.storage_stats()['unique_blobs'] == 0
+    assert not quarantine.delete(ids[1])
+
+
+@pytest.mark.parametrize('use_processes', [False, True])
+def test_quarantine_batch_in_threads_and_processes(na, tmp_path, use_processes):
+    quarantine = quarantine_system(na, tmp_path)
+    contents = {'a.bin': b'A' * 3000, 'b.bin': b'B' * 10, 'c.bin': b'A' * 3000}
+    paths = []
+    for name, data in contents.items():
+        (tmp_path / name).write_bytes(data)
+        paths.append(str(tmp_path / name))
+    paths.append(str(tmp_path / 'missing.bin'))
+
+    results = quarantine.quarantine_batch(paths, 'batch', workers=2, use_processes=use_processes)
+    assert results[paths[-1]] is None
+    assert all(results[path] for path in paths[:-1])
+    assert quarantine.storage_stats()['unique_blobs'] == 2
+    for path, data in zip(paths, contents.values()):
+        assert not os.path.exists(path)
+        assert quarantine.restore_file(results[path], path)
+        assert open(path, 'rb').read() == data
+
+
+class SlowVirusTotal:
+    def __init__(self, delay):
+        self.delay = delay
+
+    async def check_ip_reputation(self, ip):
+        await asyncio.sleep(self.delay)
+        return None
+
+
+def test_enrichment_submission_time_does_not_depend_on_vt_latency(na, tmp_path):
+    analyzer = na.AdvancedEnterpriseNetworkAnalyzer(analyzer_config(tmp_path, VIRUSTOTAL={'enrichment_workers': 2,
+                                                                                          'enrichment_queue_size': 4}))
+    assert analyzer.create_enrichment_queue().backpressure == 'drop'
+
+    async def submit_all(delay):
+        analyzer.advanced_threat_analyzer.vt_integration = SlowVirusTotal(delay)
+        enrichment = analyzer.create_enrichment_queue()
+        enrichment.start()
+        started = time.perf_counter()
+        for i in range(200):
+            await enrichment.submit(f'203.0.113.{i}')
+            await asyncio.sleep(0)
+        elapsed = time.perf_counter() - started
+        await enrichment.join()
+        return elapsed, enrichment.stats
+
+    fast, fast_stats = asyncio.run(submit_all(0))
+    slow, slow_stats = asyncio.run(submit_all(0.2))
+    assert slow < fast + 0.1  # одна задержка VT - 0.2 с
+    assert slow_stats['dropped'] > 150
+    assert slow_stats['submitted'] + slow_stats['dropped'] == 200
+    assert fast_stats['completed'] == fast_stats['submitted']
+
+
+IOC_FEED = {
+    'malicious_ips': ['192.0.2.10', '198.51.100.0/24', '198.51.100.128/25', '2001:db8::/32'],
+    'suspicious_domains': ['evil.com', 'bad.example.org', 'miner', 'coin', 'tunnel'],
+    'malware_hashes': []
+}
+
+
+def test_domain_index_matches_suffixes_at_label_boundaries_and_keywords(na):
+    index = na.DomainSuffixIndex(IOC_FEED['suspicious_domains'])
+    assert index.match('evil.com') == 'evil.com'
+    assert index.match('a.b.EVIL.com.') == 'evil.com'
+    assert index.match('notevil.com') is None
+    assert index.match('example.org') is None
+    assert index.match('x.bad.example.org') == 'bad.example.org'
+    # Ключевые слова без точки - подстроки; из нескольких берется первое по фиду
+    assert index.match('bitcoinminer.net') == 'miner'
+    assert index.match('coin-pool.net') == 'coin'
+    assert index.keywords == ['miner', 'coin', 'tunnel']
+
+
+def test_keyword_matcher_agrees_with_substring_scan(na):
+    rng = random.Random(5)
+    alphabet = 'abc.'
+    keywords = list(dict.fromkeys(''.join(rng.choice(alphabet) for _ in range(rng.randint(1, 4)))
+                                  for _ in range(40)))
+    matcher = na.KeywordMatcher(keywords[:20])
+    for keyword in keywords[20:]:  # добавление после первого поиска перестраивает автомат
+        matcher.match('warmup')
+        matcher.add(keyword)
+    for _ in range(500):
+        text = ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 12)))
+        expected = next((keyword for keyword in keywords if keyword in text), None)
+        assert matcher.match(text) == expected
+
+
+def test_ioc_lookups_match_exact_cidr_and_snapshot(na, tmp_path):
+    ioc_file = tmp_path / 'ioc.json'
+    ioc_file.write_text(json.dumps(IOC_FEED))
+    snapshot_file = str(tmp_path / 'ioc.snapshot')
+    na.IOCSnapshot.compile(str(ioc_file), snapshot_file)
+    managers = []
+    for path in (str(ioc_file), snapshot_file):
+        manager = na.IOCManager()
+        manager.load_from_file(path)
+        managers.append(manager)
+
+    for manager in managers:
+        assert manager.check_ip('192.0.2.10') == (True, {'source': 'local_ioc', 'tlp': 'RED', 'confidence': 'high'})
+        assert manager.check_ip('192.0.2.11')[0] is False
+        assert manager.check_ip('198.51.100.200')[1]['network'] == '198.51.100.128/25'
+        assert manager.check_ip('198.51.100.5')[1]['network'] == '198.51.100.0/24'
+        assert manager.check_ip('2001:db8::1')[1]['network'] == '2001:db8::/32'
+        assert manager.check_domain('www.evil.com')[1]['matched'] == 'evil.com'
+        assert manager.check_domain('dns-tunnel.net')[1]['matched'] == 'tunnel'
+        assert manager.check_domain('example.com') == (False, {})
+
+
+def ipv4_header(src, dst, proto, payload_len, ihl=5, fragment=0):
+    header = struct.pack('!BBHHHBBH4s4s', 0x40 | ihl, 0, 20 + payload_len, 0, fragment, 64, proto, 0,
+                         bytes(map(int, src.split('.'))), bytes(map(int, dst.split('.'))))
+    return header + bytes(max(0, ihl - 5) * 4)
+
+
+def dns_query(name):
+    question = b''.join(bytes([len(label)]) + label.encode() for label in name.split('.'))
+    return struct.pack('!HHHHHH', 0x1234, 0x0100, 1, 0, 0, 0) + question + b'\x00\x00\x01\x00\x01'
+
+
+def udp_dns_frame(src='192.0.2.1', dst='192.0.2.53', name='example.com', vlan_tags=0):
+    dns = dns_query(name)
+    udp = struct.pack('!HHHH', 5353, 53, 8 + len(dns), 0) + dns
+    ethernet = bytes(12)
+    for _ in range(vlan_tags):
+        ethernet += struct.pack('!HH', 0x8100, 100)
+    return ethernet + b'\x08\x00' + ipv4_header(src, dst, 17, len(udp)) + udp
+
+
+def write_pcap(path, frames, endian='<', nanoseconds=False, linktype=1, seconds=None):
+    magic = 0xA1B23C4D if nanoseconds else 0xA1B2C3D4
+    seconds = seconds or range(len(frames))
+    with open(path, 'wb') as f:
+        f.write(struct.pack(endian + 'IHHiIII', magic, 2, 4, 0, 0, 65535, linktype))
+        for second, frame in zip(seconds, frames):
+            f.write(struct.pack(endian + 'IIII', 1700000000 + second, 500 if nanoseconds else 250000,
+                                len(frame), len(frame)))
+            f.write(frame)
+    return str(path)
+
+
+def read_all(na, path):
+    reader = na.NativePcapReader(str(path))
+    try:
+        return list(reader), reader.position
+    finally:
+        reader.close()
+
+
+def tshark_fields(na, epoch='1700000000.250000000', length='100', protocols='eth:ethertype:ip:udp:dns',
+                  **fields):
+    """Строка вывода tshark -T fields, разбитая по табуляции"""
+    values = {'frame.time_epoch': epoch, 'frame.len': length, 'frame.protocols': protocols, **fields}
+    return [values.get(field, '') for field in na.TsharkFieldReader.FIELDS]
+
+
+def test_tshark_parse_matches_native_decoder(na, tmp_path):
+    frame = udp_dns_frame()
+    [native], _ = read_all(na, write_pcap(tmp_path / 'dns.pcap', [frame]))
+    record = na.TsharkFieldReader._parse(tshark_fields(
+        na, length=str(len(frame)), **{'ip.src': '192.0.2.1', 'ip.dst': '192.0.2.53', 'udp.srcport': '5353',
+                                   'udp.dstport': '53', 'dns.qry.name': 'example.com',
+                                   'dns.flags.response': 'False'}))
+    for field in ('sniff_timestamp', 'length', 'src', 'dst', 'transport_layer', 'srcport', 'dstport',
+                  'qry_name', 'flags_response', 'highest_layer'):
+        assert getattr(record, field) == getattr(native, field), field
+    assert record.layers == ['ETH', 'ETHERTYPE', 'IP', 'UDP', 'DNS']
+    assert 'DNS' in record and 'IPV6' not in record
+
+
+def test_tshark_parse_handles_ipv6_tcp_tunnels_and_bad_lines(na):
+    parse = na.TsharkFieldReader._parse
+    record = parse(tshark_fields(na, protocols='eth:ethertype:ipv6:tcp:tls', **{
+        'ipv6.src': '2001:db8::1', 'ipv6.dst': '2001:db8::2', 'tcp.srcport': '40000',
+        'tcp.dstport': '443', 'tcp.flags': '0x0018', 'dns.flags.response': '1'}))
+    assert (record.src, record.dst, record.transport_layer) == ('2001:db8::1', '2001:db8::2', 'TCP')
+    assert (record.srcport, record.dstport, record.flags) == (40000, 443, 0x18)
+    assert record.highest_layer == 'TLS'
+    # Поля DNS без имени запроса не заполняются
+    assert not hasattr(record, 'qry_name') and not hasattr(record, 'flags_response')
+
+    # occurrence=l: для туннеля приходят поля внутреннего пакета
+    record = parse(tshark_fields(na, protocols='eth:ethertype:ip:udp:vxlan:eth:ethertype:ip:tcp', **{
+        'ip.src': '10.1.0.5', 'ip.dst': '10.1.0.6', 'tcp.srcport': '22', 'tcp.dstport': '50000'}))
+    assert (record.src, record.transport_layer, record.srcport, record.flags) == ('10.1.0.5', 'TCP', 22, 0)
+
+    # Битый порт не прерывает чтение, короткая строка пропускается
+    record = parse(tshark_fields(na, protocols='eth:ethertype:ip:udp', **{
+        'ip.src': '192.0.2.1', 'ip.dst': '192.0.2.2', 'udp.srcport': '53,5353', 'udp.dstport': '53'}))
+    assert record.transport_layer == 'UDP' and not hasattr(record, 'srcport')
+    assert parse(tshark_fields(na)[:10]) is None
+    empty = parse([''] * 14)
+    assert (empty.sniff_timestamp, empty.length, empty.layers, empty.highest_layer) == (0.0, 0, [], 'UNKNOWN')
+
+
+@pytest.mark.parametrize('endian,nanoseconds', [('<', False), ('>', False), ('<', True), ('>', True)])
+def test_decoder_reads_pcap_in_both_byte_orders(na, tmp_path, endian, nanoseconds):
+    path = write_pcap(tmp_path / 'dns.pcap', [udp_dns_frame()], endian, nanoseconds)
+    [packet], _ = read_all(na, path)
+    assert packet.layers == ['ETH', 'IP', 'UDP', 'DNS']
+    assert packet.highest_layer == 'DNS'
+    assert (packet.ip.src, packet.ip.dst, packet.udp.dstport) == ('192.0.2.1', '192.0.2.53', 53)
+    assert packet.dns.qry_name == 'example.com'
+    assert packet.dns.flags_response == 0
+    fraction = 500e-9 if nanoseconds else 0.25
+    assert packet.sniff_timestamp == pytest.approx(1700000000 + fraction)
+
+
+def test_decoder_skips_stacked_vlan_tags(na, tmp_path):
+    path = write_pcap(tmp_path / 'vlan.pcap', [udp_dns_frame(vlan_tags=2)])
+    [packet], _ = read_all(na, path)
+    assert packet.layers == ['ETH', 'VLAN', 'VLAN', 'IP', 'UDP', 'DNS']
+    assert packet.dns.qry_name == 'example.com'
+
+
+def test_decoder_reads_ipv6_with_extension_headers(na, tmp_path):
+    tcp = struct.pack('!HHIIBBHHH', 40000, 443, 1, 0, 5 << 4, 0x02, 65535, 0, 0)
+    hop_by_hop = bytes([6, 0]) + bytes(6)  # следующий заголовок - TCP
+    ipv6 = struct.pack('!IHBB', 6 << 28, len(hop_by_hop) + len(tcp), 0, 64) + \
+        socket.inet_pton(socket.AF_INET6, '2001:db8::1') + socket.inet_pton(socket.AF_INET6, '2001:db8::2')
+    path = write_pcap(tmp_path / 'v6.pcap', [ipv6 + hop_by_hop + tcp], linktype=101)
+    [packet], _ = read_all(na, path)
+    assert packet.layers == ['IPV6', 'TCP']
+    assert 'IPV6' in packet and 'IP' not in packet
+    assert (packet.ipv6.src, packet.ipv6.dst) == ('2001:db8::1', '2001:db8::2')
+    assert (packet.tcp.dstport, packet.tcp.flags) == (443, 0x02)
+
+
+def test_decoder_handles_truncated_and_malformed_frames(na, tmp_path):
+    frame = udp_dns_frame()
+    bad_ihl = bytes(12) + b'\x08\x00' + ipv4_header('192.0.2.1', '192.0.2.2', 6, 20, ihl=4) + bytes(20)
+    frames = [frame[:14 + 20 + 4], bad_ihl, bytes(10), frame]
+    path = write_pcap(tmp_path / 'cut.pcap', frames)
+    with open(path, 'ab') as f:
+        f.write(struct.pack('<IIII', 1700000009, 0, len(frame), len(frame)) + frame[:30])  # запись дописывается
+
+    packets, position = read_all(na, path)
+    assert [packet.layers for packet in packets] == [['ETH', 'IP'], ['ETH'], [], ['ETH', 'IP', 'UDP', 'DNS']]
+    assert packets[0].ip.src == '192.0.2.1'
+    assert packets[2].highest_layer == 'UNKNOWN'
+    assert position == os.path.getsize(path) - 16 - 30
+
+
+def zipf_stream(rng, size, universe):
+    weights = [1 / (rank + 1) for rank in range(universe)]
+    return rng.choices([f'10.0.{i // 256}.{i % 256}' for i in range(universe)], weights, k=size)
+
+
+def assert_space_saving_bounds(sketch, truth):
+    total = sum(truth.values())
+    assert sketch.total == total
+    assert len(sketch) <= sketch.capacity
+    for item, count in sketch.counts.items():
+        # Оценка не занижена и завышена не больше, чем на хранимую ошибку <= N / capacity
+        assert truth[item] <= count <= truth[item] + sketch.errors[item]
+        assert sketch.errors[item] <= total / sketch.capacity
+    for item, count in truth.items():
+        if count > total / sketch.capacity:
+            assert item in sketch.counts
+
+
+def test_space_saving_overestimate_is_bounded(na):
+    rng = random.Random(7)
+    stream = zipf_stream(rng, 20000, 2000)
+    sketch = na.SpaceSavingCounter(capacity=50)
+    for item in stream:
+        sketch.append(item)
+    truth = na.Counter(stream)
+    assert_space_saving_bounds(sketch, truth)
+    assert [item for item, _ in sketch.most_common(3)] == [item for item, _ in truth.most_common(3)]
+
+
+def test_space_saving_merge_keeps_bounds_of_combined_stream(na):
+    rng = random.Random(11)
+    first, second = zipf_stream(rng, 8000, 1000), zipf_stream(rng, 12000, 3000)
+    sketches = []
+    for stream in (first, second):
+        sketch = na.SpaceSavingCounter(capacity=40)
+        for item in stream:
+            sketch.update(item)
+        sketches.append(sketch)
+    merged = na.merge_counts(sketches[0], sketches[1])
+    assert merged is sketches[0]
+    assert_space_saving_bounds(merged, na.Counter(first + second))
+
+    restored = na.SpaceSavingCounter.from_state(json.loads(json.dumps(merged.to_state())))
+    assert (restored.counts, restored.errors, restored.total) == (merged.counts, merged.errors, merged.total)
+    assert restored.min_count() == merged.min_count()
+
+
+def test_result_cache_hits_and_invalidates_on_file_config_and_feed_change(na, tmp_path, capsys):
+    capture = na.SyntheticCaptureGenerator('mixed').write(str(tmp_path / 'mixed.pcap'), 500)
+    cache = na.AnalysisResultCache(str(tmp_path / 'cache'))
+    ioc_file = tmp_path / 'ioc.json'
+    ioc_file.write_text(json.dumps(IOC_FEED))
+
+    def analyze(**sections):
+        analyzer = na.AdvancedEnterpriseNetworkAnalyzer(analyzer_config(tmp_path, IOC={'ioc_file': str(ioc_file)},
+                                                                         **sections))
+        asyncio.run(analyzer.analyze_pcapng_advanced(capture, streaming=True, result_cache=cache))
+        return 'Cached result' in capsys.readouterr().out, analyzer
+
+    cached, first = analyze()
+    assert not cached
+    cached, second = analyze()
+    assert cached
+    assert second.stats['total_packets'] == 500
+    assert second.stats['ip_addresses'] == first.stats['ip_addresses']
+    assert second.stats['threats_found'] == first.stats['threats_found']
+
+    # Порог в конфигурации, фид IOC и сам файл входят в ключ
+    assert analyze(ALERTS={'port_scan_threshold': 5})[0] is False
+    assert analyze(ALERTS={'port_scan_threshold': 5})[0] is True
+    ioc_file.write_text(json.dumps({**IOC_FEED, 'malicious_ips': ['8.8.4.4']}))
+    assert analyze()[0] is False
+    with open(capture, 'ab') as f:
+        f.write(struct.pack('<IIII', 1700001000, 0, 0, 0))
+    assert analyze()[0] is False
+    assert analyze()[0] is True
+
+
+def test_result_cache_evicts_least_recently_used_entries(na, tmp_path):
+    cache = na.AnalysisResultCache(str(tmp_path / 'cache'), max_size_mb=1)
+    payload = {'data': 'x' * 300000}
+    for i, key in enumerate(('a', 'b', 'c')):
+        cache.put(key, payload)
+        os.utime(cache._entry_path(key), (1000 + i, 1000 + i))
+    assert cache.get('a') == payload  # обращение обновляет время использования
+    cache.put('d', payload)
+    assert [key for key in 'abcd' if os.path.exists(cache._entry_path(key))] == ['a', 'c', 'd']
+    assert cache.get('b') is None
+
+
+def test_streaming_report_json_is_byte_identical_to_json_dump(na, tmp_path):
+    document = {
+        'report_metadata': {'file': 'захват.pcap', 'tags': ['a', 'б'], 'nested': {'empty': {}, 'none': None}},
+        'threats': [{'type': 'MALICIOUS_IP', 'ip': '192.0.2.1', 'details': {'score': 1.5, 'list': [1, [2, 3]]}},
+                    {'type': 'DNS', 'domain': 'пример.рф'}],
+        'counts': [['10.0.0.1', 5], ['10.0.0.2', 3]],
+        'empty_stream': [],
+        'sections': {'inner': ['x', {'y': []}], 'scalar': 'ok'},
+        'unicode_key_ключ': 'значение "в кавычках"\n',
+    }
+    expected = tmp_path / 'expected.json'
+    with open(expected, 'w', encoding='utf-8') as f:
+        json.dump(document, f, indent=2, ensure_ascii=False)
+
+    streamed = dict(document, threats=iter(document['threats']), empty_stream=iter([]),
+                    sections=dict(document['sections'], inner=iter(document['sections']['inner'])))
+    writer = na.StreamingReportWriter(str(tmp_path / 'streamed.json'))
+    writer.write(streamed)
+    assert (tmp_path / 'streamed.json').read_bytes() == expected.read_bytes()
+    assert writer.items_written == 4
+
+
+def test_streaming_report_ndjson_writes_header_and_one_line_per_item(na, tmp_path):
+    writer = na.StreamingReportWriter(str(tmp_path / 'report.ndjson'), 'ndjson')
+    writer.write({'file': 'a.pcap', 'threats': iter([{'ip': '192.0.2.1'}, {'ip': '192.0.2.2'}]),
+                  'summary': {'ports': iter([22, 23])}})
+    lines = [json.loads(line) for line in (tmp_path / 'report.ndjson').read_text().splitlines()]
+    assert lines == [
+        {'record': 'header', 'file': 'a.pcap', 'summary': {}},
+        {'record': 'threats', 'ip': '192.0.2.1'},
+        {'record': 'threats', 'ip': '192.0.2.2'},
+        {'record': 'summary.ports', 'value': 22},
+        {'record': 'summary.ports', 'value': 23},
+    ]
+
+
+STIX_THREATS = [
+    {'type': 'MALICIOUS_IP', 'ip': '192.0.2.1', 'severity': 'HIGH'},
+    {'type': 'MALICIOUS_IP', 'ip': '192.0.2.1', 'severity': 'HIGH'},
+    {'type': 'PORT_SCAN', 'source_ip': '192.0.2.1', 'severity': 'MEDIUM'},
+    {'type': 'SUSPICIOUS_DOMAIN', 'domain': "Bad'Site.example", 'severity': 'LOW'},
+    {'type': 'SUSPICIOUS_PORT', 'port': 4444, 'severity': 'MEDIUM'},
+    {'type': 'MALICIOUS_IP', 'ip': '2001:db8::1', 'severity': 'CRITICAL'},
+]
+
+
+def stix_objects(generator, threats, metadata=None):
+    metadata = metadata or {'filename': 'a.pcap', 'file_hash': 'abc'}
+    return list(generator.iter_aggregated_stix_objects(threats, metadata))
+
+
+def test_stix_aggregates_one_indicator_and_sighting_per_observable(na):
+    generator = na.STIXReportGenerator()
+    generator.observe(STIX_THREATS[0], 1700000000.0)
+    generator.observe(STIX_THREATS[2], 1700000060.5)
+    objects = stix_objects(generator, STIX_THREATS)
+    indicators = {obj['pattern']: obj for obj in objects if obj['type'] == 'indicator'}
+    sightings = {obj['sighting_of_ref']: obj for obj in objects if obj['type'] == 'sighting'}
+    assert list(indicators) == ["[ipv4-addr:value = '192.0.2.1']",
+                                "[domain-name:value = 'bad\\'site.example']",
+                                "[ipv6-addr:value = '2001:db8::1']"]
+    ip = indicators["[ipv4-addr:value = '192.0.2.1']"]
+    assert ip['labels'] == ['malicious-activity', 'high']
+    assert ip['description'] == 'Detected threats: MALICIOUS_IP x2, PORT_SCAN x1'
+    sighting = sightings[ip['id']]
+    assert sighting['count'] == 3
+    assert (sighting['first_seen'], sighting['last_seen']) == ('2023-11-14T22:13:20.000Z', '2023-11-14T22:14:20.500Z')
+    assert indicators["[ipv6-addr:value = '2001:db8::1']"]['labels'][1] == 'critical'
+
+
+def test_stix_ids_are_deterministic_uuid5(na):
+    first = stix_objects(na.STIXReportGenerator(), STIX_THREATS)
+    second = stix_objects(na.STIXReportGenerator(), list(reversed(STIX_THREATS)))
+    assert sorted(obj['id'] for obj in first) == sorted(obj['id'] for obj in second)
+    indicator = first[0]
+    expected = na.uuid.uuid5(na.STIXReportGenerator.ID_NAMESPACE, indicator['pattern'])
+    assert indicator['id'] == f'indicator--{expected}'
+    assert na.uuid.UUID(indicator['id'].split('--')[1]).version == 5
+    # Sighting зависит от источника: другой захват - другой Sighting того же индикатора
+    other = stix_objects(na.STIXReportGenerator(), STIX_THREATS, {'filename': 'b.pcap', 'file_hash': 'def'})
+    assert other[0]['id'] == indicator['id'] and other[1]['id'] != first[1]['id']
+
+
+def test_stix_merge_sightings_widens_first_and_last_seen(na):
+    generator = na.STIXReportGenerator()
+    generator.observe({'ip': '192.0.2.1'}, 200.0)
+    generator.observe({'ip': '192.0.2.1'}, 100.0)
+    generator.observe({'port': 22}, 50.0)  # без наблюдаемого значения не учитывается
+    shard = na.STIXReportGenerator()
+    shard.observe({'ip': '192.0.2.1'}, 300.0)
+    shard.observe({'domain': 'Example.COM'}, 10.0)
+    generator.merge_sightings(json.loads(json.dumps(shard.sightings_state())))
+    assert generator.sightings == {('ipv4-addr', '192.0.2.1'): [100.0, 300.0],
+                                   ('domain-name', 'example.com'): [10.0, 10.0]}
+
+
+class SMTPSink:
+    """Минимальный SMTP сервер в потоке: принимает письма и считает соединения"""
+
+    def __init__(self, drop_after_message=False):
+        sink = self
+        self.messages = []
+        self.connections = 0
+        self.drop_after_message = drop_after_message
+
+        class Handler(socketserver.StreamRequestHandler):
+            def reply(self, line):
+                self.wfile.write(line.encode() + b'\r\n')
+
+            def handle(self):
+                sink.connections += 1
+                self.reply('220 sink ready')
+                envelope = {'rcpt': []}
+                while True:
+                    line = self.rfile.readline().decode().rstrip('\r\n')
+                    if not line:
+                        return
+                    command = line[:4].upper()
+                    if command == 'EHLO':
+                        self.reply('250 sink')
+                    elif command == 'MAIL':
+                        envelope = {'from': line.split(':', 1)[1], 'rcpt': []}
+                        self.reply('250 OK')
+                    elif command == 'RCPT':
+                        envelope['rcpt'].append(line.split(':', 1)[1])
+                        self.reply('250 OK')
+                    elif command == 'DATA':
+                        self.reply('354 end with .')
+                        data = []
+                        while (chunk := self.rfile.readline()) not in (b'.\r\n', b''):
+                            data.append(chunk)
+                        envelope['data'] = b''.join(data).decode()
+                        sink.messages.append(envelope)
+                        self.reply('250 queued')
+                        if sink.drop_after_message:
+                            return
+                    elif command == 'QUIT':
+                        self.reply('221 bye')
+                        return
+                    else:
+                        self.reply('250 OK')
+
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def alert_pipeline(na, tmp_path, sink, **alerts):
+    config_file = analyzer_config(tmp_path, EMAIL={'smtp_server': '127.0.0.1', 'smtp_port': sink.port,
+                                                   'use_tls': 'false', 'sender': 'ids@example.org',
+                                                   'recipients': 'soc@example.org, oncall@example.org'},
+                                  ALERTS=alerts)
+    return na.AlertPipeline(na.EnterpriseConfig(config_file))
+
+
+def test_alert_pipeline_sends_grouped_digests_over_one_smtp_session(na, tmp_path):
+    with SMTPSink() as sink:
+        pipeline = alert_pipeline(na, tmp_path, sink, alert_window=3600)
+        threats = [{'type': 'MALICIOUS_IP', 'ip': '192.0.2.1', 'severity': 'HIGH'}] * 3 + \
+                  [{'type': 'MALICIOUS_IP', 'ip': '192.0.2.2', 'severity': 'CRITICAL'}]
+        pipeline.add(threats, 'a.pcap')
+        assert not pipeline.flush()  # окно еще не закончилось
+        assert pipeline.flush(force=True)
+        pipeline.add(threats[:1], 'b.pcap')
+        pipeline.close()
+
+    assert sink.connections == 1
+    assert pipeline.stats['smtp_connections'] == 1
+    assert len(sink.messages) == 2
+    first = sink.messages[0]
+    assert [rcpt.strip('<> ') for rcpt in first['rcpt']] == ['soc@example.org', 'oncall@example.org']
+    assert 'Subject: [Security Alert] 4 threats in 2 groups' in first['data']
+    body = email.message_from_string(first['data']).get_payload()[0].get_payload(decode=True).decode()
+    # Группы по убыванию важности, повторы свернуты в счетчик
+    assert body.splitlines()[2] == '[CRITICAL] MALICIOUS_IP 192.0.2.2 x1'
+    assert '[HIGH] MALICIOUS_IP 192.0.2.1 x3' in body
+    assert 'sources: a.pcap' in body
+
+
+def test_alert_pipeline_rate_limits_and_reconnects(na, tmp_path):
+    with SMTPSink(drop_after_message=True) as sink:
+        pipeline = alert_pipeline(na, tmp_path, sink, max_emails_per_hour=2)
+        for ip in ('192.0.2.1', '192.0.2.2', '192.0.2.3'):
+            pipeline.add([{'type': 'MALICIOUS_IP', 'ip': ip, 'severity': 'HIGH'}], 'a.pcap')
+            pipeline.flush(force=True)
+        assert pipeline.stats['digests'] == 2
+        assert pipeline.stats['rate_limited'] == 1
+        assert len(pipeline.groups) == 1  # группа ждет следующего разрешенного письма
+        pipeline.close()
+
+    # Сервер закрывал сессию после каждого письма: вторая отправка переподключилась
+    assert sink.connections == 2
+    assert len(sink.messages) == 2
+    assert not pipeline.groups
+
+
+def tcp_syn(na, timestamp, src, dport):
+    return make_packet(na, timestamp, src=src, transport='TCP', dstport=dport, flags=0x02)
+
+
+def synthetic_packets(na, tmp_path, mix, count):
+    capture = na.SyntheticCaptureGenerator(mix).write(str(tmp_path / f'{mix}.pcap'), count)
+    return read_all(na, capture)[0]
+
+
+def run_detector_in_shards(detector_factory, packets, cuts):
+    """Детекторы по кускам потока, слитые в порядке шардов, как в параллельном анализе"""
+    bounds = [0] + list(cuts) + [len(packets)]
+    merged = None
+    for start, end in zip(bounds, bounds[1:]):
+        detector = detector_factory()
+        for packet in packets[start:end]:
+            detector.process_packet(packet)
+        if merged is None:
+            merged = detector
+        else:
+            merged.merge(detector)
+    return merged
+
+
+def test_port_scan_detector_counts_ports_in_adjacent_intervals(na):
+    # Сканер: 5 портов в конце интервала и 5 в начале следующего
+    packets = [tcp_syn(na, 1050.0 + 2 * i, '10.0.0.66', port) for i, port in enumerate(range(1000, 1010))]
+    # Медленный перебор: интервалы не соседние, порты не складываются
+    packets += [tcp_syn(na, 1000.0 + 130 * (i // 5) + i, '10.0.0.77', port)
+                for i, port in enumerate(range(2000, 2010))]
+    # Повторы одного порта не считаются, UDP не учитывается
+    packets += [tcp_syn(na, 1000.0 + i, '10.0.0.88', 443) for i in range(50)]
+    packets += [make_packet(na, 1000.0 + i, src='10.0.0.99', dstport=i) for i in range(50)]
+    packets.sort(key=lambda packet: packet.sniff_timestamp)
+
+    detector = na.PortScanDetector(threshold=10, window=60)
+    for packet in packets:
+        detector.process_packet(packet)
+    assert detector.scanners == {'10.0.0.66': 10}
+    [alert] = detector.finalize()
+    assert (alert['source_ip'], alert['ports_scanned'], alert['severity']) == ('10.0.0.66', 10, 'HIGH')
+
+    # Граница шардов внутри интервала и на границе интервалов
+    boundary = next(i for i, packet in enumerate(packets) if packet.sniff_timestamp >= 1060.0)
+    for cuts in ((boundary,), (boundary - 3, boundary + 2)):
+        merged = run_detector_in_shards(lambda: na.PortScanDetector(threshold=10, window=60), packets, cuts)
+        assert merged.scanners == {'10.0.0.66': 10}
+
+
+def test_port_scan_detector_hll_mode_for_large_thresholds(na):
+    detector = na.PortScanDetector(threshold=200, window=60)
+    assert detector.use_hll
+    for port in range(300):
+        detector.process_packet(tcp_syn(na, 1000.0 + port / 10, '10.0.0.66', port))
+    for port in range(150):
+        detector.process_packet(tcp_syn(na, 1000.0 + port / 10, '10.0.0.77', port))
+    assert list(detector.scanners) == ['10.0.0.66']
+    assert 'about' in detector.finalize()[0]['description']
+
+
+@pytest.mark.parametrize('cuts', [(1000,), (1, 2500), (700, 1400, 2100, 2800)])
+def test_port_scan_detector_merge_matches_single_pass_on_scan_mix(na, tmp_path, cuts):
+    packets = synthetic_packets(na, tmp_path, 'scan', 3000)
+    factory = lambda: na.PortScanDetector(threshold=20, window=60)
+    single = factory()
+    for packet in packets:
+        single.process_packet(packet)
+    assert single.scanners
+    merged = run_detector_in_shards(factory, packets, cuts)
+    assert set(merged.scanners) == set(single.scanners)
+    assert set(merged.sources) == set(single.sources)
+
+
+def dns_packet(na, timestamp, name, response=False, length=80):
+    return make_packet(na, timestamp, qry_name=name, flags_response=int(response), length=length)
+
+
+def test_dns_tunneling_registered_domain_split(na):
+    split = na.DNSTunnelingDetector.registered_domain
+    assert split('a.b.Example.COM.') == ('a.b', 'example.com')
+    assert split('x.y.bbc.co.uk') == ('x.y', 'bbc.co.uk')
+    assert split('example.com') == ('', 'example.com')
+    assert split('www.example.de') == ('www', 'example.de')
+
+
+def test_dns_tunneling_flags_high_entropy_subdomains_only(na):
+    rng = random.Random(3)
+    detector = na.DNSTunnelingDetector(check_interval=50, min_unique=50)
+    for i in range(300):
+        label = ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz234567') for _ in range(48))
+        detector.process_packet(dns_packet(na, 1000.0 + i, f'{label}.t.tunnel.example.com'))
+        # Ответ повторяет имя запроса и не учитывается
+        detector.process_packet(dns_packet(na, 1000.0 + i, f'{label}.t.tunnel.example.com', response=True))
+        detector.process_packet(dns_packet(na, 1000.0 + i, f"{('www', 'api', 'cdn')[i % 3]}.site{i % 40}.com"))
+    long_name = 'a' * 120 + '.example.org'
+    detector.process_packet(dns_packet(na, 1400.0, long_name))
+
+    findings = detector.finalize()
+    suspicion, tunnel = findings[0], findings[1]
+    assert suspicion['type'] == 'DNS_TUNNELING_SUSPICION'
+    assert [candidate['domain'] for candidate in suspicion['candidates']] == [long_name]
+    assert len(findings) == 2
+    assert (tunnel['domain'], tunnel['severity'], tunnel['queries']) == ('example.com', 'HIGH', 300)
+    assert tunnel['unique_subdomains'] == pytest.approx(300, rel=0.05)
+    assert tunnel['avg_entropy'] > 4
+
+
+def test_dns_tunneling_evicts_idle_domains_after_scoring_them(na):
+    detector = na.DNSTunnelingDetector(check_interval=10, min_unique=5, idle_timeout=60, max_domains=2)
+    for i in range(6):
+        detector.process_packet(dns_packet(na, 1000.0 + i, f'{"q" * 45}{i}.first.net'))
+    for i, domain in enumerate(('second.net', 'third.net', 'fourth.net')):
+        detector.process_packet(dns_packet(na, 2000.0 + i, f'www.{domain}'))
+    assert 'first.net' not in detector.domains
+    assert detector.evicted >= 1
+    assert detector.findings['first.net']['queries'] == 6
+
+
+@pytest.mark.parametrize('cuts', [(1500,), (400, 1700, 2600)])
+def test_dns_tunneling_merge_matches_single_pass_on_dns_heavy_mix(na, tmp_path, cuts):
+    packets = synthetic_packets(na, tmp_path, 'dns_heavy', 3000)
+    factory = lambda: na.DNSTunnelingDetector(min_unique=10)
+    single = factory()
+    for packet in packets:
+        single.process_packet(packet)
+    merged = run_detector_in_shards(factory, packets, cuts)
+    expected, actual = single.finalize(), merged.finalize()
+    assert [f['domain'] for f in actual] == [f['domain'] for f in expected] == ['tunnel-example.com']
+    for key in ('queries', 'bytes', 'unique_subdomains', 'severity'):
+        assert actual[0][key] == expected[0][key]
+
+
+def tcp_packet(na, timestamp, src, dst, srcport, dstport, flags=0x10, length=100):
+    return make_packet(na, timestamp, src=src, dst=dst, transport='TCP', srcport=srcport,
+                       dstport=dstport, flags=flags, length=length)
+
+
+def test_flow_table_end_reasons(na):
+    table = na.FlowTable(idle_timeout=60, active_timeout=300, closed_timeout=5, max_flows=3)
+    client, server = '10.0.0.5', '198.51.100.7'
+    # Закрытие: FIN с обеих сторон, затем closed_timeout
+    table.process_packet(tcp_packet(na, 1000.0, client, server, 40001, 443, flags=0x02))
+    table.process_packet(tcp_packet(na, 1000.1, server, client, 443, 40001, flags=0x12, length=1500))
+    table.process_packet(tcp_packet(na, 1000.2, client, server, 40001, 443, flags=0x11))
+    table.process_packet(tcp_packet(na, 1000.3, server, client, 443, 40001, flags='0x0011'))
+    # Сброс завершает поток так же
+    table.process_packet(tcp_packet(na, 1000.4, client, server, 40002, 443, flags=0x04))
+    table.process_packet(tcp_packet(na, 1010.0, client, server, 40003, 22))
+    assert table.end_reasons == {'closed': 2}
+    assert list(table.flows) == [(client, 40003, server, 22, 'TCP')]
+
+    # Длинное соединение выгружается частями, начало соединения сохраняется
+    for second in range(0, 700, 30):
+        table.process_packet(tcp_packet(na, 1010.0 + second, client, server, 40003, 22))
+    assert table.end_reasons['active'] == 2
+    assert table.flows[(client, 40003, server, 22, 'TCP')].connection_start == 1010.0
+
+    # Вытеснение сверх max_flows и простой
+    for port in range(50000, 50004):
+        table.process_packet(make_packet(na, 1700.0, src=client, srcport=port))
+    assert table.end_reasons['evicted'] == 2
+    table.expire(1800.0)
+    assert table.end_reasons['idle'] == 3
+    assert not table.flows
+
+    summary = table.summary()
+    assert summary['flows'] == 9 == sum(summary['end_reasons'].values())
+    first = [flow for flow in summary['top_flows'] if flow['sport'] == 443 or flow['dport'] == 443][0]
+    assert (first['src'], first['packets_fwd'], first['bytes_rev'], first['end_reason']) == (client, 2, 1600, 'closed')
+    assert summary['top_talkers'][0][0] == client
+
+
+def test_flow_anomaly_detector_flags_exfiltration_and_long_connections(na):
+    detector = na.FlowAnomalyDetector(exfil_bytes=10000, volume_bytes=15000, long_duration=600)
+    table = na.FlowTable(active_timeout=300, consumers=[detector])
+    for i in range(20):
+        table.process_packet(tcp_packet(na, 1000.0 + i, '10.0.0.5', '93.184.216.34', 40000, 443, length=1000))
+    table.process_packet(tcp_packet(na, 1000.0, '10.0.0.6', '10.0.0.7', 40000, 445, length=1000))
+    for second in range(0, 700, 30):
+        table.process_packet(tcp_packet(na, 1000.0 + second, '10.0.0.6', '10.0.0.7', 40000, 445))
+    types = [finding['type'] for finding in table.finalize()]
+    assert types == ['DATA_EXFILTRATION', 'HIGH_OUTBOUND_VOLUME', 'LONG_CONNECTION']
+
+
+@pytest.mark.parametrize('cuts', [(1500,), (1, 900, 2999)])
+def test_flow_table_merge_matches_single_pass_on_large_flows_mix(na, tmp_path, cuts):
+    packets = synthetic_packets(na, tmp_path, 'large_flows', 3000)
+    factory = lambda: na.FlowTable(consumers=[na.FlowAnomalyDetector(exfil_bytes=20000, ratio=1)])
+    single = factory()
+    for packet in packets:
+        single.process_packet(packet)
+    merged = run_detector_in_shards(factory, packets, cuts)
+    expected_findings, actual_findings = single.finalize(), merged.finalize()
+    expected, actual = single.summary(), merged.summary()
+    assert expected['flows'] > 1
+    assert actual['flows'] == expected['flows']
+    assert actual['end_reasons'] == expected['end_reasons']
+    assert actual['top_talkers'] == expected['top_talkers']
+    assert actual['top_flows'] == expected['top_flows']
+    assert expected_findings
+    assert sorted((f['type'], f.get('source_ip'), f.get('bytes_out')) for f in actual_findings) == \
+        sorted((f['type'], f.get('source_ip'), f.get('bytes_out')) for f in expected_findings)
+
+
+class RecordingAlertPipeline:
+    """Заглушка конвейера оповещений: запоминает переданные угрозы"""
+
+    def __init__(self):
+        self.added = []
+
+    def add(self, threats, source):
+        self.added.extend(threats)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def live_windows(na, tmp_path, packets, window, slide=0):
+    """Окна живого анализа, прочитанные из NDJSON вывода, как (начало, конец, пакеты)"""
+    ioc_file = tmp_path / 'ioc.json'
+    ioc_file.write_text(json.dumps(IOC_FEED))
+    analyzer = na.AdvancedEnterpriseNetworkAnalyzer(analyzer_config(tmp_path, IOC={'ioc_file': str(ioc_file)}))
+    analyzer.alert_pipeline = RecordingAlertPipeline()
+    output_file = tmp_path / 'windows.ndjson'
+    live = na.LiveStreamAnalyzer(analyzer, window=window, slide=slide, output_file=str(output_file))
+    live.run(packets)
+    windows = []
+    for line in output_file.read_text().splitlines():
+        result = json.loads(line)
+        windows.append((datetime.fromisoformat(result['window_start']).timestamp(),
+                        datetime.fromisoformat(result['window_end']).timestamp(), result['packets']))
+    return windows, analyzer.alert_pipeline.added
+
+
+@pytest.mark.parametrize('window,slide', [(4, 0), (4, 1), (3, 1.5)])
+def test_live_windows_cover_packets_between_their_boundaries(na, tmp_path, capsys, window, slide):
+    capture = na.SyntheticCaptureGenerator('mixed', packets_per_second=100).write(str(tmp_path / 'live.pcap'), 2000)
+    timestamps = [packet.sniff_timestamp for packet in read_all(na, capture)[0]]
+    windows, _ = live_windows(na, tmp_path, na.replay_capture(capture, speed=0), window, slide)
+
+    step = slide or window
+    assert len(windows) == pytest.approx((timestamps[-1] - timestamps[0]) / step, abs=2)
+    for (start, end, packets), (_, next_end, _) in zip(windows, windows[1:]):
+        assert next_end - end == pytest.approx(step)
+    for start, end, packets in windows:
+        assert end % step == pytest.approx(0, abs=1e-6) or end % step == pytest.approx(step)
+        assert end - start <= window + 1e-6
+        assert packets == sum(start <= t < end for t in timestamps)
+    # Полные скользящие окна имеют длину window, а каждый пакет попадает в window/step окон
+    assert all(end - start == pytest.approx(window) for start, end, _ in windows[round(window / step):-1])
+    if not slide:
+        assert sum(packets for _, _, packets in windows) == len(timestamps)
+
+
+def test_live_windows_catch_up_after_idle_gap(na, tmp_path, capsys):
+    capture = write_pcap(tmp_path / 'gap.pcap', [udp_dns_frame()] * 7, seconds=[0, 1, 2, 3, 4, 100, 101])
+    windows, _ = live_windows(na, tmp_path, na.replay_capture(capture, speed=0), window=10, slide=5)
+    base = 1700000000
+    # Пауза в 20 сегментов выдает только окна, пока сегмент до паузы не вытеснен
+    assert [(start - base, end - base, packets) for start, end, packets in windows] == \
+        [(0, 5, 5), (0, 10, 5), (95, 105, 2)]
+
+
+def test_live_sliding_windows_alert_each_threat_once(na, tmp_path, capsys):
+    capture = write_pcap(tmp_path / 'ioc.pcap', [udp_dns_frame(src='192.0.2.10')] * 20, seconds=range(20))
+    windows, alerted = live_windows(na, tmp_path, na.replay_capture(capture, speed=0), window=10, slide=2)
+    # Пакет входит в пять скользящих окон, но оповещение по нему одно
+    assert sum(packets for _, _, packets in windows) > 20
+    assert len(alerted) == 20
+    assert {threat['ip'] for threat in alerted} == {'192.0.2.10'}
+
+
+def sample_metrics(na, output_file, **kwargs):
+    metrics = na.PipelineMetrics(str(output_file), **kwargs)
+    metrics.add('decode', 0.5, 1000)
+    with metrics.stage('ioc "lookup"\n'):
+        pass
+    metrics.counters.update(packets=1000, threats=3)
+    metrics.merge({'stages': {'decode': {'seconds': 0.25, 'calls': 500}, 'report': {'seconds': 1.5, 'calls': 1}},
+                   'counters': {'packets': 500, 'ioc_hits': 2},
+                   'memory': {'rss_mb': 10.0, 'peak_rss_mb': 4096.0}})
+    return metrics
+
+
+def test_metrics_prometheus_text_format(na, tmp_path):
+    output_file = tmp_path / 'netanalyz.prom'
+    metrics = sample_metrics(na, output_file)
+    assert metrics.format == 'prometheus'
+    metrics.export()
+    assert os.listdir(tmp_path) == ['netanalyz.prom']
+
+    samples, types = {}, {}
+    sample_line = re.compile(r'^([a-z_]+)(\{stage="((?:[^"\\]|\\.)*)"\})? (\S+)$')
+    for line in output_file.read_text().splitlines():
+        if line.startswith('# TYPE '):
+            _, _, name, kind = line.split(' ')
+            assert name not in types
+            types[name] = kind
+            continue
+        if line.startswith('# HELP '):
+            continue
+        match = sample_line.match(line)
+        assert match, line
+        name, _, stage, value = match.groups()
+        # Образцы идут после объявления типа своего семейства
+        assert name in types and list(types)[-1] == name
+        samples[(name, stage)] = float(value)
+
+    assert types['netanalyz_stage_seconds_total'] == types['netanalyz_packets_total'] == 'counter'
+    assert types['netanalyz_memory_peak_rss_bytes'] == 'gauge'
+    assert samples[('netanalyz_stage_seconds_total', 'decode')] == pytest.approx(0.75)
+    assert samples[('netanalyz_stage_calls_total', 'decode')] == 1500
+    assert samples[('netanalyz_stage_calls_total', 'ioc \\"lookup\\"\\n')] == 1
+    assert samples[('netanalyz_packets_total', None)] == 1500
+    assert samples[('netanalyz_ioc_hits_total', None)] == 2
+    assert samples[('netanalyz_memory_peak_rss_bytes', None)] >= 4096 * 1024 * 1024
+
+
+def test_metrics_json_snapshot_and_export_interval(na, tmp_path):
+    with pytest.raises(ValueError):
+        na.PipelineMetrics(str(tmp_path / 'metrics.txt'), fmt='xml')
+    output_file = tmp_path / 'metrics.json'
+    metrics = sample_metrics(na, output_file, interval=3600)
+    assert metrics.format == 'json'
+    metrics.maybe_export()
+    assert not output_file.exists()
+    metrics.export()
+
+    document = json.loads(output_file.read_text())
+    assert set(document) == {'timestamp', 'uptime_seconds', 'stages', 'counters', 'memory'}
+    assert list(document['stages'])[:2] == ['report', 'decode']
+    assert document['stages']['decode'] == {'seconds': 0.75, 'calls': 1500}
+    assert document['counters'] == {'packets': 1500, 'threats': 3, 'ioc_hits': 2}
+    assert document['memory']['peak_rss_mb'] >= 4096.0
+    # Снимок одного процесса сливается в другой без потерь
+    total = na.PipelineMetrics()
+    total.merge(document)
+    total.merge(document)
+    assert total.snapshot()['stages']['decode'] == {'seconds': 1.5, 'calls': 3000}
+    assert total.counters['packets'] == 3000
+
+
+def test_bench_backends_are_validated_by_argparse(na, tmp_path, monkeypatch, capsys):
+    assert na._bench_backends('native,tshark') == ('native', 'tshark')
+    output_file = tmp_path / 'bench.json'
+    monkeypatch.setattr(sys, 'argv', ['net-analyz.py', '--benchmark', str(output_file),
+                                      '--bench-backends', 'native,wireshark'])
+    with pytest.raises(SystemExit) as exit_info:
+        na.main()
+    assert exit_info.value.code == 2
+    assert 'unknown capture backend: wireshark' in capsys.readouterr().err
+    assert not output_file.exists()